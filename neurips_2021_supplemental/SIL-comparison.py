@@ -894,6 +894,11 @@ if __name__ == '__main__':
         n_digits = exp_params.n_digits
         data_train, data_latent_train = Vocal_Digits(n_sample, n_digits, hpc = not(exp_params.local))
         data_test, data_latent_test = Vocal_Digits(n_sample, n_digits, hpc = not(exp_params.local), test = True)
+    elif not(exp_params.data_seed is None):
+        #opt-in (data_seed): the shared, disk-cached dataset of impression_learning.simulated_dataset, which is generated
+        #by impression_learning's generator rather than by this script's simulate_data
+        from impression_learning import simulated_dataset
+        mixing_matrix, data_train, data_latent_train, data_test, data_latent_test = simulated_dataset(n_latent, n_in, n_out, n_sample, n_test, dt, exp_params.data_seed)
     else:
         data_train, data_latent_train = simulate_data(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01)
         data_test, data_latent_test = simulate_data(n_latent, n_out, n_test, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01)
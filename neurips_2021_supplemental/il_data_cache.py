@@ -0,0 +1,65 @@
+"""On-disk cache for generated datasets.
+
+Each dataset is stored as a set of .npy files in a directory named by a hash of the parameters that generated it,
+and is reopened with np.load(mmap_mode = 'r'). Repeated runs, variant scripts and SLURM array tasks with identical
+data parameters therefore load the same files (and share the page cache) instead of regenerating the data."""
+import os
+import json
+import hashlib
+import numpy as np
+
+cache_dir = os.path.join(os.getcwd(), 'dataset_cache')
+
+def to_builtin(value):
+    """converts numpy scalars/arrays to plain python values so that they hash consistently"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def dataset_key(generator, version, **params):
+    """returns a hash identifying the dataset produced by the named generator with the given parameters
+    version: version of the generator, changed whenever the generator produces different data for the same parameters"""
+    description = {'generator': generator, 'version': version}
+    for name, value in params.items():
+        description[name] = to_builtin(value)
+    description = json.dumps(description, sort_keys = True)
+    return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+def load_dataset(key, names, build, directory = None):
+    """returns the arrays called names that are stored under key, memory-mapped read-only
+    build: called as build(create) if any array is missing. create(name, shape, dtype = np.float64) returns a writable,
+        memory-mapped array that build fills in place, so a dataset never has to fit in memory while it is written
+    directory: cache location (default: cache_dir)"""
+    if directory is None:
+        directory = cache_dir
+    path = os.path.join(directory, key)
+    files = [os.path.join(path, name + '.npy') for name in names]
+    if not(all([os.path.exists(file) for file in files])):
+        os.makedirs(path, exist_ok = True)
+        suffix = '.tmp' + str(os.getpid())
+        created = []
+        temporary = []
+
+        def create(name, shape, dtype = np.float64):
+            filename = os.path.join(path, name + '.npy' + suffix)
+            temporary.append((filename, name))
+            array = np.lib.format.open_memmap(filename, mode = 'w+', dtype = dtype, shape = shape)
+            created.append(array)
+            return array
+
+        try:
+            build(create)
+            for array in created:
+                array.flush()
+            del created[:]
+            #move the finished files into place, so concurrent readers never see a partial dataset
+            for filename, name in temporary:
+                os.replace(filename, os.path.join(path, name + '.npy'))
+        finally:
+            #a failed build leaves no temporary files behind
+            for filename, name in temporary:
+                if os.path.exists(filename):
+                    os.remove(filename)
+    return tuple([np.load(file, mmap_mode = 'r') for file in files])
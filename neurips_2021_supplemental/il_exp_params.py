@@ -5,6 +5,12 @@ local = True
 local_plot = True
 save = True
 layered = True
+fused = False #build networks from the allocation-free fused layers (results are identical)
+stacked = False #with fused: stack the matvecs that share a weight matrix into one GEMM (identical up to rounding)
+arena = False #allocate each network's trainable parameters as views into one contiguous vector (see ParameterArena)
+pooled_noise = False #seeded runs draw their network noise from per-run Generator pools (see NoiseProvider) instead of seeding np.random, and may skip unused draws. Faster, but the noise differs from the original runs
+legacy_data = False #generate simulated data with the original draw order and initial state (simulate_data_legacy), to reproduce earlier datasets
+data_seed = None #if set, simulated datasets are generated from this seed and cached on disk (see il_data_cache)
 if local == False:
     array_num = int(os.environ['SLURM_ARRAY_TASK_ID']);
 else:
@@ -86,6 +92,15 @@ elif mode == 'SNR':
     learning_rate = 1e-4 #learning rate
     switch_period = 1#int(n_sample/600000) #number of samples taken before switching from wake to sleep
     epoch_num_snr = 1000000
+    #the wake-sleep (and backprop) SNRs are estimated snr_batch_size episodes at a time, as the members of an ensemble
+    #(see update_snr, SNREstimator). Each member runs a chain of epoch_num_snr/snr_batch_size episodes; for these
+    #algorithms the statistics agree with the sequential estimate to well within its seed-to-seed spread, with no
+    #burn-in, at ~20x the speed. REINFORCE (decay = 1) builds its traces up over the whole run, so it is always
+    #estimated sequentially. snr_batch_size = 1 runs every algorithm sequentially, as the original code did.
+    #snr_burn_in: episodes per member run before the statistics are counted
+    snr_batch_size = 1000
+    snr_burn_in = 0
+    backprop_snr = False #also estimate the SNR of the backpropagated gradient (mean_backprop, var_backprop, snr_backprop)
 
 # Parameters for seeing how dimensionality affects SNR
 elif mode == 'dimensionality':
@@ -139,6 +154,9 @@ elif mode == 'lr_optim':
     learning_rate = 1e-2 / (10**((np.mod(array_num - 1, 20)+1)/2))
     recognition_scale = 1#(np.mod(array_num - 1, 10)+1) #learning rate
     switch_period = 1#int(n_sample/600000) #number of samples taken before switching from wake to sleep
+    ensemble_sweep = False #wake_sleep only: train the learning rates of tasks 1-20 together, one row each of a single EnsembleLayeredHM, all from the same initial network. Results go to impression_lr_sweep_1..20
+    learning_rate_sweep = 1e-2 / (10**((np.arange(20)+1)/2)) #learning rates of tasks 1-20
+    replicas = 1 #independent networks per learning rate in the ensemble sweep
 
     
     
@@ -194,6 +212,7 @@ elif mode == 'Vocal_Digits':
     n_in = n_out
     n_neurons = 100
     #n_neurons = 40
+    hidden_layers = [n_neurons, 40] #widths of the hidden layers from the bottom up; a longer list builds a deeper DeepHM
     n_sample = 0 #number of training data points
     n_digits = 10 #number of digits to extract from the MNIST data set
     n_test = 0 #number of testing data points
@@ -2,64 +2,194 @@ import numpy as np
 #import statsmodels.api as sm
 import time
 import il_exp_params as exp_params
+import il_data_cache
 import pickle
 import os
 from copy import copy, deepcopy
+from functools import partial
+from scipy.linalg import blas
+from scipy.signal import lfilter
 
 #Generate simulated inputs (Static FA)
-def simulate_data(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = 1, sigma_out = 0.01):
+def ar1_filter(noise, coefficients, prev):
+    """runs the recursion h[..., t] = coefficients * h[..., t-1] + noise[..., t] along the last axis as a linear filter,
+    starting from prev (the state before the first step). coefficients and prev broadcast against noise[..., 0]"""
+    coefficients = np.broadcast_to(coefficients, noise.shape[:-1])
+    prev = np.broadcast_to(prev, noise.shape[:-1])
+    h = np.empty(noise.shape)
+    #filter all dimensions sharing a coefficient at once
+    for coefficient in np.unique(coefficients):
+        idx = coefficients == coefficient
+        zi = (coefficient * prev[idx])[:, None]
+        h[idx], _ = lfilter([1.], [1., -coefficient], noise[idx], axis = -1, zi = zi)
+    return h
+
+def simulate_latent_chunk(latent_noise, transition_matrix, latent_prev):
+    """runs the latent recursion latent[:,t] = transition_matrix @ latent[:,t-1] + latent_noise[:,t] over one chunk,
+    starting from latent_prev (the last latent state of the previous chunk)
+    For a diagonal transition matrix, each latent dimension is an AR(1) process, which is computed as a linear filter along time"""
+    n_latent, n = latent_noise.shape
+    if np.count_nonzero(transition_matrix - np.diag(np.diag(transition_matrix))) == 0:
+        latent = ar1_filter(latent_noise, np.diag(transition_matrix), latent_prev)
+    else:
+        latent = np.empty((n_latent, n))
+        for ii in range(0, n):
+            latent_prev = transition_matrix @ latent_prev + latent_noise[:,ii]
+            latent[:,ii] = latent_prev
+    return latent
+
+def simulate_data_chunks(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = 1, sigma_out = 0.01, chunk_size = 100000, obs_noise = False, rng = None):
+    """simulate_data_chunks: generates the data of simulate_data in chunks of at most chunk_size samples,
+    yielding (data, latent) for each chunk. The latent state is carried over between chunks.
+    obs_noise: add observation noise (with standard deviation sigma_out) to the data. It is only drawn if added.
+    rng: numpy Generator to draw from (default: the global np.random state)"""
+    if rng is None:
+        rng = np.random
+    latent_prev = np.zeros((n_latent,))
+    for start in range(0, n_sample, chunk_size):
+        n = min(chunk_size, n_sample - start)
+        latent_noise = rng.normal(scale = sigma_latent, size = (n_latent, n))
+        latent = simulate_latent_chunk(latent_noise, transition_matrix, latent_prev)
+        latent_prev = latent[:,-1]
+        data = mixing_matrix @ latent
+        if obs_noise:
+            data += rng.normal(scale = sigma_out, size = (n_out, n))
+        yield data, latent
+
+def simulate_data_legacy(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = 1, sigma_out = 0.01):
+    """the original simulate_data, kept to reproduce the datasets of earlier runs: the latent noise of the whole dataset
+    is drawn at once, followed by an observation noise draw that is not added to the data, and only the first latent
+    dimension starts from its noise (latent[1:,0] = 0)"""
+    latent_noise = np.random.normal(scale = sigma_latent, size = (n_latent, n_sample))
+    latent = np.zeros((n_latent, n_sample))
+    latent[0,0] = latent_noise[0,0]
+    for ii in range(1, n_sample):
+        latent[:,ii] = transition_matrix @ latent[:,ii-1] + latent_noise[:,ii]
+    obs_noise = np.random.normal(scale = sigma_out, size = (n_out, n_sample))
+    data = mixing_matrix @ latent
+    return data, latent
+
+def simulate_data(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = 1, sigma_out = 0.01, chunk_size = 100000, obs_noise = False, rng = None, legacy = False):
     """simulate_data: generates data points for the Helmholtz Machine to learn on
     n_latent: number of latent states
     n_out: number of observed dimensions
     n_sample: number of samples to draw
     mixing_matrix: n_out x n_latent matrix mapping latent variables to observed
     sigma_latent: latent noise (default 1)
-    sigma_out: observation noise"""
+    sigma_out: observation noise (only used if obs_noise)
+    legacy: reproduce the original draw order and initial state exactly (see simulate_data_legacy). The chunked
+        generator draws from the random stream in a different order, and starts every latent dimension from its noise"""
+    if legacy:
+        return simulate_data_legacy(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent, sigma_out)
+    data = np.empty((n_out, n_sample))
+    latent = np.empty((n_latent, n_sample))
+    start = 0
+    for data_chunk, latent_chunk in simulate_data_chunks(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent, sigma_out, chunk_size, obs_noise, rng):
+        n = data_chunk.shape[1]
+        data[:, start:start + n] = data_chunk
+        latent[:, start:start + n] = latent_chunk
+        start += n
+    return data, latent
+
+class DataStream():
+    """The data of simulate_data as a re-iterable stream of chunks, so that training can consume it without
+    materialising the full dataset. Every pass over the stream replays the same samples.
+    seed: seed for the stream's Generator (default: drawn from the global np.random state)"""
+    def __init__(self, n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = 1, sigma_out = 0.01, chunk_size = 100000, obs_noise = False, seed = None):
+        self.n_latent = n_latent
+        self.n_out = n_out
+        self.n_sample = n_sample
+        self.mixing_matrix = mixing_matrix
+        self.transition_matrix = transition_matrix
+        self.sigma_latent = sigma_latent
+        self.sigma_out = sigma_out
+        self.chunk_size = chunk_size
+        self.obs_noise = obs_noise
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.seed = seed
+        self.shape = (n_out, n_sample)
+        
+    def chunks(self):
+        """yields the data in chunks of (n_out x chunk_size)"""
+        rng = np.random.default_rng(self.seed)
+        for data, _ in simulate_data_chunks(self.n_latent, self.n_out, self.n_sample, self.mixing_matrix, self.transition_matrix,
+                                            self.sigma_latent, self.sigma_out, self.chunk_size, self.obs_noise, rng):
+            yield data
     
-    #draw samples from the latent var
-    latent_noise = np.random.normal(scale = sigma_latent, size = (n_latent, n_sample))
-    latent = np.zeros((n_latent, n_sample))
-    for ii in range(0, n_sample):
-        if ii > 0:
-            latent[:,ii] = transition_matrix @ latent[:,ii-1] + latent_noise[:,ii]
-        else:
-            latent[ii] = latent_noise[ii]
+simulated_dataset_version = 1 #bump whenever the generator below changes the data it produces, so stale caches are not reused
+
+def simulated_dataset(n_latent, n_in, n_out, n_sample, n_test, dt, seed, chunk_size = 100000):
+    """simulated_dataset: the mixing matrix and the train/test data used by the main script, generated from seed
+    and cached on disk (see il_data_cache). The arrays are memory-mapped read-only. Data and latents are stored
+    time-major, so the returned (n x T) arrays are transposed views whose columns are contiguous.
+    returns mixing_matrix, data_train, data_latent_train, data_test, data_latent_test"""
+    assert n_in == n_out, 'the mixing matrix maps the latents onto the n_out observed dimensions'
+    sigma_latent = 0.5 * np.sqrt(dt)
+    key = il_data_cache.dataset_key('simulate_data', simulated_dataset_version, n_latent = n_latent, n_in = n_in, n_out = n_out, n_sample = n_sample, n_test = n_test,
+                                    dt = dt, sigma_latent = sigma_latent, seed = seed, chunk_size = chunk_size)
     
-    #generate observation noise
-    obs_noise = np.random.normal(scale = sigma_out, size = (n_out, n_sample))
+    def build(create):
+        rng = np.random.default_rng(seed)
+        mixing_matrix = create('mixing_matrix', (n_in, n_latent))
+        mixing_matrix[...] = rng.normal(loc = 0, scale = 1/n_latent, size = (n_in, n_latent))
+        transition_matrix = (1 - sigma_latent**2) * np.eye(n_latent)
+        for name, n in (('train', n_sample), ('test', n_test)):
+            data = create('data_' + name, (n, n_out))
+            latent = create('latent_' + name, (n, n_latent))
+            start = 0
+            for data_chunk, latent_chunk in simulate_data_chunks(n_latent, n_out, n, mixing_matrix, transition_matrix, sigma_latent, chunk_size = chunk_size, rng = rng):
+                data[start:start + data_chunk.shape[1]] = data_chunk.T
+                latent[start:start + data_chunk.shape[1]] = latent_chunk.T
+                start += data_chunk.shape[1]
     
-    #produce observations from the latent variables and the noise
-    data = mixing_matrix @ latent #+ obs_noise
-    return data, latent
+    mixing_matrix, data_train, latent_train, data_test, latent_test = il_data_cache.load_dataset(key, ('mixing_matrix', 'data_train', 'latent_train', 'data_test', 'latent_test'), build)
+    return mixing_matrix, data_train.T, latent_train.T, data_test.T, latent_test.T
     
 def Vocal_Digits(n_sample, n_digits = 10, hpc = False, test = False):
-    """Function for data generated by vocalized digits (https://github.com/Jakobovski/free-spoken-digit-dataset)"""
+    """Function for data generated by vocalized digits (https://github.com/Jakobovski/free-spoken-digit-dataset)
+    The first call converts the pickled dataset into normalized train/test arrays for n_digits and caches them
+    on disk (see il_data_cache); every later call, for either split, is a read-only memory map of those arrays."""
     if (not(hpc)):
         path = 'spoken_digits_dataset'
     else:
         path = os.getcwd() + 'anonymous_filepath_2'
-    data = pickle.load(open(path, 'rb'))
-    if test:
-        X = data['test_set']
-        Y = data['test_labels']
-    else:
-        X = data['train_set']
-        Y = data['train_labels']
-        
-    digits = np.arange(0, n_digits)
-    digit_idx = np.where(np.isin(Y, digits))[1]
-    X = X[:,digit_idx]
-    Y = Y[:,digit_idx]
-    
-    X = (X + np.abs(np.min(X)))/np.std(X) #normalize inputs
+    split = 'test' if test else 'train'
+    X, Y = vocal_digits_dataset(path, n_digits)[split]
     return X, Y
 
+def vocal_digits_dataset(path, n_digits):
+    """vocal_digits_dataset: the train and test splits of the spoken digits in path, restricted to the digits
+    0, ..., n_digits - 1 (in their original order) and normalized. The pickle is only read if the converted
+    arrays are not cached yet. Inputs are stored time-major, so the (n_in x T) arrays are transposed views.
+    returns {'train': (X, Y), 'test': (X, Y)}"""
+    source = os.stat(path)
+    key = il_data_cache.dataset_key('Vocal_Digits', path = os.path.abspath(path), size = source.st_size, mtime = source.st_mtime_ns,
+                                    n_digits = n_digits)
+    
+    def build(create):
+        data = pickle.load(open(path, 'rb'))
+        digits = np.arange(0, n_digits)
+        for split in ('train', 'test'):
+            X = data[split + '_set']
+            Y = data[split + '_labels']
+            digit_idx = np.where(np.isin(Y, digits))[1]
+            X = X[:,digit_idx]
+            Y = Y[:,digit_idx]
+            X_stored = create(split + '_set', X.shape[::-1])
+            X_stored[...] = ((X + np.abs(np.min(X)))/np.std(X)).T #normalize inputs
+            Y_stored = create(split + '_labels', Y.shape, Y.dtype)
+            Y_stored[...] = Y
+    
+    X_train, Y_train, X_test, Y_test = il_data_cache.load_dataset(key, ('train_set', 'train_labels', 'test_set', 'test_labels'), build)
+    return {'train': (X_train.T, Y_train), 'test': (X_test.T, Y_test)}
+
 def set_learn_alg(network, learning_rate, switch_period):
     if exp_params.algorithm == 'wake_sleep':
         #learn_alg = WakeSleep(network, learning_rate, switch_period)
         learn_alg = LayeredImpression(network, learning_rate, switch_period)
     elif exp_params.algorithm == 'backprop':
-        learn_alg = Backpropagation(network, learning_rate)
+        learn_alg = Backpropagation(network, learning_rate, switch_period)
     elif exp_params.algorithm == 'reinforce':
         #learn_alg = LayeredREINFORCE(network, learning_rate)
         learn_alg = LayeredAlternatingREINFORCE(network, learning_rate, switch_period, decay = 0.9)
@@ -76,44 +206,74 @@ class Function:
         f_prime (function): The element-wise derivative of f with respect to
             the first argument, must also act on 1-d numpy arrays of arbitrary
             dimension.
+        Both accept an optional out argument, which the fused layers use to
+            write into preallocated buffers.
+        f_and_fprime (function): Returns (f(z), f_prime(z)), accepting optional
+            out and out_prime arguments. Functions whose derivative can be
+            written in terms of f (e.g. tanh) pass a fused version that
+            evaluates f once; otherwise it calls f and f_prime in turn.
     """
     
-    def __init__(self, f, f_prime):
+    def __init__(self, f, f_prime, f_and_fprime = None):
         """Inits an instance of Function by specifying f and f_prime."""
         
         self.f = f
         self.f_prime = f_prime
+        if not(f_and_fprime is None):
+            self.f_and_fprime = f_and_fprime
+            
+    def f_and_fprime(self, z, out = None, out_prime = None):
+        return self.f(z, out = out), self.f_prime(z, out = out_prime)
+        
+def write_out(result, out = None):
+    """copies result into out (if given), so that functions without an in-place form still accept out"""
+    if out is None:
+        return result
+    out[...] = result
+    return out
         
-def tanh_(z):
+def tanh_(z, out = None):
 
-    return np.tanh(z)
+    return np.tanh(z, out = out)
+
+def tanh_derivative(z, out = None):
+    
+    if out is None:
+        return 1 - np.tanh(z)**2
+    np.tanh(z, out = out)
+    np.square(out, out = out)
+    return np.subtract(1, out, out = out)
 
-def tanh_derivative(z):
+def tanh_and_derivative(z, out = None, out_prime = None):
     
-    return 1 - np.tanh(z)**2
+    f = np.tanh(z, out = out)
+    if out_prime is None:
+        return f, 1 - f**2
+    np.square(f, out = out_prime)
+    return f, np.subtract(1, out_prime, out = out_prime)
 
-tanh = Function(tanh_, tanh_derivative)
+tanh = Function(tanh_, tanh_derivative, tanh_and_derivative)
 
 right_slope = 1
 left_slope = 0
-def relu_(h):
+def relu_(h, out = None):
 
-    return np.maximum(0, right_slope * h) - np.maximum(0, left_slope * (-h))
+    return write_out(np.maximum(0, right_slope * h) - np.maximum(0, left_slope * (-h)), out)
 
-def relu_derivative(h):
+def relu_derivative(h, out = None):
 
-    return (h > 0) * (right_slope - left_slope) + left_slope
+    return write_out((h > 0) * (right_slope - left_slope) + left_slope, out)
 
 relu = Function(relu_,
                 relu_derivative)
 
-def sigmoid_(z):
+def sigmoid_(z, out = None):
 
-    return 1 / (1 + np.exp(-z))
+    return write_out(1 / (1 + np.exp(-z)), out)
 
-def sigmoid_derivative(z):
+def sigmoid_derivative(z, out = None):
 
-    return sigmoid_(z) * (1 - sigmoid_(z))
+    return write_out(sigmoid_(z) * (1 - sigmoid_(z)), out)
 
 sigmoid = Function(sigmoid_,
                    sigmoid_derivative)
@@ -132,6 +292,235 @@ def unnormalized_similarity(mat_1, mat_2):
     
     return np.dot(vec_1, vec_2)
 
+#define noise providers, which draw the network noise in large blocks rather than one small vector per call
+class NoisePool():
+    """Supplies Gaussian noise of a fixed shape from a block of pre-drawn standard normals.
+    shape: shape of a single draw
+    scale: standard deviation applied to each draw
+    rng: numpy Generator used to (re)fill the block
+    block_size: number of draws held in the block"""
+    def __init__(self, shape, scale, rng, block_size = 1024):
+        self.shape = tuple(shape)
+        self.scale = scale
+        self.rng = rng
+        self.block = np.empty((block_size,) + self.shape)
+        self.cursor = block_size #the block is filled on the first draw
+        
+    def refill(self):
+        """overwrite the block in place with new standard normals"""
+        self.rng.standard_normal(out = self.block)
+        self.cursor = 0
+        
+    def draw(self, out = None):
+        """returns the next draw, scaled by the noise standard deviation (written into out if given)"""
+        if self.cursor == self.block.shape[0]:
+            self.refill()
+        sample = np.multiply(self.block[self.cursor], self.scale, out = out)
+        self.cursor += 1
+        return sample
+    
+    def skip(self):
+        """discards the next draw, keeping the stream aligned when a draw is not needed"""
+        if self.cursor == self.block.shape[0]:
+            self.refill()
+        self.cursor += 1
+        
+    def take(self, n):
+        """returns the next n draws at once (n x shape), the same values n calls to draw would return"""
+        samples = np.empty((n,) + self.shape)
+        filled = 0
+        while filled < n:
+            if self.cursor == self.block.shape[0]:
+                self.refill()
+            m = min(n - filled, self.block.shape[0] - self.cursor)
+            np.multiply(self.block[self.cursor:self.cursor + m], self.scale, out = samples[filled:filled + m])
+            self.cursor += m
+            filled += m
+        return samples
+    
+class NoiseProvider():
+    """Hands out independent NoisePools seeded from a single per-run seed. Pools are spawned in a
+    fixed order (layer by layer, generative then recognition), so a given seed reproduces a run exactly."""
+    def __init__(self, seed, block_size = 1024):
+        self.seed = seed
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.block_size = block_size
+        
+    def pool(self, shape, scale):
+        rng = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+        return NoisePool(shape, scale, rng, self.block_size)
+
+def noise_seed(seed):
+    """returns the seed to give a Simulation (or SNREstimator.run) for a run that should be reproducible from seed.
+    With exp_params.pooled_noise, that is seed itself, and the run draws its noise from NoiseProvider pools.
+    Otherwise the global np.random state is seeded, as the original scripts did, and None is returned"""
+    if exp_params.pooled_noise:
+        return seed
+    np.random.seed(seed)
+    return None
+
+#define factored (rank-1) parameter updates
+class Rank1Update():
+    """A parameter update u v^T kept in factored form, so that it can be added to a weight matrix in place
+    with a BLAS ger call instead of materialising the outer product.
+    u: vector over the rows of the parameter
+    v: vector over the columns of the parameter"""
+    def __init__(self, u, v):
+        self.u = u
+        self.v = v
+        
+    def dense(self):
+        """returns the update as a full matrix"""
+        return np.outer(self.u, self.v)
+    
+    def apply(self, param, alpha):
+        """param += alpha * u v^T, in place"""
+        if param.dtype == np.float64 and param.flags.c_contiguous and param.flags.writeable:
+            #a C-ordered matrix is the Fortran-ordered transpose, so v u^T is added to param.T. dger updates param.T in
+            #place when it can; should f2py have worked on a copy instead, the result is written back
+            updated = blas.dger(alpha, self.v, self.u, a = param.T, overwrite_a = 1)
+            if not(np.shares_memory(updated, param)):
+                param.T[...] = updated
+        else:
+            param += alpha * np.outer(self.u, self.v)
+            
+def apply_update(param, update, alpha):
+    """adds alpha * update to param in place. Scalar zero updates (phases without an update) are skipped"""
+    if isinstance(update, Rank1Update):
+        update.apply(param, alpha)
+    elif isinstance(update, np.ndarray) and update.ndim > 0:
+        param += alpha * update
+    elif update != 0:
+        param += alpha * update
+
+#define a flat parameter arena
+def arena_size(layer_list):
+    """returns the number of entries needed to hold every trainable parameter of the layers"""
+    return int(sum([np.size(param) for layer in layer_list for param in layer.params_list_rec + layer.params_list_gen]))
+
+class ParameterArena():
+    """Holds every trainable parameter of a network in one contiguous float64 vector, flat: the recognition parameters
+    (params_list_rec of each layer in turn) followed by the generative ones. The params lists, and the named layer
+    attributes (W_in, W_out, bias, bias_gen, transition_mat), are views into flat, so that copying, snapshotting or
+    sharing the parameters is a single array operation.
+    rec, gen: the recognition (flat[:n_rec]) and generative parts of flat"""
+    def __init__(self, layer_list, buffer = None):
+        """buffer: a float64 vector of arena_size(layer_list) entries to place the parameters in, e.g. an np.ndarray
+        over a multiprocessing.shared_memory block. A new vector is allocated if None"""
+        #one (layer index, params list, index in the list, attribute name, offset, shape) per parameter
+        self.layout = []
+        self.n_layers = len(layer_list)
+        offset = 0
+        for list_name in ('params_list_rec', 'params_list_gen'):
+            if list_name == 'params_list_gen':
+                self.n_rec = offset
+            for ii in range(0, len(layer_list)):
+                params_list = getattr(layer_list[ii], list_name)
+                for jj in range(0, len(params_list)):
+                    name = None
+                    for attr, value in vars(layer_list[ii]).items():
+                        if value is params_list[jj]:
+                            name = attr
+                    self.layout.append((ii, list_name, jj, name, offset, np.shape(params_list[jj])))
+                    offset += np.size(params_list[jj])
+        self.size = offset
+        if buffer is None:
+            buffer = np.zeros((self.size,))
+        for ii, list_name, jj, name, offset, shape in self.layout:
+            buffer[offset:offset + int(np.prod(shape))] = np.ravel(getattr(layer_list[ii], list_name)[jj])
+        self.bind(layer_list, buffer)
+        
+    def bind(self, layer_list, flat = None):
+        """points the parameters of layer_list at views into flat (default: the current buffer), without copying.
+        Used to restore the views after a copy of the network, or to run a network on a stored or shared vector"""
+        if not(flat is None):
+            self.flat = flat
+        self.rec = self.flat[:self.n_rec]
+        self.gen = self.flat[self.n_rec:]
+        for ii, list_name, jj, name, offset, shape in self.layout:
+            view = self.flat[offset:offset + int(np.prod(shape))].reshape(shape)
+            getattr(layer_list[ii], list_name)[jj] = view
+            if not(name is None):
+                setattr(layer_list[ii], name, view)
+                
+    def split(self, flat, list_name = 'params_list_rec'):
+        """returns the per-layer lists of views of a vector laid out like flat (or like rec, for the recognition
+        parameters), matching the layers' params lists"""
+        if list_name == 'params_list_rec':
+            start = 0
+        else:
+            start = self.n_rec
+        views = [[] for ii in range(0, self.n_layers)]
+        for ii, entry_list, jj, name, offset, shape in self.layout:
+            if entry_list == list_name:
+                views[ii].append(flat[offset - start:offset - start + int(np.prod(shape))].reshape(shape))
+        return views
+    
+    def gather(self, update_list, views):
+        """copies updates (one list per layer, as in the learning algorithms) into views, the split of a vector laid
+        out like rec or gen. Scalar zero updates are written as zeros"""
+        for ii in range(0, len(views)):
+            for jj in range(0, len(views[ii])):
+                update = update_list[ii][jj]
+                if isinstance(update, Rank1Update):
+                    np.outer(update.u, update.v, out = views[ii][jj])
+                else:
+                    np.copyto(views[ii][jj], update)
+    
+#define streaming moments of the parameter updates
+class MomentAccumulator():
+    """Running mean and sum of squared deviations from the mean (m2) of a stream of arrays of a fixed shape,
+    updated in place with Welford's algorithm. Accumulators over disjoint parts of a stream can be merged exactly,
+    so the statistics of a long stream may be computed in shards (e.g. on several cores) and recombined"""
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.delta = np.zeros(shape)
+        self.tmp = np.zeros(shape)
+        
+    def update(self, x):
+        """adds x (an array of the accumulator's shape, or a scalar) to the stream"""
+        self.n += 1
+        np.subtract(x, self.mean, out = self.delta)
+        np.divide(self.delta, self.n, out = self.tmp)
+        np.add(self.mean, self.tmp, out = self.mean)
+        np.subtract(x, self.mean, out = self.tmp)
+        np.multiply(self.delta, self.tmp, out = self.tmp)
+        np.add(self.m2, self.tmp, out = self.m2)
+        
+    def update_batch(self, X):
+        """adds the rows of X (n x the accumulator's shape) to the stream"""
+        mean = np.mean(X, axis = 0)
+        self.combine(X.shape[0], mean, np.sum(np.square(X - mean), axis = 0))
+        
+    def merge(self, other):
+        """combines the moments of other, accumulated over a disjoint part of the stream, into this accumulator"""
+        self.combine(other.n, other.mean, other.m2)
+        
+    def combine(self, n_other, mean_other, m2_other):
+        """adds the moments (count, mean and m2) of another part of the stream"""
+        if n_other == 0:
+            return
+        n = self.n + n_other
+        np.subtract(mean_other, self.mean, out = self.delta)
+        np.multiply(self.delta, n_other / n, out = self.tmp)
+        np.add(self.mean, self.tmp, out = self.mean)
+        np.square(self.delta, out = self.tmp)
+        np.multiply(self.tmp, self.n * n_other / n, out = self.tmp)
+        np.add(self.m2, m2_other, out = self.m2)
+        np.add(self.m2, self.tmp, out = self.m2)
+        self.n = n
+        
+    def variance(self):
+        """returns the (population) variance of the stream so far"""
+        return self.m2 / self.n
+    
+    def reset(self):
+        self.n = 0
+        self.mean.fill(0)
+        self.m2.fill(0)
+        
 #define a Layer class
 class Layer():
     """Parent class for all layers"""
@@ -152,6 +541,74 @@ class Layer():
         self.rec_switch = 0
         self.parent = None
         self.child = None
+        self.noise_pool_gen = None
+        self.noise_pool_rec = None
+        self.cache = {}
+        
+    def __getstate__(self):
+        """noise pools belong to a single run, and the step cache to a single step, so neither is copied nor pickled
+        with the layer"""
+        state = self.__dict__.copy()
+        state['noise_pool_gen'] = None
+        state['noise_pool_rec'] = None
+        state['cache'] = {}
+        return state
+    
+    def invalidate_cache(self):
+        """drops the intermediates (pre-activations, predictions, derivatives) that the forward pass cached for reuse
+        by grad_gen, grad_rec and e_trace_reinforce. Called at the start of every step and whenever the parameters
+        are assigned; code that changes the parameters in between must call it as well"""
+        self.cache = {}
+    
+    @property
+    def noise_shape(self):
+        return (self.N,)
+    
+    def set_noise(self, provider):
+        """draw the layer noise from a NoiseProvider, or from np.random if provider is None"""
+        if provider is None:
+            self.noise_pool_gen = None
+            self.noise_pool_rec = None
+        else:
+            self.noise_pool_gen = provider.pool(self.noise_shape, self.sigma_gen)
+            self.noise_pool_rec = provider.pool(self.noise_shape, self.sigma_rec)
+            
+    def draw_noise_gen(self, out = None):
+        if self.noise_pool_gen is None:
+            return write_out(np.random.normal(scale = self.sigma_gen, size = self.noise_shape), out)
+        return self.noise_pool_gen.draw(out)
+    
+    def draw_noise_rec(self, out = None):
+        if self.noise_pool_rec is None:
+            return write_out(np.random.normal(scale = self.sigma_rec, size = self.noise_shape), out)
+        return self.noise_pool_rec.draw(out)
+    
+    def skip_noise_gen(self):
+        """skips a generative noise draw. Draws from a NoisePool are discarded, so that seeded runs stay aligned;
+        draws from np.random are simply not made"""
+        if not(self.noise_pool_gen is None):
+            self.noise_pool_gen.skip()
+            
+    def skip_noise_rec(self):
+        """skips a recognition noise draw (see skip_noise_gen)"""
+        if not(self.noise_pool_rec is None):
+            self.noise_pool_rec.skip()
+            
+    def skip_generative(self):
+        """stands in for forward_generative in the wake phase, where the generative pass does not contribute to h"""
+        self.skip_noise_gen()
+        
+    def draw_noise_gen_sequence(self, n):
+        """draws the generative noise for n consecutive time steps (n x noise_shape)"""
+        if self.noise_pool_gen is None:
+            return np.random.normal(scale = self.sigma_gen, size = (n,) + self.noise_shape)
+        return self.noise_pool_gen.take(n)
+    
+    def draw_noise_rec_sequence(self, n):
+        """draws the recognition noise for n consecutive time steps (n x noise_shape)"""
+        if self.noise_pool_rec is None:
+            return np.random.normal(scale = self.sigma_rec, size = (n,) + self.noise_shape)
+        return self.noise_pool_rec.take(n)
         
     def link(self, parent = None, child = None):
         self.parent = parent
@@ -197,12 +654,14 @@ class Layer():
         
         return
     
-    def grad_gen(self):
-        """returns a list of updates for each generative parameter in the layer"""
+    def grad_gen(self, factored = False):
+        """returns a list of updates for each generative parameter in the layer.
+        If factored, weight matrix updates are returned as Rank1Update objects"""
         return []
     
-    def grad_rec(self):
-        """returns a list of updates for each recognition parameter in the layer"""
+    def grad_rec(self, factored = False):
+        """returns a list of updates for each recognition parameter in the layer.
+        If factored, weight matrix updates are returned as Rank1Update objects"""
         return []
     
     def e_trace_reinforce(self):
@@ -233,22 +692,72 @@ class InputLayer(Layer):
     
     def forward_generative(self):
         #generate observation noise
-        self.noise_gen = np.random.normal(scale = self.sigma_gen, size = (self.N,))
+        self.noise_gen = self.draw_noise_gen()
         #produce observations from the latent variables and the noise
         self.h_mean_gen = self.W_out @ self.parent.h_gen
         self.h_gen = self.h_mean_gen + self.noise_gen
         
     def forward_recognition(self, h_child):
+        self.invalidate_cache()
         self.h_child = h_child
-        self.noise_rec = np.random.normal(scale = self.sigma_rec, size = (self.N,))
+        self.noise_rec = self.draw_noise_rec()
         self.h_mean_rec = self.h_child
         self.h_rec = self.h_mean_rec + self.noise_rec #an input layer just copies its inputs
         
-    def forward(self):
+    def generative_sequence(self, H_parent):
+        """samples observations (samples x t x N) from the parent's generated activities (samples x t x N_parent)"""
+        n_samples, T = H_parent.shape[0:2]
+        noise = self.draw_noise_gen_sequence(n_samples * T).reshape((n_samples, T, self.N))
+        self.h_gen_seq = H_parent @ self.W_out.T + noise
+        return self.h_gen_seq
+    
+    def recognition_sequence(self, X):
+        """wake-phase recognition pass over a time-major block of inputs X (t x N). returns h_rec (t x N)"""
+        self.h_mean_rec_seq = X
+        self.h_rec_seq = X + self.draw_noise_rec_sequence(X.shape[0])
+        return self.h_rec_seq
+    
+    def wake_loss_sequence(self):
+        """layer_loss (t,) for the block passed to recognition_sequence, once the parent has processed it as well"""
+        h_pred_gen = self.parent.h_rec_seq @ self.W_out.T
+        self.h[...] = self.h_rec_seq[-1]
+        return np.sum((self.h_rec_seq - h_pred_gen)**2, axis = 1)/self.sigma_gen**2 - np.sum((self.h_rec_seq - self.h_mean_rec_seq)**2, axis = 1)/self.sigma_rec**2
+        
+    def skip_recognition(self, h_child):
+        """stands in for forward_recognition in the sleep phase: only the input itself enters the sleep loss"""
+        self.invalidate_cache()
+        self.h_child = h_child
+        self.h_mean_rec = self.h_child
+        self.skip_noise_rec()
+        
+    def forward_wake(self, compute_loss = True):
+        """forward for delta = 1, computing only the terms that the wake-phase loss does not multiply by zero"""
+        self.h_prev = self.h
+        self.h = self.h_rec
+        if not(compute_loss):
+            return
+        self.h_pred_gen = self.W_out @ self.parent.h_rec
+        self.cache['pre_pred_gen'] = self.h_pred_gen
+        self.h_pred_rec = self.h_child
+        self.layer_loss = np.sum((self.h - self.h_pred_gen)**2)/self.sigma_gen**2 - np.sum((self.h - self.h_mean_rec)**2/self.sigma_rec**2)
+        
+    def forward_sleep(self, compute_loss = True):
+        """forward for delta = 0, computing only the terms that the sleep-phase loss does not multiply by zero"""
+        self.h_prev = self.h
+        self.h = self.h_gen
+        if not(compute_loss):
+            return
+        self.h_pred_rec = self.h_child
+        self.layer_loss = np.sum((self.h - self.h_pred_rec)**2)/self.sigma_rec**2 - np.sum((self.h - self.h_mean_gen)**2)/self.sigma_gen**2
+        
+    def forward(self, compute_loss = True):
         self.h_prev = self.h
         self.h = self.delta * self.h_rec + (1-self.delta) * self.h_gen
+        if not(compute_loss):
+            return
 
         self.h_pred_gen = self.W_out @ self.parent.h_rec
+        self.cache['pre_pred_gen'] = self.h_pred_gen
         self.h_pred_rec = self.h_child
         #self.layer_loss = np.sum((self.h - self.h_pred)**2)/self.sigma_gen**2
         self.layer_loss = self.delta *(np.sum((self.h - self.h_pred_gen)**2)/self.sigma_gen**2 - np.sum((self.h - self.h_mean_rec)**2/self.sigma_rec**2)) + \
@@ -261,15 +770,21 @@ class InputLayer(Layer):
         self.h_rec = np.zeros((self.N,))
         self.h = np.zeros((self.N,))
     
-    def grad_gen(self):
+    def grad_gen(self, factored = False):
         g_hat = self.parent.h_rec
-        G = (self.h_child - self.W_out @ g_hat)
-        W_out_update = np.outer(G, g_hat)
+        h_pred = self.cache.get('pre_pred_gen')
+        if h_pred is None:
+            h_pred = self.W_out @ g_hat
+        G = (self.h_child - h_pred)
+        if factored:
+            W_out_update = Rank1Update(G, g_hat)
+        else:
+            W_out_update = np.outer(G, g_hat)
             
         self.generative_update_list = [W_out_update]
         return self.generative_update_list
     
-    def grad_rec(self):
+    def grad_rec(self, factored = False):
         return []
     
     def e_trace_reinforce(self):
@@ -286,12 +801,18 @@ class InputLayer(Layer):
 #define a feedforward Layer
 class FeedforwardLayer(Layer):
     """defines a feedforward layer for the Helmholtz Machine"""
-    def __init__(self, N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, W_out = None, W_in = None, bias = False, top_layer = False):
+    def __init__(self, N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, W_out = None, W_in = None, bias = False, top_layer = False, diagonal_transition = True):
+        """diagonal_transition: store the top-layer transition matrix as the vector of its diagonal, which is
+        applied and updated elementwise. Set to False for a full N x N transition matrix"""
         super().__init__(N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec)
         self.top_layer = top_layer
+        self.diagonal_transition = diagonal_transition
         if self.top_layer:
             self.W_out = None #if the feedforward layer is at the top of the hierarchy, do not give it a top-down projection
-            self.transition_mat = 0.6 * np.eye(N)
+            if self.diagonal_transition:
+                self.transition_mat = 0.6 * np.ones((N,))
+            else:
+                self.transition_mat = 0.6 * np.eye(N)
             self.params_list_gen = [self.transition_mat]
         else:
             if not(W_out is None):
@@ -315,32 +836,134 @@ class FeedforwardLayer(Layer):
         else:
             self.biased = False
     
+    def transition(self, h, out = None):
+        """applies the top-layer dynamics to h: elementwise for a diagonal transition, a matvec otherwise"""
+        if self.diagonal_transition:
+            return np.multiply(self.transition_mat, h, out = out)
+        return np.matmul(self.transition_mat, h, out = out)
+        
     def forward_generative(self):
         if not(self.parent is None):
             self.h_mean_gen = self.nl.f(self.W_out @ self.parent.h_gen + self.bias_gen)
         else:
-            self.h_mean_gen = self.transition_mat @ self.h
-        self.noise_gen = np.random.normal(scale = self.sigma_gen, size = (self.N,))
+            self.h_mean_gen = self.transition(self.h)
+        self.noise_gen = self.draw_noise_gen()
         self.h_gen = self.h_mean_gen + self.noise_gen
         
     def forward_recognition(self):
+        self.invalidate_cache()
         self.h_pre_rec = self.W_in @ self.child.h_rec + self.bias
         self.h_mean_rec = self.nl.f(self.h_pre_rec)
-        self.noise_rec = np.random.normal(scale = self.sigma_rec, size = (self.N,))
+        self.noise_rec = self.draw_noise_rec()
         self.h_rec = self.h_mean_rec + self.noise_rec
         
-    def forward(self):
-        self.h_prev = self.h
-        self.h = self.delta * self.h_rec + (1-self.delta) * self.h_gen
+    def generative_sequence(self, H_parent, T = None, n_samples = 1):
+        """samples activities (samples x t x N) from the parent's generated activities (samples x t x N_parent). The top
+        layer has no parent and instead runs its linear dynamics for T steps from a zero state: a linear filter along
+        time for a diagonal transition, a batched recursion otherwise"""
+        if not(H_parent is None):
+            n_samples, T = H_parent.shape[0:2]
+        noise = self.draw_noise_gen_sequence(n_samples * T).reshape((n_samples, T, self.N))
+        if not(H_parent is None):
+            self.h_gen_seq = self.nl.f(H_parent @ self.W_out.T + self.bias_gen) + noise
+        elif self.diagonal_transition:
+            self.h_gen_seq = np.swapaxes(ar1_filter(np.swapaxes(noise, 1, 2), self.transition_mat, 0.), 1, 2)
+        else:
+            self.h_gen_seq = noise
+            for tt in range(1, T):
+                self.h_gen_seq[:, tt] += self.h_gen_seq[:, tt - 1] @ self.transition_mat.T
+        return self.h_gen_seq
+    
+    def recognition_sequence(self, H_child):
+        """wake-phase recognition pass over a time-major block of child activities (t x N_child). returns h_rec (t x N)"""
+        self.h_mean_rec_seq = self.nl.f(H_child @ self.W_in.T + self.bias)
+        self.h_rec_seq = self.h_mean_rec_seq + self.draw_noise_rec_sequence(H_child.shape[0])
+        return self.h_rec_seq
+    
+    def wake_loss_sequence(self):
+        """layer_loss (t,) for the block passed to recognition_sequence, once the parent has processed it as well.
+        Carries h across blocks, since the top-layer prediction depends on the previous state"""
+        H = self.h_rec_seq
+        if self.rec_switch == 1 or self.parent is None:
+            H_prev = np.concatenate((self.h[None], H[:-1]), axis = 0)
+        if self.rec_switch == 1:
+            h_pred_gen = H_prev
+        elif not(self.parent is None):
+            h_pred_gen = self.nl.f(self.parent.h_rec_seq @ self.W_out.T + self.bias_gen)
+        elif self.diagonal_transition:
+            h_pred_gen = H_prev * self.transition_mat
+        else:
+            h_pred_gen = H_prev @ self.transition_mat.T
+        self.h[...] = H[-1]
+        return np.sum((H - h_pred_gen)**2, axis = 1)/(self.sigma_gen**2) - np.sum((H - self.h_mean_rec_seq)**2, axis = 1)/(self.sigma_rec**2)
+        
+    def skip_recognition(self):
+        """stands in for forward_recognition in the sleep phase, where the recognition pass does not contribute to h"""
+        self.invalidate_cache()
+        self.skip_noise_rec()
+        
+    def cache_recognition(self):
+        """in the wake phase child.h is child.h_rec, so the recognition pass has already formed the pre-activation
+        (and prediction) that grad_rec needs"""
+        if self.child.phase == 'wake':
+            self.cache['pre_grad_rec'] = self.h_pre_rec
+            self.cache['pred_grad_rec'] = self.h_mean_rec
+            
+    def predict_gen(self):
+        """sets h_pred_gen, the generative prediction of h in the loss, caching it and its pre-activation for grad_gen"""
         if self.rec_switch == 1:
             self.h_pred_gen = self.h_prev
+            return
+        if not(self.parent is None):
+            h_pre_pred = self.W_out @ self.parent.h_rec + self.bias_gen
+            self.h_pred_gen = self.nl.f(h_pre_pred)
+            self.cache['pre_pred_gen'] = h_pre_pred
         else:
-            if not(self.parent is None):
-                self.h_pred_gen = self.nl.f(self.W_out @ self.parent.h_rec + self.bias_gen)
-            else:
-                self.h_pred_gen = self.transition_mat @ self.h_prev
+            self.h_pred_gen = self.transition(self.h_prev)
+        self.cache['pred_gen'] = self.h_pred_gen
+        
+    def predict_rec(self):
+        """sets h_pred_rec, the recognition prediction of h from child.h_gen. In the sleep phase child.h is child.h_gen,
+        so the products are cached for grad_rec"""
+        h_pre_pred = self.W_in @ self.child.h_gen + self.bias
+        self.h_pred_rec = self.nl.f(h_pre_pred)
+        if self.child.phase in ('sleep', 'deep_sleep'):
+            self.cache['pre_grad_rec'] = h_pre_pred
+            self.cache['pred_grad_rec'] = self.h_pred_rec
             
-        self.h_pred_rec = self.nl.f(self.W_in @ self.child.h_gen + self.bias)
+    def fprime_rec(self):
+        """f'(h_pre_rec), computed once per step and shared by e_trace_reinforce and (in the wake phase) grad_rec"""
+        if not('fprime_rec' in self.cache):
+            self.cache['fprime_rec'] = self.nl.f_prime(self.h_pre_rec)
+        return self.cache['fprime_rec']
+        
+    def forward_wake(self, compute_loss = True):
+        """forward for delta = 1, computing only the terms that the wake-phase loss does not multiply by zero"""
+        self.h_prev = self.h
+        self.h = self.h_rec
+        self.cache_recognition()
+        if not(compute_loss):
+            return
+        self.predict_gen()
+        self.layer_loss = np.sum((self.h - self.h_pred_gen)**2)/(self.sigma_gen**2) - np.sum((self.h - self.h_mean_rec)**2)/(self.sigma_rec**2)
+        
+    def forward_sleep(self, compute_loss = True):
+        """forward for delta = 0, computing only the terms that the sleep-phase loss does not multiply by zero"""
+        self.h_prev = self.h
+        self.h = self.h_gen
+        if not(compute_loss):
+            return
+        self.predict_rec()
+        self.layer_loss = np.sum((self.h - self.h_pred_rec)**2)/(self.sigma_rec**2) - np.sum((self.h - self.h_mean_gen)**2)/(self.sigma_gen**2)
+        
+    def forward(self, compute_loss = True):
+        self.h_prev = self.h
+        self.h = self.delta * self.h_rec + (1-self.delta) * self.h_gen
+        self.cache_recognition()
+        if not(compute_loss):
+            return
+        self.predict_gen()
+        self.predict_rec()
             
         #self.layer_loss = np.sum((self.h - self.h_pred)**2)/self.sigma_gen**2
         self.layer_loss = self.delta *(np.sum((self.h - self.h_pred_gen)**2)/(self.sigma_gen**2) - np.sum((self.h - self.h_mean_rec)**2)/(self.sigma_rec**2)) + \
@@ -354,7 +977,7 @@ class FeedforwardLayer(Layer):
         self.h_rec = np.zeros((self.N,))
         self.h = np.zeros((self.N,))
         
-    def grad_gen(self):
+    def grad_gen(self, factored = False):
         #update the generative transition matrix
         if self.rec_switch == 1: #if a recurrent switch has just occurred, there are no updates to the generative parameters
             if self.biased:
@@ -363,27 +986,51 @@ class FeedforwardLayer(Layer):
                 self.generative_update_list = [0]
         else:
             if (self.top_layer):
-                E = (self.h - self.transition_mat @ self.h_prev)
-                transition_mat_update = np.diag(E * self.h_prev)
+                h_pred = self.cache.get('pred_gen')
+                if h_pred is None:
+                    h_pred = self.transition(self.h_prev)
+                E = (self.h - h_pred)
+                if self.diagonal_transition:
+                    transition_mat_update = E * self.h_prev
+                else:
+                    transition_mat_update = np.diag(E * self.h_prev)
                 self.generative_update_list = [transition_mat_update]
             else: #or update W_out if it's an intermediate layer
                 g_hat = self.parent.h_rec
-                h_pre_pred = self.W_out @ g_hat + self.bias_gen
-                h_pred = self.nl.f(h_pre_pred)
-                G = self.nl.f_prime(h_pre_pred) * (self.h_rec - h_pred)
-                W_out_update = np.outer(G, g_hat)
+                h_pre_pred = self.cache.get('pre_pred_gen')
+                h_pred = self.cache.get('pred_gen')
+                if h_pre_pred is None:
+                    h_pre_pred = self.W_out @ g_hat + self.bias_gen
+                if h_pred is None:
+                    h_pred, f_prime = self.nl.f_and_fprime(h_pre_pred)
+                else:
+                    f_prime = self.nl.f_prime(h_pre_pred)
+                G = f_prime * (self.h_rec - h_pred)
+                if factored:
+                    W_out_update = Rank1Update(G, g_hat)
+                else:
+                    W_out_update = np.outer(G, g_hat)
                 self.generative_update_list = [W_out_update]
                 if self.biased:
                     bias_update = G
                     self.generative_update_list.append(bias_update)
         return self.generative_update_list
     
-    def grad_rec(self):
+    def grad_rec(self, factored = False):
         a_hat = self.child.h
-        h_pre_pred = self.W_in @ a_hat + self.bias
-        h_pred = self.nl.f(h_pre_pred)
-        D = self.nl.f_prime(h_pre_pred) * (self.h - h_pred)
-        W_in_update = np.outer(D, a_hat)
+        h_pre_pred = self.cache.get('pre_grad_rec')
+        if h_pre_pred is None:
+            h_pre_pred = self.W_in @ a_hat + self.bias
+            h_pred, f_prime = self.nl.f_and_fprime(h_pre_pred)
+        elif h_pre_pred is self.h_pre_rec:
+            h_pred, f_prime = self.cache['pred_grad_rec'], self.fprime_rec()
+        else:
+            h_pred, f_prime = self.cache['pred_grad_rec'], self.nl.f_prime(h_pre_pred)
+        D = f_prime * (self.h - h_pred)
+        if factored:
+            W_in_update = Rank1Update(D, a_hat)
+        else:
+            W_in_update = np.outer(D, a_hat)
         if self.biased:
             bias_update = D
             self.recognition_update_list = [W_in_update, bias_update]
@@ -393,87 +1040,409 @@ class FeedforwardLayer(Layer):
         return self.recognition_update_list
     
     def e_trace_reinforce(self):
+        D = self.fprime_rec() * (self.h - self.h_mean_rec)
         if not(self.bias is None):
-            e_trace_W_in = np.outer(self.nl.f_prime(self.h_pre_rec) * (self.h - self.h_mean_rec), self.child.h)
-            e_trace_bias = self.nl.f_prime(self.h_pre_rec) * (self.h - self.h_mean_rec)
+            e_trace_W_in = np.outer(D, self.child.h)
+            e_trace_bias = D
             self.e_trace_update_list = [e_trace_W_in, e_trace_bias]
         else:
-            self.e_trace_update_list = [np.outer(self.nl.f_prime(self.h_pre_rec) * (self.h - self.h_mean_rec), self.child.h)]
+            self.e_trace_update_list = [np.outer(D, self.child.h)]
         return self.e_trace_update_list
 
-#define a layered Helmholtz Machine
-class LayeredHM():
-    def __init__(self, N_vec, sigma_gen_vec, sigma_rec_vec):
-        self.N_vec = N_vec
-        self.n_latent = np.sum(N_vec) #total # of neurons
-        self.sigma_gen_vec = sigma_gen_vec
-        self.sigma_rec_vec = sigma_rec_vec
+#define fused layers, which preallocate every per-step buffer and compute each step with in-place ufuncs
+def sum_squared_error(h, a, tmp):
+    """returns np.sum((h - a)**2), using tmp as scratch space. The sum is taken with np.add.reduce directly, which
+    gives the same result without the Python-level overhead of np.sum on small vectors"""
+    np.subtract(h, a, out = tmp)
+    np.square(tmp, out = tmp)
+    return np.add.reduce(tmp)
+
+class FusedInputLayer(InputLayer):
+    """An InputLayer whose step allocates no arrays. Results are identical to InputLayer, but the state
+    attributes are persistent buffers that are overwritten every step."""
+    def __init__(self, N, N_parent, nonlinearity, sigma_gen, sigma_rec, W_out = None):
+        super().__init__(N, N_parent, nonlinearity, sigma_gen, sigma_rec, W_out = W_out)
+        self.noise_gen = np.zeros((self.N,))
+        self.noise_rec = np.zeros((self.N,))
+        self.h_mean_gen = np.zeros((self.N,))
+        self.h_gen = np.zeros((self.N,))
+        self.h_rec = np.zeros((self.N,))
+        self.h = np.zeros((self.N,))
+        self.h_prev = np.zeros((self.N,))
+        self.h_pred_gen = np.zeros((self.N,))
+        self.h_child = np.zeros((self.N_child,))
+        self.tmp = np.zeros((self.N,))
+        self.G = np.zeros((self.N,))
+        self.W_out_update = np.zeros((self.N, self.N_parent))
+        self.W_out_factors = Rank1Update(self.G, None)
+        #stacked products (see forward_generative_stacked)
+        self.parent_stack = np.zeros((2, self.N_parent))
+        self.pre_gen_stack = np.zeros((2, self.N))
         
-        #construct the individual layers
-        self.l0 = InputLayer(N_vec[0], N_vec[1], nonlinearity, sigma_gen_vec[0], sigma_rec_vec[0])
-        self.l1 = FeedforwardLayer(N_vec[1], None, N_vec[0], nonlinearity, sigma_gen_vec[1], sigma_rec_vec[1], top_layer = True)
+    def forward_generative(self):
+        self.draw_noise_gen(out = self.noise_gen)
+        np.matmul(self.W_out, self.parent.h_gen, out = self.h_mean_gen)
+        np.add(self.h_mean_gen, self.noise_gen, out = self.h_gen)
         
-        #link together the individual layers
-        self.l0.link(parent = self.l1, child = None)
-        self.l1.link(parent = None, child = self.l0)
+    def forward_generative_stacked(self):
+        """forward_generative for the general path, once the recognition pass has run: W_out multiplies parent.h_gen
+        and parent.h_rec in a single GEMM, and the second product is cached for forward and grad_gen"""
+        self.parent_stack[0] = self.parent.h_gen
+        self.parent_stack[1] = self.parent.h_rec
+        np.matmul(self.parent_stack, self.W_out.T, out = self.pre_gen_stack)
+        self.cache['pre_pred_gen'] = self.pre_gen_stack[1]
+        self.draw_noise_gen(out = self.noise_gen)
+        np.copyto(self.h_mean_gen, self.pre_gen_stack[0])
+        np.add(self.h_mean_gen, self.noise_gen, out = self.h_gen)
         
-        self.layer_list = (self.l0, self.l1)
-        self.set_phase('wake')
+    def forward_recognition(self, h_child):
+        self.invalidate_cache()
+        self.h_child = h_child
+        self.draw_noise_rec(out = self.noise_rec)
+        self.h_mean_rec = self.h_child
+        np.add(self.h_mean_rec, self.noise_rec, out = self.h_rec)
+        
+    def predict_gen(self):
+        """sets h_pred_gen = W_out @ parent.h_rec (reusing the stacked product if there is one) and caches it for grad_gen"""
+        h_pred = self.cache.get('pre_pred_gen')
+        if h_pred is None:
+            np.matmul(self.W_out, self.parent.h_rec, out = self.h_pred_gen)
+        else:
+            np.copyto(self.h_pred_gen, h_pred)
+        self.cache['pre_pred_gen'] = self.h_pred_gen
+        
+    def forward_wake(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        np.copyto(self.h, self.h_rec)
+        if not(compute_loss):
+            return
+        self.predict_gen()
+        self.h_pred_rec = self.h_child
+        s_gen = sum_squared_error(self.h, self.h_pred_gen, self.tmp)/self.sigma_gen**2
+        np.subtract(self.h, self.h_mean_rec, out = self.tmp)
+        np.square(self.tmp, out = self.tmp)
+        np.divide(self.tmp, self.sigma_rec**2, out = self.tmp)
+        self.layer_loss = s_gen - np.add.reduce(self.tmp)
+        
+    def forward_sleep(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        np.copyto(self.h, self.h_gen)
+        if not(compute_loss):
+            return
+        self.h_pred_rec = self.h_child
+        s_pred_rec = sum_squared_error(self.h, self.h_pred_rec, self.tmp)/self.sigma_rec**2
+        s_mean_gen = sum_squared_error(self.h, self.h_mean_gen, self.tmp)/self.sigma_gen**2
+        self.layer_loss = s_pred_rec - s_mean_gen
+        
+    def forward(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        np.multiply(self.delta, self.h_rec, out = self.h)
+        np.multiply(1-self.delta, self.h_gen, out = self.tmp)
+        np.add(self.h, self.tmp, out = self.h)
+        if not(compute_loss):
+            return
+        
+        self.predict_gen()
+        self.h_pred_rec = self.h_child
+        s_gen = sum_squared_error(self.h, self.h_pred_gen, self.tmp)/self.sigma_gen**2
+        #as in InputLayer, this recognition term divides inside the sum
+        np.subtract(self.h, self.h_mean_rec, out = self.tmp)
+        np.square(self.tmp, out = self.tmp)
+        np.divide(self.tmp, self.sigma_rec**2, out = self.tmp)
+        s_rec = np.add.reduce(self.tmp)
+        s_pred_rec = sum_squared_error(self.h, self.h_pred_rec, self.tmp)/self.sigma_rec**2
+        s_mean_gen = sum_squared_error(self.h, self.h_mean_gen, self.tmp)/self.sigma_gen**2
+        self.layer_loss = self.delta *(s_gen - s_rec) + (1-self.delta)* (s_pred_rec - s_mean_gen)
         
-    def set_phase(self,phase):
-        for layer in self.layer_list:
-            layer.set_phase(phase)
-        self.phase = phase
-    
-    def toggle_phase(self):
-        for layer in self.layer_list:
-            layer.toggle_phase()
-        if self.phase == 'wake':
-            self.phase = 'sleep'
-        elif self.phase == 'sleep':
-            self.phase = 'wake'
-            self.rec_switch = 1 #variable indicates if a phase switch has just occurred
-    
-    def continue_phase(self):
-        for layer in self.layer_list:
-            layer.continue_phase()
-        self.rec_switch = 0
     def reset(self):
-        for layer in self.layer_list:
-            layer.reset()
+        self.noise_gen.fill(0)
+        self.h_mean_gen.fill(0)
+        self.h_gen.fill(0)
+        self.h_child = np.zeros((self.N_child,))
+        self.h_rec.fill(0)
+        self.h.fill(0)
+        
+    def grad_gen(self, factored = False):
+        g_hat = self.parent.h_rec
+        h_pred = self.cache.get('pre_pred_gen')
+        if h_pred is None:
+            h_pred = np.matmul(self.W_out, g_hat, out = self.G)
+        np.subtract(self.h_child, h_pred, out = self.G)
+        if factored:
+            self.W_out_factors.v = g_hat
+            self.generative_update_list = [self.W_out_factors]
+        else:
+            np.multiply(self.G[:, None], g_hat[None, :], out = self.W_out_update)
+            self.generative_update_list = [self.W_out_update]
+        return self.generative_update_list
+    
+class FusedFeedforwardLayer(FeedforwardLayer):
+    """A FeedforwardLayer whose step allocates no arrays. Results are identical to FeedforwardLayer, but the
+    state attributes and returned updates are persistent buffers that are overwritten every step."""
+    def __init__(self, N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, W_out = None, W_in = None, bias = False, top_layer = False, diagonal_transition = True):
+        super().__init__(N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, W_out = W_out, W_in = W_in, bias = bias, top_layer = top_layer, diagonal_transition = diagonal_transition)
+        self.noise_gen = np.zeros((self.N,))
+        self.noise_rec = np.zeros((self.N,))
+        self.h_mean_gen = np.zeros((self.N,))
+        self.h_gen = np.zeros((self.N,))
+        self.h_pre_rec = np.zeros((self.N,))
+        self.h_mean_rec = np.zeros((self.N,))
+        self.h_rec = np.zeros((self.N,))
+        self.h = np.zeros((self.N,))
+        self.h_prev = np.zeros((self.N,))
+        self.h_pred_gen = np.zeros((self.N,))
+        self.h_pred_rec = np.zeros((self.N,))
+        self.h_child = np.zeros((self.N_child,))
+        self.tmp = np.zeros((self.N,))
+        self.h_pre_pred = np.zeros((self.N,))
+        self.h_pred = np.zeros((self.N,))
+        self.D = np.zeros((self.N,))
+        self.G = np.zeros((self.N,))
+        self.W_in_update = np.zeros((self.N, self.N_child))
+        self.W_in_factors = Rank1Update(self.D, None)
+        self.W_out_factors = Rank1Update(self.G, None)
+        if self.top_layer:
+            if self.diagonal_transition:
+                self.transition_mat_update = np.zeros((self.N,))
+                self.transition_mat_update_diag = self.transition_mat_update
+            else:
+                self.transition_mat_update = np.zeros((self.N, self.N))
+                self.transition_mat_update_diag = np.einsum('ii->i', self.transition_mat_update) #writable view of the diagonal
+        else:
+            self.W_out_update = np.zeros((self.N, self.N_parent))
+        #stacked/reused products (see forward_generative_stacked and the predict_* methods)
+        if not(self.top_layer):
+            self.parent_stack = np.zeros((2, self.N_parent))
+        self.pre_gen_stack = np.zeros((2, self.N))
+        self.pre_pred_gen = np.zeros((self.N,))
+        self.pre_pred_rec = np.zeros((self.N,))
+        self.h_prime_rec = np.zeros((self.N,))
             
-    def forward(self, x):
-        #pass forward through the network for approximate inference
-        self.l0.forward_recognition(x)
-        self.l1.forward_recognition()
+    def forward_generative(self):
+        if not(self.parent is None):
+            np.matmul(self.W_out, self.parent.h_gen, out = self.tmp)
+            np.add(self.tmp, self.bias_gen, out = self.tmp)
+            self.nl.f(self.tmp, out = self.h_mean_gen)
+        else:
+            self.transition(self.h, out = self.h_mean_gen)
+        self.draw_noise_gen(out = self.noise_gen)
+        np.add(self.h_mean_gen, self.noise_gen, out = self.h_gen)
         
-        #pass backward through the network for stimulus generation
-        self.l1.forward_generative()
-        self.l0.forward_generative()
+    def forward_recognition(self):
+        self.invalidate_cache()
+        np.matmul(self.W_in, self.child.h_rec, out = self.h_pre_rec)
+        np.add(self.h_pre_rec, self.bias, out = self.h_pre_rec)
+        self.nl.f(self.h_pre_rec, out = self.h_mean_rec)
+        self.draw_noise_rec(out = self.noise_rec)
+        np.add(self.h_mean_rec, self.noise_rec, out = self.h_rec)
         
-        #based on the network phase, choose to set activities according to inference or generation
-        self.l0.forward()
-        self.l1.forward()
+    def forward_generative_stacked(self):
+        """forward_generative for the general path, once the recognition pass has run: W_out multiplies parent.h_gen
+        and parent.h_rec in a single GEMM, and the second product is cached for forward and grad_gen"""
+        if self.parent is None:
+            self.forward_generative()
+            return
+        self.parent_stack[0] = self.parent.h_gen
+        self.parent_stack[1] = self.parent.h_rec
+        np.matmul(self.parent_stack, self.W_out.T, out = self.pre_gen_stack)
+        np.add(self.pre_gen_stack, self.bias_gen, out = self.pre_gen_stack)
+        self.cache['pre_pred_gen'] = self.pre_gen_stack[1]
+        self.nl.f(self.pre_gen_stack[0], out = self.h_mean_gen)
+        self.draw_noise_gen(out = self.noise_gen)
+        np.add(self.h_mean_gen, self.noise_gen, out = self.h_gen)
+        
+    def predict_gen(self):
+        if self.rec_switch == 1:
+            np.copyto(self.h_pred_gen, self.h_prev)
+            return
+        if not(self.parent is None):
+            h_pre_pred = self.cache.get('pre_pred_gen')
+            if h_pre_pred is None:
+                h_pre_pred = np.matmul(self.W_out, self.parent.h_rec, out = self.pre_pred_gen)
+                np.add(h_pre_pred, self.bias_gen, out = h_pre_pred)
+                self.cache['pre_pred_gen'] = h_pre_pred
+            self.nl.f(h_pre_pred, out = self.h_pred_gen)
+        else:
+            self.transition(self.h_prev, out = self.h_pred_gen)
+        self.cache['pred_gen'] = self.h_pred_gen
+        
+    def predict_rec(self):
+        np.matmul(self.W_in, self.child.h_gen, out = self.pre_pred_rec)
+        np.add(self.pre_pred_rec, self.bias, out = self.pre_pred_rec)
+        self.nl.f(self.pre_pred_rec, out = self.h_pred_rec)
+        if self.child.phase in ('sleep', 'deep_sleep'):
+            self.cache['pre_grad_rec'] = self.pre_pred_rec
+            self.cache['pred_grad_rec'] = self.h_pred_rec
+            
+    def fprime_rec(self):
+        if not('fprime_rec' in self.cache):
+            self.cache['fprime_rec'] = self.nl.f_prime(self.h_pre_rec, out = self.h_prime_rec)
+        return self.cache['fprime_rec']
+        
+    def forward_wake(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        np.copyto(self.h, self.h_rec)
+        self.cache_recognition()
+        if not(compute_loss):
+            return
+        self.predict_gen()
+        s_pred_gen = sum_squared_error(self.h, self.h_pred_gen, self.tmp)/(self.sigma_gen**2)
+        s_mean_rec = sum_squared_error(self.h, self.h_mean_rec, self.tmp)/(self.sigma_rec**2)
+        self.layer_loss = s_pred_gen - s_mean_rec
         
-        self.loss_total = np.sum([layer.layer_loss for layer in self.layer_list])
+    def forward_sleep(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        np.copyto(self.h, self.h_gen)
+        if not(compute_loss):
+            return
+        self.predict_rec()
+        s_pred_rec = sum_squared_error(self.h, self.h_pred_rec, self.tmp)/(self.sigma_rec**2)
+        s_mean_gen = sum_squared_error(self.h, self.h_mean_gen, self.tmp)/(self.sigma_gen**2)
+        self.layer_loss = s_pred_rec - s_mean_gen
+        
+    def forward(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        np.multiply(self.delta, self.h_rec, out = self.h)
+        np.multiply(1-self.delta, self.h_gen, out = self.tmp)
+        np.add(self.h, self.tmp, out = self.h)
+        self.cache_recognition()
+        if not(compute_loss):
+            return
+        self.predict_gen()
+        self.predict_rec()
+        
+        s_pred_gen = sum_squared_error(self.h, self.h_pred_gen, self.tmp)/(self.sigma_gen**2)
+        s_mean_rec = sum_squared_error(self.h, self.h_mean_rec, self.tmp)/(self.sigma_rec**2)
+        s_pred_rec = sum_squared_error(self.h, self.h_pred_rec, self.tmp)/(self.sigma_rec**2)
+        s_mean_gen = sum_squared_error(self.h, self.h_mean_gen, self.tmp)/(self.sigma_gen**2)
+        self.layer_loss = self.delta *(s_pred_gen - s_mean_rec) + (1-self.delta)* (s_pred_rec - s_mean_gen)
+        
+    def reset(self):
+        self.noise_gen.fill(0)
+        self.h_mean_gen.fill(0)
+        self.h_gen.fill(0)
+        self.h_child.fill(0)
+        self.h_rec.fill(0)
+        self.h.fill(0)
+        
+    def grad_gen(self, factored = False):
+        if self.rec_switch == 1: #if a recurrent switch has just occurred, there are no updates to the generative parameters
+            if self.biased:
+                self.generative_update_list = [0,0]
+            else:
+                self.generative_update_list = [0]
+        else:
+            if (self.top_layer):
+                h_pred = self.cache.get('pred_gen')
+                if h_pred is None:
+                    h_pred = self.transition(self.h_prev, out = self.G)
+                np.subtract(self.h, h_pred, out = self.G)
+                np.multiply(self.G, self.h_prev, out = self.transition_mat_update_diag)
+                self.generative_update_list = [self.transition_mat_update]
+            else:
+                g_hat = self.parent.h_rec
+                h_pre_pred = self.cache.get('pre_pred_gen')
+                h_pred = self.cache.get('pred_gen')
+                if h_pre_pred is None:
+                    h_pre_pred = np.matmul(self.W_out, g_hat, out = self.h_pre_pred)
+                    np.add(h_pre_pred, self.bias_gen, out = h_pre_pred)
+                if h_pred is None:
+                    h_pred, f_prime = self.nl.f_and_fprime(h_pre_pred, out = self.h_pred, out_prime = self.tmp)
+                else:
+                    f_prime = self.nl.f_prime(h_pre_pred, out = self.tmp)
+                np.subtract(self.h_rec, h_pred, out = self.G)
+                np.multiply(f_prime, self.G, out = self.G)
+                if factored:
+                    self.W_out_factors.v = g_hat
+                    self.generative_update_list = [self.W_out_factors]
+                else:
+                    np.multiply(self.G[:, None], g_hat[None, :], out = self.W_out_update)
+                    self.generative_update_list = [self.W_out_update]
+                if self.biased:
+                    self.generative_update_list.append(self.G)
+        return self.generative_update_list
+    
+    def grad_rec(self, factored = False):
+        a_hat = self.child.h
+        h_pre_pred = self.cache.get('pre_grad_rec')
+        if h_pre_pred is None:
+            np.matmul(self.W_in, a_hat, out = self.h_pre_pred)
+            np.add(self.h_pre_pred, self.bias, out = self.h_pre_pred)
+            h_pred, f_prime = self.nl.f_and_fprime(self.h_pre_pred, out = self.h_pred, out_prime = self.tmp)
+        elif h_pre_pred is self.h_pre_rec:
+            h_pred, f_prime = self.cache['pred_grad_rec'], self.fprime_rec()
+        else:
+            h_pred, f_prime = self.cache['pred_grad_rec'], self.nl.f_prime(h_pre_pred, out = self.tmp)
+        np.subtract(self.h, h_pred, out = self.D)
+        np.multiply(f_prime, self.D, out = self.D)
+        if factored:
+            self.W_in_factors.v = a_hat
+            W_in_update = self.W_in_factors
+        else:
+            np.multiply(self.D[:, None], a_hat[None, :], out = self.W_in_update)
+            W_in_update = self.W_in_update
+        if self.biased:
+            self.recognition_update_list = [W_in_update, self.D]
+        else:
+            self.recognition_update_list = [W_in_update]
         
-class TwoLayeredHM():
-    def __init__(self, N_vec, sigma_gen_vec, sigma_rec_vec):
+        return self.recognition_update_list
+
+def layer_classes(fused = False):
+    """returns the (input, feedforward) layer classes used to build a network"""
+    if fused:
+        return FusedInputLayer, FusedFeedforwardLayer
+    return InputLayer, FeedforwardLayer
+
+#define a layered Helmholtz Machine
+class DeepHM():
+    """A layered Helmholtz Machine of any depth. N_vec = [N_0, N_1, ..., N_L] gives the input layer and the hidden
+    layers from the bottom up; the hidden layers below the top are biased and the top layer carries the transition
+    dynamics. The layers are also available as l0, l1, ..., lL."""
+    def __init__(self, N_vec, sigma_gen_vec, sigma_rec_vec, fused = False, diagonal_transition = True, stacked = False, arena = False):
+        """fused: build the layers from FusedInputLayer/FusedFeedforwardLayer, which give identical results
+        without allocating arrays at every time step
+        diagonal_transition: keep the top-layer dynamics as a diagonal (vector) transition; False for a full matrix
+        stacked: (fused only) in the general forward pass, multiply each weight matrix with both vectors it is applied
+        to in one (2 x N) GEMM, and reuse the products in grad_gen/grad_rec. Identical up to rounding.
+        arena: allocate the trainable parameters as views into one contiguous vector, self.arena (see ParameterArena)"""
         self.N_vec = N_vec
+        self.fused = fused
+        self.stacked = stacked and fused
         self.n_latent = np.sum(N_vec) #total # of neurons
+        self.n_hidden = int(np.sum(N_vec[1:])) #width of the recorded latent activities
         self.sigma_gen_vec = sigma_gen_vec
         self.sigma_rec_vec = sigma_rec_vec
         
         #construct the individual layers
-        self.l0 = InputLayer(N_vec[0], N_vec[1], nonlinearity, sigma_gen_vec[0], sigma_rec_vec[0])
-        self.l1 = FeedforwardLayer(N_vec[1], N_vec[2], N_vec[0], nonlinearity, sigma_gen_vec[1], sigma_rec_vec[1], bias = True, top_layer = False)
-        self.l2 = FeedforwardLayer(N_vec[2], None, N_vec[1], nonlinearity, sigma_gen_vec[2], sigma_rec_vec[2], bias = False, top_layer = True)
+        n_layers = len(N_vec)
+        input_layer, feedforward_layer = layer_classes(fused)
+        layers = [input_layer(N_vec[0], N_vec[1], nonlinearity, sigma_gen_vec[0], sigma_rec_vec[0])]
+        for ii in range(1, n_layers):
+            if ii < n_layers - 1:
+                layers.append(feedforward_layer(N_vec[ii], N_vec[ii+1], N_vec[ii-1], nonlinearity, sigma_gen_vec[ii], sigma_rec_vec[ii], bias = True, top_layer = False))
+            else:
+                layers.append(feedforward_layer(N_vec[ii], None, N_vec[ii-1], nonlinearity, sigma_gen_vec[ii], sigma_rec_vec[ii], bias = False, top_layer = True, diagonal_transition = diagonal_transition))
+        
         #link together the individual layers
-        self.l0.link(parent = self.l1, child = None)
-        self.l1.link(parent = self.l2, child = self.l0)
-        self.l2.link(parent = None, child = self.l1)
-        self.layer_list = (self.l0, self.l1, self.l2)
+        for ii in range(0, n_layers):
+            parent = layers[ii+1] if ii < n_layers - 1 else None
+            child = layers[ii-1] if ii > 0 else None
+            layers[ii].link(parent = parent, child = child)
+        for ii in range(0, n_layers):
+            setattr(self, 'l' + str(ii), layers[ii])
+        
+        self.layer_list = tuple(layers)
+        self.arena = ParameterArena(self.layer_list) if arena else None
         self.set_phase('wake')
+        self.phase_kernels = False
+        
+    def __setstate__(self, state):
+        #a copy (deepcopy, pickle) restores the arena and the layer parameters as separate arrays, so the layers are
+        #pointed back at the restored arena
+        self.__dict__.update(state)
+        if not(self.__dict__.get('arena') is None):
+            self.arena.bind(self.layer_list)
         
     def set_phase(self,phase):
         for layer in self.layer_list:
@@ -494,47 +1463,888 @@ class TwoLayeredHM():
             layer.continue_phase()
         self.rec_switch = 0
         
+    def set_noise(self, provider):
+        """draw all network noise from a NoiseProvider (None reverts to np.random)"""
+        for layer in self.layer_list:
+            layer.set_noise(provider)
+        
+    def forward_sequence(self, X):
+        """wake-phase pass over a time-major block of inputs X (t x N_0) for a network with frozen parameters.
+        Recognition is feedforward, so each layer processes the whole block with one matmul.
+        returns the hidden activities (t x sum(N_vec[1:])) and loss_total (t,)"""
+        H = X
+        for layer in self.layer_list:
+            H = layer.recognition_sequence(H)
+        loss = 0.
+        for layer in self.layer_list:
+            loss = loss + layer.wake_loss_sequence()
+        return np.concatenate([layer.h_rec_seq for layer in self.layer_list[1::]], axis = 1), loss
+        
+    def sample(self, T, n_samples = 1):
+        """draws n_samples independent sequences of length T from the generative model, without data, starting from
+        a zero state (as a deep_sleep Simulation does after reset).
+        returns latent (n_samples x sum(N_vec[1:]) x T), the hidden activities a deep_sleep Simulation records,
+        and observations (n_samples x N_vec[0] x T)"""
+        H = self.layer_list[-1].generative_sequence(None, T, n_samples)
+        for layer in self.layer_list[-2::-1]:
+            H = layer.generative_sequence(H)
+        latent = np.concatenate([layer.h_gen_seq for layer in self.layer_list[1::]], axis = 2)
+        return np.swapaxes(latent, 1, 2), np.swapaxes(self.l0.h_gen_seq, 1, 2)
+        
     def reset(self):
         for layer in self.layer_list:
             layer.reset()
             
-    def forward(self, x):
+    def set_phase_kernels(self, enabled):
+        """enabled: in the wake and sleep phases, run only the pass (and noise draws) that sets h and the half of the
+        loss that is not multiplied by zero. The skipped activities (h_gen in wake, h_rec in sleep) go stale, so this
+        is only valid when the learning rule does not read them (see needs_both_passes)"""
+        self.phase_kernels = enabled
+        
+    def forward_wake(self, x, compute_loss = True):
+        self.l0.forward_recognition(x)
+        for layer in self.layer_list[1::]:
+            layer.forward_recognition()
+        for layer in self.layer_list:
+            layer.skip_generative()
+        for layer in self.layer_list:
+            layer.forward_wake(compute_loss)
+            
+    def forward_sleep(self, x, compute_loss = True):
+        self.l0.skip_recognition(x)
+        for layer in self.layer_list[1::]:
+            layer.skip_recognition()
+        for layer in self.layer_list[::-1]:
+            layer.forward_generative()
+        for layer in self.layer_list:
+            layer.forward_sleep(compute_loss)
+            
+    def forward(self, x, compute_loss = True):
+        """compute_loss: if False, the layer losses and loss_total are not updated this step, nor are the predictions
+        (h_pred_gen, h_pred_rec) that only enter the loss"""
+        if self.phase_kernels and self.phase == 'wake':
+            self.forward_wake(x, compute_loss)
+        elif self.phase_kernels and self.phase in ('sleep', 'deep_sleep'):
+            self.forward_sleep(x, compute_loss)
+        else:
+            self.forward_general(x, compute_loss)
+        if not(compute_loss):
+            return
+        
+        if self.fused:
+            loss_total = 0.
+            for layer in self.layer_list:
+                loss_total = loss_total + layer.layer_loss
+            self.loss_total = loss_total
+        else:
+            self.loss_total = np.sum([layer.layer_loss for layer in self.layer_list])
+            
+    def forward_general(self, x, compute_loss = True):
         #pass forward through the network for approximate inference
         self.l0.forward_recognition(x)
-        self.l1.forward_recognition()
-        self.l2.forward_recognition()
+        for layer in self.layer_list[1::]:
+            layer.forward_recognition()
+        if self.stacked:
+            self.forward_stacked(compute_loss)
+            return
+        
         #pass backward through the network for stimulus generation
-        self.l2.forward_generative()
-        self.l1.forward_generative()
-        self.l0.forward_generative()
+        for layer in self.layer_list[::-1]:
+            layer.forward_generative()
         
         #based on the network phase, choose to set activities according to inference or generation
-        self.l0.forward()
-        self.l1.forward()
-        self.l2.forward()
+        for layer in self.layer_list:
+            layer.forward(compute_loss)
+        
+    def forward_stacked(self, compute_loss = True):
+        #generative pass of forward_general with the products sharing a weight matrix stacked; forward picks the
+        #second product up from the layer cache
+        self.layer_list[-1].forward_generative()
+        for layer in self.layer_list[-2::-1]:
+            layer.forward_generative_stacked()
+        for layer in self.layer_list:
+            layer.forward(compute_loss)
+            
+class LayeredHM(DeepHM):
+    """a DeepHM with a single hidden layer, N_vec = [N_0, N_1]"""
+    def __init__(self, N_vec, sigma_gen_vec, sigma_rec_vec, fused = False, diagonal_transition = True, stacked = False, arena = False):
+        """fused, diagonal_transition, stacked, arena: see DeepHM"""
+        super().__init__(N_vec[:2], sigma_gen_vec[:2], sigma_rec_vec[:2], fused = fused, diagonal_transition = diagonal_transition, stacked = stacked, arena = arena)
         
-        self.loss_total = np.sum([layer.layer_loss for layer in self.layer_list])
+class TwoLayeredHM(DeepHM):
+    """a DeepHM with two hidden layers, N_vec = [N_0, N_1, N_2]"""
+    def __init__(self, N_vec, sigma_gen_vec, sigma_rec_vec, fused = False, diagonal_transition = True, stacked = False, arena = False):
+        """fused, diagonal_transition, stacked, arena: see DeepHM"""
+        super().__init__(N_vec[:3], sigma_gen_vec[:3], sigma_rec_vec[:3], fused = fused, diagonal_transition = diagonal_transition, stacked = stacked, arena = arena)
    
-class LayeredLearningAlgorithm():
+#define ensemble layers, which carry a leading member axis so that K independent networks run in lockstep
+def batched_matvec(W, x):
+    """multiplies a stack of matrices W (K x N x M) with a stack of vectors x (K x M)"""
+    return np.matmul(W, x[..., None])[..., 0]
+
+def batched_outer(u, v):
+    """returns the stack of outer products of u (K x N) and v (K x M)"""
+    return u[:, :, None] * v[:, None, :]
+
+def matvec(W, x, out = None):
+    """W @ x for a matrix and a vector, or for stacks of them (K x N x M and K x M)"""
+    if np.ndim(x) == 1:
+        return np.matmul(W, x, out = out)
+    if out is None:
+        return batched_matvec(W, x)
+    np.matmul(W, x[..., None], out = out[..., None])
+    return out
+
+def vecmat(u, W, out = None):
+    """u @ W (W^T u) for a vector and a matrix, or for stacks of them (K x N and K x N x M)"""
+    if np.ndim(u) == 1:
+        return np.matmul(u, W, out = out)
+    if out is None:
+        return np.matmul(u[:, None, :], W)[:, 0, :]
+    np.matmul(u[:, None, :], W, out = out[:, None, :])
+    return out
+
+def outer(u, v, out = None):
+    """u v^T for two vectors, or for stacks of them (K x N and K x M)"""
+    if np.ndim(u) == 1:
+        return np.outer(u, v, out = out)
+    return np.multiply(u[:, :, None], v[:, None, :], out = out)
+
+def member_axes(scale, ndim):
+    """reshapes a per-member scale (K or K x 1) to broadcast against an array with a leading member axis and ndim
+    dimensions. Scalars, for a single network, are returned as they are"""
+    if np.ndim(scale) == 0:
+        return scale
+    return np.reshape(scale, (-1,) + (1,)*(ndim - 1))
+
+def member_scale(scale, arr):
+    """multiplies each member of arr (leading axis K) by the corresponding entry of scale (length K)"""
+    return np.reshape(scale, (-1,) + (1,)*(np.ndim(arr) - 1)) * arr
+
+def ensemble_param(param, K):
+    """gives every member of the ensemble its own copy of an initial parameter"""
+    return np.array(np.broadcast_to(param, (K,) + np.shape(param)))
+
+class EnsembleLayer():
+    """Mixin giving a layer a member axis: every state is K x N and every phase variable is per member"""
+    @property
+    def noise_shape(self):
+        return (self.K, self.N)
     
-    def __init__(self, network, learning_rate):
-        self.nn = network
-        self.update_list_rec = []
-        self.update_list_gen = []
-        self.learning_stats = {'mean_update': [], 'moment_2': []}
-        self.mean = []
-        self.variance = []
-        self.snr = []
-        self.N_prev = 0
+    def set_phase(self, phase):
+        """sets the phase (wake or sleep) for every member of the ensemble"""
+        self.phases = np.full((self.K,), phase, dtype = '<U10')
+        self.update_phase()
         
-        for ii in range(0, len(self.nn.layer_list)):
+    def update_phase(self):
+        """recompute delta (K x 1) and the summary phase from the per-member phases"""
+        self.delta = (self.phases == 'wake').astype(float)[:, None]
+        if (self.phases == self.phases[0]).all():
+            self.phase = self.phases[0]
+        else:
+            self.phase = 'mixed'
+        
+    def toggle_phase(self, members = None):
+        """toggles the phase of the selected members (all members by default)"""
+        if members is None:
+            members = np.ones((self.K,), dtype = bool)
+        to_sleep = members & (self.phases == 'wake')
+        to_wake = members & (self.phases == 'sleep')
+        self.phases[to_sleep] = 'sleep'
+        self.phases[to_wake] = 'wake'
+        self.rec_switch[to_wake] = 1 #indication that a switch to the recognition state has occurred
+        self.update_phase()
+        
+    def continue_phase(self, members = None):
+        """remove the markers indicating phase switches for the selected members"""
+        if members is None:
+            self.rec_switch[:] = 0
+        else:
+            self.rec_switch[members] = 0
+            
+    def redraw_mixed_phase(self):
+        """randomly assigns each neuron of each member to 'sleep' or 'wake'"""
+        self.phase = 'mixed'
+        self.delta = np.random.binomial(1,0.5, size = (self.K, self.N))
+        
+    def reset(self):
+        self.noise_gen = np.zeros((self.K, self.N))
+        self.h_mean_gen = np.zeros((self.K, self.N))
+        self.h_gen = np.zeros((self.K, self.N))
+        self.h_child = np.zeros((self.K, self.N_child))
+        self.h_rec = np.zeros((self.K, self.N))
+        self.h = np.zeros((self.K, self.N))
+        
+class EnsembleInputLayer(EnsembleLayer, InputLayer):
+    """an InputLayer for K networks at once. W_out is K x N x N_parent"""
+    def __init__(self, N, N_parent, nonlinearity, sigma_gen, sigma_rec, K, W_out = None):
+        self.K = K
+        self.rec_switch = np.zeros((K,), dtype = int)
+        if W_out is None:
+            W_out = np.random.normal(loc = 0, scale = 1/N_parent, size = (K, N, N_parent))
+        elif np.ndim(W_out) == 2:
+            W_out = ensemble_param(W_out, K)
+        super().__init__(N, N_parent, nonlinearity, sigma_gen, sigma_rec, W_out = W_out)
+        self.rec_switch = np.zeros((K,), dtype = int)
+        
+    def forward_generative(self):
+        self.noise_gen = self.draw_noise_gen()
+        self.h_mean_gen = batched_matvec(self.W_out, self.parent.h_gen)
+        self.h_gen = self.h_mean_gen + self.noise_gen
+        
+    def forward_recognition(self, h_child):
+        #the input may be shared by all members (N,) or given per member (K x N)
+        self.invalidate_cache()
+        self.h_child = np.broadcast_to(h_child, (self.K, self.N))
+        self.noise_rec = self.draw_noise_rec()
+        self.h_mean_rec = self.h_child
+        self.h_rec = self.h_mean_rec + self.noise_rec
+        
+    def forward(self, compute_loss = True):
+        self.h_prev = self.h
+        self.h = self.delta * self.h_rec + (1-self.delta) * self.h_gen
+        if not(compute_loss):
+            return
+        self.h_pred_gen = batched_matvec(self.W_out, self.parent.h_rec)
+        self.cache['pre_pred_gen'] = self.h_pred_gen
+        self.h_pred_rec = self.h_child
+        self.layer_loss = np.sum(self.delta *((self.h - self.h_pred_gen)**2/self.sigma_gen**2 - (self.h - self.h_mean_rec)**2/self.sigma_rec**2) + \
+                        (1-self.delta)* ((self.h - self.h_pred_rec)**2/self.sigma_rec**2 - (self.h - self.h_mean_gen)**2/self.sigma_gen**2), axis = -1)
+        
+    def grad_gen(self, factored = False):
+        #ensemble updates are always dense stacks, one matrix per member
+        g_hat = self.parent.h_rec
+        h_pred = self.cache.get('pre_pred_gen')
+        if h_pred is None:
+            h_pred = batched_matvec(self.W_out, g_hat)
+        G = (self.h_child - h_pred)
+        self.generative_update_list = [batched_outer(G, g_hat)]
+        return self.generative_update_list
+    
+class EnsembleFeedforwardLayer(EnsembleLayer, FeedforwardLayer):
+    """a FeedforwardLayer for K networks at once. Every parameter carries a leading member axis"""
+    def __init__(self, N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, K, W_out = None, W_in = None, bias = False, top_layer = False, diagonal_transition = True):
+        self.K = K
+        self.rec_switch = np.zeros((K,), dtype = int)
+        if W_in is None:
+            W_in = np.random.normal(loc = 0, scale = 1/N_child, size = (K, N, N_child))
+        elif np.ndim(W_in) == 2:
+            W_in = ensemble_param(W_in, K)
+        if not(top_layer):
+            if W_out is None:
+                W_out = np.random.normal(loc = 0, scale = 1/N_parent, size = (K, N, N_parent))
+            elif np.ndim(W_out) == 2:
+                W_out = ensemble_param(W_out, K)
+        super().__init__(N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, W_out = W_out, W_in = W_in, bias = bias, top_layer = top_layer, diagonal_transition = diagonal_transition)
+        self.rec_switch = np.zeros((K,), dtype = int)
+        
+        #rebuild the remaining parameters with a member axis
+        self.bias = np.zeros((K, N))
+        self.bias_gen = np.zeros((K, N))
+        if self.top_layer:
+            self.transition_mat = ensemble_param(self.transition_mat, K)
+            self.params_list_gen = [self.transition_mat]
+        else:
+            self.params_list_gen = [self.W_out]
+        self.params_list_rec = [self.W_in]
+        if self.biased:
+            self.params_list_rec.append(self.bias)
+            if not(top_layer):
+                self.params_list_gen.append(self.bias_gen)
+    
+    def transition(self, h, out = None):
+        if self.diagonal_transition:
+            return np.multiply(self.transition_mat, h, out = out)
+        return write_out(batched_matvec(self.transition_mat, h), out)
+    
+    def forward_generative(self):
+        if not(self.parent is None):
+            self.h_mean_gen = self.nl.f(batched_matvec(self.W_out, self.parent.h_gen) + self.bias_gen)
+        else:
+            self.h_mean_gen = self.transition(self.h)
+        self.noise_gen = self.draw_noise_gen()
+        self.h_gen = self.h_mean_gen + self.noise_gen
+        
+    def forward_recognition(self):
+        self.invalidate_cache()
+        self.h_pre_rec = batched_matvec(self.W_in, self.child.h_rec) + self.bias
+        self.h_mean_rec = self.nl.f(self.h_pre_rec)
+        self.noise_rec = self.draw_noise_rec()
+        self.h_rec = self.h_mean_rec + self.noise_rec
+        
+    def forward(self, compute_loss = True):
+        self.h_prev = self.h
+        self.h = self.delta * self.h_rec + (1-self.delta) * self.h_gen
+        if not(compute_loss):
+            return
+        if not(self.parent is None):
+            h_pre_pred_gen = batched_matvec(self.W_out, self.parent.h_rec) + self.bias_gen
+            h_pred_gen = self.nl.f(h_pre_pred_gen)
+            self.cache['pre_pred_gen'] = h_pre_pred_gen
+        else:
+            h_pred_gen = self.transition(self.h_prev)
+        self.cache['pred_gen'] = h_pred_gen
+        #members that have just switched back to the wake phase predict their previous state
+        self.h_pred_gen = np.where(self.rec_switch[:, None] == 1, self.h_prev, h_pred_gen)
+        h_pre_pred_rec = batched_matvec(self.W_in, self.child.h_gen) + self.bias
+        self.h_pred_rec = self.nl.f(h_pre_pred_rec)
+        if self.child.delta.shape[-1] == 1:
+            #child.h is child.h_rec for members that are awake and child.h_gen for those that are asleep
+            awake = (self.child.delta == 1)
+            self.cache['pre_grad_rec'] = np.where(awake, self.h_pre_rec, h_pre_pred_rec)
+            self.cache['pred_grad_rec'] = np.where(awake, self.h_mean_rec, self.h_pred_rec)
+        
+        self.layer_loss = np.sum(self.delta *((self.h - self.h_pred_gen)**2/(self.sigma_gen**2) - (self.h - self.h_mean_rec)**2/(self.sigma_rec**2)) + \
+                        (1-self.delta)* ((self.h - self.h_pred_rec)**2/(self.sigma_rec**2) - (self.h - self.h_mean_gen)**2/(self.sigma_gen**2)), axis = -1)
+        
+    def grad_gen(self, factored = False):
+        #ensemble updates are always dense stacks, one matrix per member
+        #members for which a recurrent switch has just occurred receive no generative update
+        no_switch = (self.rec_switch == 0).astype(float)
+        if (self.top_layer):
+            h_pred = self.cache.get('pred_gen')
+            if h_pred is None:
+                h_pred = self.transition(self.h_prev)
+            E = (self.h - h_pred)
+            if self.diagonal_transition:
+                transition_mat_update = member_scale(no_switch, E * self.h_prev)
+            else:
+                transition_mat_update = np.zeros((self.K, self.N, self.N))
+                diag = np.arange(0, self.N)
+                transition_mat_update[:, diag, diag] = member_scale(no_switch, E * self.h_prev)
+            self.generative_update_list = [transition_mat_update]
+        else:
+            g_hat = self.parent.h_rec
+            h_pre_pred = self.cache.get('pre_pred_gen')
+            if h_pre_pred is None:
+                h_pre_pred = batched_matvec(self.W_out, g_hat) + self.bias_gen
+                h_pred, f_prime = self.nl.f_and_fprime(h_pre_pred)
+            else:
+                h_pred, f_prime = self.cache['pred_gen'], self.nl.f_prime(h_pre_pred)
+            G = member_scale(no_switch, f_prime * (self.h_rec - h_pred))
+            self.generative_update_list = [batched_outer(G, g_hat)]
+            if self.biased:
+                self.generative_update_list.append(G)
+        return self.generative_update_list
+    
+    def grad_rec(self, factored = False):
+        a_hat = self.child.h
+        h_pre_pred = self.cache.get('pre_grad_rec')
+        if h_pre_pred is None:
+            h_pre_pred = batched_matvec(self.W_in, a_hat) + self.bias
+            h_pred, f_prime = self.nl.f_and_fprime(h_pre_pred)
+        else:
+            h_pred, f_prime = self.cache['pred_grad_rec'], self.nl.f_prime(h_pre_pred)
+        D = f_prime * (self.h - h_pred)
+        self.recognition_update_list = [batched_outer(D, a_hat)]
+        if self.biased:
+            self.recognition_update_list.append(D)
+        return self.recognition_update_list
+    
+    def e_trace_reinforce(self):
+        D = self.fprime_rec() * (self.h - self.h_mean_rec)
+        self.e_trace_update_list = [batched_outer(D, self.child.h)]
+        if self.biased:
+            self.e_trace_update_list.append(D)
+        return self.e_trace_update_list
+
+class FusedEnsembleInputLayer(EnsembleInputLayer):
+    """An EnsembleInputLayer whose step allocates no K x N arrays. Results are identical to EnsembleInputLayer, but
+    the state attributes and returned updates are persistent buffers that are overwritten every step."""
+    def __init__(self, N, N_parent, nonlinearity, sigma_gen, sigma_rec, K, W_out = None):
+        super().__init__(N, N_parent, nonlinearity, sigma_gen, sigma_rec, K, W_out = W_out)
+        self.noise_gen = np.zeros((K, self.N))
+        self.noise_rec = np.zeros((K, self.N))
+        self.h_mean_gen = np.zeros((K, self.N))
+        self.h_gen = np.zeros((K, self.N))
+        self.h_rec = np.zeros((K, self.N))
+        self.h = np.zeros((K, self.N))
+        self.h_prev = np.zeros((K, self.N))
+        self.h_pred_gen = np.zeros((K, self.N))
+        self.tmp = np.zeros((K, self.N))
+        self.tmp_rec = np.zeros((K, self.N))
+        self.tmp_gen = np.zeros((K, self.N))
+        self.layer_loss = np.zeros((K,))
+        self.h_child = np.zeros((K, self.N))
+        self.G = np.zeros((K, self.N))
+        self.W_out_update = np.zeros((K, self.N, self.N_parent))
+        
+    def forward_generative(self):
+        self.draw_noise_gen(out = self.noise_gen)
+        np.matmul(self.W_out, self.parent.h_gen[..., None], out = self.h_mean_gen[..., None])
+        np.add(self.h_mean_gen, self.noise_gen, out = self.h_gen)
+        
+    def forward_recognition(self, h_child):
+        #the input may be shared by all members (N,) or given per member (K x N)
+        self.invalidate_cache()
+        np.copyto(self.h_child, h_child)
+        self.draw_noise_rec(out = self.noise_rec)
+        self.h_mean_rec = self.h_child
+        np.add(self.h_mean_rec, self.noise_rec, out = self.h_rec)
+        
+    def forward(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        #when every member is in the same phase, only that phase's terms are evaluated (as in FusedInputLayer's
+        #forward_wake/forward_sleep); the other terms are multiplied by zero in EnsembleInputLayer
+        if self.phase == 'wake':
+            np.copyto(self.h, self.h_rec)
+        elif self.phase in ('sleep', 'deep_sleep'):
+            np.copyto(self.h, self.h_gen)
+        else:
+            np.multiply(self.delta, self.h_rec, out = self.h)
+            np.multiply(1-self.delta, self.h_gen, out = self.tmp)
+            np.add(self.h, self.tmp, out = self.h)
+        if not(compute_loss):
+            return
+        self.h_pred_rec = self.h_child
+        if self.phase in ('sleep', 'deep_sleep'):
+            self.sleep_terms(self.tmp)
+            np.add.reduce(self.tmp, axis = -1, out = self.layer_loss)
+            return
+        np.matmul(self.W_out, self.parent.h_rec[..., None], out = self.h_pred_gen[..., None])
+        self.cache['pre_pred_gen'] = self.h_pred_gen
+        if self.phase == 'wake':
+            self.wake_terms(self.tmp)
+        else:
+            self.wake_terms(self.tmp)
+            np.multiply(self.delta, self.tmp, out = self.tmp)
+            self.sleep_terms(self.tmp_rec)
+            np.multiply(1-self.delta, self.tmp_rec, out = self.tmp_rec)
+            np.add(self.tmp, self.tmp_rec, out = self.tmp)
+        np.add.reduce(self.tmp, axis = -1, out = self.layer_loss)
+        
+    def wake_terms(self, out):
+        """out = (h - h_pred_gen)**2/sigma_gen**2 - (h - h_mean_rec)**2/sigma_rec**2, as in EnsembleInputLayer"""
+        np.subtract(self.h, self.h_pred_gen, out = out)
+        np.square(out, out = out)
+        np.divide(out, self.sigma_gen**2, out = out)
+        np.subtract(self.h, self.h_mean_rec, out = self.tmp_gen)
+        np.square(self.tmp_gen, out = self.tmp_gen)
+        np.divide(self.tmp_gen, self.sigma_rec**2, out = self.tmp_gen)
+        np.subtract(out, self.tmp_gen, out = out)
+        
+    def sleep_terms(self, out):
+        """out = (h - h_pred_rec)**2/sigma_rec**2 - (h - h_mean_gen)**2/sigma_gen**2, as in EnsembleInputLayer"""
+        np.subtract(self.h, self.h_pred_rec, out = out)
+        np.square(out, out = out)
+        np.divide(out, self.sigma_rec**2, out = out)
+        np.subtract(self.h, self.h_mean_gen, out = self.tmp_gen)
+        np.square(self.tmp_gen, out = self.tmp_gen)
+        np.divide(self.tmp_gen, self.sigma_gen**2, out = self.tmp_gen)
+        np.subtract(out, self.tmp_gen, out = out)
+        
+    def reset(self):
+        self.noise_gen.fill(0)
+        self.h_mean_gen.fill(0)
+        self.h_gen.fill(0)
+        self.h_child.fill(0)
+        self.h_rec.fill(0)
+        self.h.fill(0)
+        
+    def grad_gen(self, factored = False):
+        g_hat = self.parent.h_rec
+        h_pred = self.cache.get('pre_pred_gen')
+        if h_pred is None:
+            h_pred = np.matmul(self.W_out, g_hat[..., None], out = self.G[..., None])[..., 0]
+        np.subtract(self.h_child, h_pred, out = self.G)
+        np.multiply(self.G[:, :, None], g_hat[:, None, :], out = self.W_out_update)
+        self.generative_update_list = [self.W_out_update]
+        return self.generative_update_list
+    
+class FusedEnsembleFeedforwardLayer(EnsembleFeedforwardLayer):
+    """An EnsembleFeedforwardLayer whose step allocates no K x N arrays. Results are identical to
+    EnsembleFeedforwardLayer, but the state attributes and returned updates are persistent buffers that are
+    overwritten every step."""
+    def __init__(self, N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, K, W_out = None, W_in = None, bias = False, top_layer = False, diagonal_transition = True):
+        super().__init__(N, N_parent, N_child, nonlinearity, sigma_gen, sigma_rec, K, W_out = W_out, W_in = W_in, bias = bias, top_layer = top_layer, diagonal_transition = diagonal_transition)
+        self.noise_gen = np.zeros((K, self.N))
+        self.noise_rec = np.zeros((K, self.N))
+        self.h_mean_gen = np.zeros((K, self.N))
+        self.h_gen = np.zeros((K, self.N))
+        self.h_pre_rec = np.zeros((K, self.N))
+        self.h_mean_rec = np.zeros((K, self.N))
+        self.h_rec = np.zeros((K, self.N))
+        self.h = np.zeros((K, self.N))
+        self.h_prev = np.zeros((K, self.N))
+        self.h_pred_gen = np.zeros((K, self.N))
+        self.h_pred_rec = np.zeros((K, self.N))
+        self.tmp = np.zeros((K, self.N))
+        self.tmp_rec = np.zeros((K, self.N))
+        self.tmp_gen = np.zeros((K, self.N))
+        self.layer_loss = np.zeros((K,))
+        self.pre_pred_gen = np.zeros((K, self.N))
+        self.pred_gen = np.zeros((K, self.N))
+        self.pre_pred_rec = np.zeros((K, self.N))
+        self.pre_grad_rec = np.zeros((K, self.N))
+        self.pred_grad_rec = np.zeros((K, self.N))
+        self.h_prime = np.zeros((K, self.N))
+        self.D = np.zeros((K, self.N))
+        self.G = np.zeros((K, self.N))
+        self.W_in_update = np.zeros((K, self.N, self.N_child))
+        if self.top_layer:
+            if self.diagonal_transition:
+                self.transition_mat_update = np.zeros((K, self.N))
+                self.transition_mat_update_diag = self.transition_mat_update
+            else:
+                self.transition_mat_update = np.zeros((K, self.N, self.N))
+                self.transition_mat_update_diag = np.einsum('kii->ki', self.transition_mat_update) #writable view of the diagonals
+        else:
+            self.W_out_update = np.zeros((K, self.N, self.N_parent))
+            
+    def forward_generative(self):
+        if not(self.parent is None):
+            np.matmul(self.W_out, self.parent.h_gen[..., None], out = self.tmp[..., None])
+            np.add(self.tmp, self.bias_gen, out = self.tmp)
+            self.nl.f(self.tmp, out = self.h_mean_gen)
+        else:
+            self.transition(self.h, out = self.h_mean_gen)
+        self.draw_noise_gen(out = self.noise_gen)
+        np.add(self.h_mean_gen, self.noise_gen, out = self.h_gen)
+        
+    def forward_recognition(self):
+        self.invalidate_cache()
+        np.matmul(self.W_in, self.child.h_rec[..., None], out = self.h_pre_rec[..., None])
+        np.add(self.h_pre_rec, self.bias, out = self.h_pre_rec)
+        self.nl.f(self.h_pre_rec, out = self.h_mean_rec)
+        self.draw_noise_rec(out = self.noise_rec)
+        np.add(self.h_mean_rec, self.noise_rec, out = self.h_rec)
+        
+    def forward(self, compute_loss = True):
+        self.h_prev, self.h = self.h, self.h_prev
+        #when every member is in the same phase, only that phase's terms are evaluated (as in FusedFeedforwardLayer's
+        #forward_wake/forward_sleep); the other terms are multiplied by zero in EnsembleFeedforwardLayer
+        if self.phase == 'wake':
+            np.copyto(self.h, self.h_rec)
+        elif self.phase in ('sleep', 'deep_sleep'):
+            np.copyto(self.h, self.h_gen)
+        else:
+            np.multiply(self.delta, self.h_rec, out = self.h)
+            np.multiply(1-self.delta, self.h_gen, out = self.tmp)
+            np.add(self.h, self.tmp, out = self.h)
+        if not(compute_loss):
+            return
+        if self.phase == 'wake':
+            self.predict_gen()
+            self.wake_terms(self.tmp)
+        elif self.phase in ('sleep', 'deep_sleep'):
+            self.predict_rec()
+            self.sleep_terms(self.tmp)
+        else:
+            self.predict_gen()
+            self.predict_rec()
+            self.wake_terms(self.tmp)
+            np.multiply(self.delta, self.tmp, out = self.tmp)
+            self.sleep_terms(self.tmp_rec)
+            np.multiply(1-self.delta, self.tmp_rec, out = self.tmp_rec)
+            np.add(self.tmp, self.tmp_rec, out = self.tmp)
+        np.add.reduce(self.tmp, axis = -1, out = self.layer_loss)
+        
+    def predict_gen(self):
+        """sets h_pred_gen, the generative prediction of h (the previous state for members that have just switched
+        back to the wake phase), and caches the unmasked prediction for grad_gen"""
+        if not(self.parent is None):
+            np.matmul(self.W_out, self.parent.h_rec[..., None], out = self.pre_pred_gen[..., None])
+            np.add(self.pre_pred_gen, self.bias_gen, out = self.pre_pred_gen)
+            self.nl.f(self.pre_pred_gen, out = self.pred_gen)
+            self.cache['pre_pred_gen'] = self.pre_pred_gen
+        else:
+            self.transition(self.h_prev, out = self.pred_gen)
+        self.cache['pred_gen'] = self.pred_gen
+        np.copyto(self.h_pred_gen, self.pred_gen)
+        if self.rec_switch.any():
+            np.copyto(self.h_pred_gen, self.h_prev, where = (self.rec_switch[:, None] == 1))
+            
+    def predict_rec(self):
+        """sets h_pred_rec, the recognition prediction of h from child.h_gen, and caches the pre-activation and
+        prediction that grad_rec needs for each member"""
+        np.matmul(self.W_in, self.child.h_gen[..., None], out = self.pre_pred_rec[..., None])
+        np.add(self.pre_pred_rec, self.bias, out = self.pre_pred_rec)
+        self.nl.f(self.pre_pred_rec, out = self.h_pred_rec)
+        if self.child.delta.shape[-1] == 1:
+            #child.h is child.h_rec for members that are awake and child.h_gen for those that are asleep
+            awake = (self.child.delta == 1)
+            np.copyto(self.pre_grad_rec, self.pre_pred_rec)
+            np.copyto(self.pre_grad_rec, self.h_pre_rec, where = awake)
+            np.copyto(self.pred_grad_rec, self.h_pred_rec)
+            np.copyto(self.pred_grad_rec, self.h_mean_rec, where = awake)
+            self.cache['pre_grad_rec'] = self.pre_grad_rec
+            self.cache['pred_grad_rec'] = self.pred_grad_rec
+            
+    def wake_terms(self, out):
+        """out = (h - h_pred_gen)**2/sigma_gen**2 - (h - h_mean_rec)**2/sigma_rec**2, as in EnsembleFeedforwardLayer"""
+        np.subtract(self.h, self.h_pred_gen, out = out)
+        np.square(out, out = out)
+        np.divide(out, self.sigma_gen**2, out = out)
+        np.subtract(self.h, self.h_mean_rec, out = self.tmp_gen)
+        np.square(self.tmp_gen, out = self.tmp_gen)
+        np.divide(self.tmp_gen, self.sigma_rec**2, out = self.tmp_gen)
+        np.subtract(out, self.tmp_gen, out = out)
+        
+    def sleep_terms(self, out):
+        """out = (h - h_pred_rec)**2/sigma_rec**2 - (h - h_mean_gen)**2/sigma_gen**2, as in EnsembleFeedforwardLayer"""
+        np.subtract(self.h, self.h_pred_rec, out = out)
+        np.square(out, out = out)
+        np.divide(out, self.sigma_rec**2, out = out)
+        np.subtract(self.h, self.h_mean_gen, out = self.tmp_gen)
+        np.square(self.tmp_gen, out = self.tmp_gen)
+        np.divide(self.tmp_gen, self.sigma_gen**2, out = self.tmp_gen)
+        np.subtract(out, self.tmp_gen, out = out)
+        
+    def reset(self):
+        self.noise_gen.fill(0)
+        self.h_mean_gen.fill(0)
+        self.h_gen.fill(0)
+        self.h_child = np.zeros((self.K, self.N_child))
+        self.h_rec.fill(0)
+        self.h.fill(0)
+        
+    def fprime_rec(self):
+        if not('fprime_rec' in self.cache):
+            self.cache['fprime_rec'] = self.nl.f_prime(self.h_pre_rec, out = self.h_prime)
+        return self.cache['fprime_rec']
+        
+    def grad_gen(self, factored = False):
+        #members for which a recurrent switch has just occurred receive no generative update
+        no_switch = (self.rec_switch == 0).astype(float)[:, None]
+        if (self.top_layer):
+            h_pred = self.cache.get('pred_gen')
+            if h_pred is None:
+                h_pred = self.transition(self.h_prev, out = self.G)
+            np.subtract(self.h, h_pred, out = self.G)
+            np.multiply(self.G, self.h_prev, out = self.transition_mat_update_diag)
+            np.multiply(no_switch, self.transition_mat_update_diag, out = self.transition_mat_update_diag)
+            self.generative_update_list = [self.transition_mat_update]
+        else:
+            g_hat = self.parent.h_rec
+            h_pre_pred = self.cache.get('pre_pred_gen')
+            if h_pre_pred is None:
+                h_pre_pred = np.matmul(self.W_out, g_hat[..., None], out = self.pre_pred_gen[..., None])[..., 0]
+                np.add(h_pre_pred, self.bias_gen, out = h_pre_pred)
+                h_pred, f_prime = self.nl.f_and_fprime(h_pre_pred, out = self.pred_gen, out_prime = self.h_prime)
+            else:
+                h_pred, f_prime = self.cache['pred_gen'], self.nl.f_prime(h_pre_pred, out = self.h_prime)
+            np.subtract(self.h_rec, h_pred, out = self.G)
+            np.multiply(f_prime, self.G, out = self.G)
+            np.multiply(no_switch, self.G, out = self.G)
+            np.multiply(self.G[:, :, None], g_hat[:, None, :], out = self.W_out_update)
+            self.generative_update_list = [self.W_out_update]
+            if self.biased:
+                self.generative_update_list.append(self.G)
+        return self.generative_update_list
+    
+    def grad_rec(self, factored = False):
+        a_hat = self.child.h
+        h_pre_pred = self.cache.get('pre_grad_rec')
+        if h_pre_pred is None:
+            h_pre_pred = np.matmul(self.W_in, a_hat[..., None], out = self.pre_grad_rec[..., None])[..., 0]
+            np.add(h_pre_pred, self.bias, out = h_pre_pred)
+            h_pred, f_prime = self.nl.f_and_fprime(h_pre_pred, out = self.pred_grad_rec, out_prime = self.h_prime)
+        else:
+            h_pred, f_prime = self.cache['pred_grad_rec'], self.nl.f_prime(h_pre_pred, out = self.h_prime)
+        np.subtract(self.h, h_pred, out = self.D)
+        np.multiply(f_prime, self.D, out = self.D)
+        np.multiply(self.D[:, :, None], a_hat[:, None, :], out = self.W_in_update)
+        self.recognition_update_list = [self.W_in_update]
+        if self.biased:
+            self.recognition_update_list.append(self.D)
+        return self.recognition_update_list
+    
+def ensemble_layer_classes(fused = False):
+    """returns the (input, feedforward) layer classes used to build an ensemble"""
+    if fused:
+        return FusedEnsembleInputLayer, FusedEnsembleFeedforwardLayer
+    return EnsembleInputLayer, EnsembleFeedforwardLayer
+
+class EnsembleLayeredHM():
+    """K independent layered Helmholtz Machines simulated in lockstep. Layer states are K x N and
+    parameters K x N x M, so that each time step is a handful of batched matrix products.
+    N_vec may have any length >= 2; intermediate layers are biased, as in DeepHM.
+    fused: build the layers from FusedEnsembleInputLayer/FusedEnsembleFeedforwardLayer, which give identical
+    results without allocating arrays at every time step. For the small networks of the SNR/lr_optim runs, the
+    per-step cost is almost all call overhead, so K replicas cost little more than one.
+    arena: see DeepHM
+    rng: np.random.Generator to draw the initial weights from (default: the global np.random state)"""
+    def __init__(self, N_vec, sigma_gen_vec, sigma_rec_vec, K, diagonal_transition = True, fused = False, arena = False, rng = None):
+        self.N_vec = N_vec
+        self.K = K
+        self.fused = fused
+        self.n_latent = np.sum(N_vec) #total # of neurons per member
+        self.sigma_gen_vec = sigma_gen_vec
+        self.sigma_rec_vec = sigma_rec_vec
+        
+        #construct the individual layers
+        n_layers = len(N_vec)
+        if rng is None:
+            rng = np.random
+        input_layer, feedforward_layer = ensemble_layer_classes(fused)
+        W_out = rng.normal(loc = 0, scale = 1/N_vec[1], size = (K, N_vec[0], N_vec[1]))
+        layers = [input_layer(N_vec[0], N_vec[1], nonlinearity, sigma_gen_vec[0], sigma_rec_vec[0], K, W_out = W_out)]
+        for ii in range(1, n_layers):
+            top_layer = (ii == n_layers - 1)
+            N_parent = None if top_layer else N_vec[ii+1]
+            #the weights are drawn in the order the layers would draw them
+            W_in = rng.normal(loc = 0, scale = 1/N_vec[ii-1], size = (K, N_vec[ii], N_vec[ii-1]))
+            W_out = None if top_layer else rng.normal(loc = 0, scale = 1/N_parent, size = (K, N_vec[ii], N_parent))
+            layers.append(feedforward_layer(N_vec[ii], N_parent, N_vec[ii-1], nonlinearity, sigma_gen_vec[ii], sigma_rec_vec[ii], K, W_out = W_out, W_in = W_in,
+                                            bias = not(top_layer), top_layer = top_layer, diagonal_transition = diagonal_transition))
+        
+        #link together the individual layers
+        for ii in range(0, n_layers):
+            parent = layers[ii+1] if ii < n_layers - 1 else None
+            child = layers[ii-1] if ii > 0 else None
+            layers[ii].link(parent = parent, child = child)
+        for ii in range(0, n_layers):
+            setattr(self, 'l' + str(ii), layers[ii])
+        self.layer_list = tuple(layers)
+        self.n_hidden = int(np.sum(N_vec[1:]))
+        self.rec_switch = np.zeros((K,), dtype = int)
+        self.arena = ParameterArena(self.layer_list) if arena else None
+        self.set_phase('wake')
+        
+    def __setstate__(self, state):
+        #a copy (deepcopy, pickle) restores the arena and the layer parameters as separate arrays, so the layers are
+        #pointed back at the restored arena
+        self.__dict__.update(state)
+        if not(self.__dict__.get('arena') is None):
+            self.arena.bind(self.layer_list)
+            
+    def copy_network(self, network):
+        """gives every member the parameters and nonlinearities of network, a single network with the same N_vec"""
+        for layer, member_layer in zip(network.layer_list, self.layer_list):
+            member_layer.nl = layer.nl
+            for param, member_param in zip(layer.params_list_rec + layer.params_list_gen, member_layer.params_list_rec + member_layer.params_list_gen):
+                member_param[...] = param
+        
+    def set_phase(self,phase):
+        for layer in self.layer_list:
+            layer.set_phase(phase)
+        self.phase = phase
+        self.phases = self.layer_list[0].phases
+    
+    def toggle_phase(self, members = None):
+        """toggles the phase of the selected members (all members by default)"""
+        if members is None:
+            members = np.ones((self.K,), dtype = bool)
+        self.rec_switch[members & (self.phases == 'sleep')] = 1 #variable indicates if a phase switch has just occurred
+        for layer in self.layer_list:
+            layer.toggle_phase(members)
+        self.phase = self.layer_list[0].phase
+        self.phases = self.layer_list[0].phases
+    
+    def continue_phase(self, members = None):
+        for layer in self.layer_list:
+            layer.continue_phase(members)
+        if members is None:
+            self.rec_switch[:] = 0
+        else:
+            self.rec_switch[members] = 0
+        
+    def set_noise(self, provider):
+        """draw all network noise from a NoiseProvider (None reverts to np.random)"""
+        for layer in self.layer_list:
+            layer.set_noise(provider)
+        
+    def reset(self):
+        for layer in self.layer_list:
+            layer.reset()
+            
+    def forward(self, x, compute_loss = True):
+        """compute_loss: see DeepHM.forward"""
+        #pass forward through the network for approximate inference
+        self.layer_list[0].forward_recognition(x)
+        for layer in self.layer_list[1:]:
+            layer.forward_recognition()
+        
+        #pass backward through the network for stimulus generation
+        for layer in self.layer_list[::-1]:
+            layer.forward_generative()
+        
+        #based on the network phase, choose to set activities according to inference or generation
+        for layer in self.layer_list:
+            layer.forward(compute_loss)
+        
+        if compute_loss:
+            self.loss_total = np.sum([layer.layer_loss for layer in self.layer_list], axis = 0) #one loss per member
+   
+#define the wake/sleep phase schedule, shared by the learning algorithms and by inference-only runs
+class PhaseScheduler():
+    """Alternates a network between the wake and sleep phases: the phase is toggled once every switch_period + 1
+    steps, and held otherwise. A switch_period of 0 never switches"""
+    def __init__(self, network, switch_period):
+        self.nn = network
+        self.switch_period = switch_period
+        self.switch_counter = 0
+        
+    def step(self):
+        """advances the schedule by one time step, toggling the network phase when the period has elapsed"""
+        if self.switch_period > 0:
+            self.switch_counter = self.switch_counter + 1;
+            if self.switch_counter > self.switch_period:
+                self.nn.toggle_phase()
+                self.switch_counter = 0
+            else:
+                self.nn.continue_phase()
+                
+class EnsemblePhaseScheduler(PhaseScheduler):
+    """PhaseScheduler for an EnsembleLayeredHM, with one switch_period and counter per member"""
+    def __init__(self, network, switch_period):
+        super().__init__(network, switch_period)
+        K = self.nn.K
+        self.switch_period = np.broadcast_to(np.asarray(switch_period), (K,)).copy()
+        self.switch_counter = np.zeros((K,), dtype = int)
+        
+    def step(self):
+        switching = self.switch_period > 0
+        self.switch_counter[switching] += 1
+        toggle = switching & (self.switch_counter > self.switch_period)
+        self.switch_counter[toggle] = 0
+        #toggling or continuing an empty selection of members changes nothing, so those calls are skipped
+        if toggle.any():
+            self.nn.toggle_phase(toggle)
+        continuing = switching & ~toggle
+        if continuing.any():
+            self.nn.continue_phase(continuing)
+
+class LayeredLearningAlgorithm():
+    #whether the updates read both the recognition and the generative pass in every phase. If not, the network
+    #may skip the pass that does not set h (see DeepHM.set_phase_kernels)
+    needs_both_passes = True
+    #whether the updates read loss_total. If not, Simulation may compute the loss only on some steps
+    requires_loss = True
+    
+    def __init__(self, network, learning_rate):
+        self.nn = network
+        self.update_list_rec = []
+        self.update_list_gen = []
+        self.learning_stats = {'mean_update': [], 'm2': []}
+        self.mean = []
+        self.variance = []
+        self.snr = []
+        self.N_prev = 0
+        
+        for ii in range(0, len(self.nn.layer_list)):
             self.update_list_rec.append([0]*len(self.nn.layer_list[ii].params_list_rec))
             self.update_list_gen.append([0]*len(self.nn.layer_list[ii].params_list_gen))
-            self.learning_stats['mean_update'].append([0]*len(self.nn.layer_list[ii].params_list_rec))
-            self.learning_stats['moment_2'].append([0]*len(self.nn.layer_list[ii].params_list_rec))
             self.mean.append([0]*len(self.nn.layer_list[ii].params_list_rec))
             self.variance.append([0]*len(self.nn.layer_list[ii].params_list_rec))
             self.snr.append([0]*len(self.nn.layer_list[ii].params_list_rec))
+        #the moments of the updates to the recognition parameters are kept in MomentAccumulators, one per parameter,
+        #and the entries of learning_stats are their mean and m2 arrays. With a parameter arena, a single accumulator
+        #holds vectors laid out like arena.rec, and the entries are views of them
+        self.arena = getattr(self.nn, 'arena', None)
+        if not(self.arena is None):
+            self.update_rec = np.zeros((self.arena.n_rec,))
+            self.update_rec_views = self.arena.split(self.update_rec)
+            self.moments = [MomentAccumulator((self.arena.n_rec,))]
+            self.learning_stats['mean_update'] = self.arena.split(self.moments[0].mean)
+            self.learning_stats['m2'] = self.arena.split(self.moments[0].m2)
+        else:
+            self.moments = []
+            for ii in range(0, len(self.nn.layer_list)):
+                layer_moments = [MomentAccumulator(np.shape(param)) for param in self.nn.layer_list[ii].params_list_rec]
+                self.moments += layer_moments
+                self.learning_stats['mean_update'].append([moments.mean for moments in layer_moments])
+                self.learning_stats['m2'].append([moments.m2 for moments in layer_moments])
             
         self.learning_rate = learning_rate
         
@@ -546,26 +2356,92 @@ class LayeredLearningAlgorithm():
         for ii in range(0, len(self.nn.layer_list)):
             #loop through all recognition parameters for that layer
             for jj in range(0, len(self.nn.layer_list[ii].params_list_rec)):
-                self.nn.layer_list[ii].params_list_rec[jj] += self.learning_rate * self.update_list_rec[ii][jj] / exp_params.recognition_scale
+                apply_update(self.nn.layer_list[ii].params_list_rec[jj], self.update_list_rec[ii][jj], self.learning_rate / exp_params.recognition_scale)
             #loop through all generative parameters for that layer
             for jj in range(0, len(self.nn.layer_list[ii].params_list_gen)):
-                self.nn.layer_list[ii].params_list_gen[jj] += self.learning_rate * self.update_list_gen[ii][jj]
+                apply_update(self.nn.layer_list[ii].params_list_gen[jj], self.update_list_gen[ii][jj], self.learning_rate)
+            #the cached products were formed with the old parameters
+            self.nn.layer_list[ii].invalidate_cache()
+            
+    def compile_assign(self):
+        """returns a function equivalent to assign_vars, with the parameters, update lists and step sizes resolved
+        once into a flat list. Valid until the parameter lists, update lists or learning rate are replaced"""
+        plan = []
+        for ii in range(0, len(self.nn.layer_list)):
+            layer = self.nn.layer_list[ii]
+            for jj in range(0, len(layer.params_list_rec)):
+                plan.append((layer.params_list_rec[jj], self.update_list_rec, ii, jj, self.learning_rate / exp_params.recognition_scale))
+            for jj in range(0, len(layer.params_list_gen)):
+                plan.append((layer.params_list_gen[jj], self.update_list_gen, ii, jj, self.learning_rate))
+        invalidate = [layer.invalidate_cache for layer in self.nn.layer_list]
+        
+        def assign():
+            #the per-layer update lists are rebuilt every step, so they are looked up through the outer list
+            for param, update_lists, ii, jj, alpha in plan:
+                apply_update(param, update_lists[ii][jj], alpha)
+            for invalidate_cache in invalidate:
+                invalidate_cache()
+        return assign
     
     def update_learning_stats(self):
-        """Keep a running average of the 1st and 2nd moments of the updates to the input weights. This is useful for comparison across algorithms"""
+        """Keep running moments of the updates to the input weights. This is useful for comparison across algorithms"""
+        if not(self.arena is None):
+            #the same moments, over all the recognition updates at once
+            self.arena.gather(self.update_list_rec, self.update_rec_views)
+            self.moments[0].update(self.update_rec)
+            self.N_prev += 1
+            return
+        kk = 0
         for ii in range(0, len(self.nn.layer_list)):
             for jj in range(0, len(self.update_list_rec[ii])):
-                self.learning_stats['mean_update'][ii][jj]= (self.learning_stats['mean_update'][ii][jj] * self.N_prev +  self.update_list_rec[ii][jj]) / (self.N_prev + 1)
-                self.learning_stats['moment_2'][ii][jj] = (self.learning_stats['moment_2'][ii][jj] * self.N_prev + self.update_list_rec[ii][jj]**2)/ (self.N_prev + 1)
+                self.moments[kk].update(self.update_list_rec[ii][jj])
+                kk += 1
         self.N_prev += 1
         return
     
+    def update_learning_stats_batch(self, update_list_rec, n):
+        """update_learning_stats for n updates at once: update_list_rec holds stacks of updates along a leading axis
+        (e.g. the updates of the members of an EnsembleLayeredHM), of which the first n are used. Scalar zero
+        updates stand for n zeros"""
+        if not(self.arena is None):
+            #the rows of update_rec_batch are laid out like arena.rec
+            if not(hasattr(self, 'update_rec_batch')) or self.update_rec_batch.shape[0] != n:
+                self.update_rec_batch = np.zeros((n, self.arena.n_rec))
+            for ii, list_name, jj, name, offset, shape in self.arena.layout:
+                if list_name == 'params_list_rec':
+                    update = update_list_rec[ii][jj]
+                    columns = self.update_rec_batch[:, offset:offset + int(np.prod(shape))]
+                    if np.ndim(update) == 0:
+                        columns.fill(update)
+                    else:
+                        columns[...] = np.reshape(update[:n], (n, -1))
+            self.moments[0].update_batch(self.update_rec_batch)
+            self.N_prev += n
+            return
+        kk = 0
+        for ii in range(0, len(self.nn.layer_list)):
+            for jj in range(0, len(self.nn.layer_list[ii].params_list_rec)):
+                update = update_list_rec[ii][jj]
+                if np.ndim(update) == 0:
+                    self.moments[kk].combine(n, np.full(self.moments[kk].mean.shape, float(update)), 0)
+                else:
+                    self.moments[kk].update_batch(update[:n])
+                kk += 1
+        self.N_prev += n
+        
+    def merge_learning_stats(self, moments):
+        """adds the learning statistics of another run over the same network (its list of MomentAccumulators,
+        moments), e.g. an SNR shard computed in a worker process"""
+        for accumulator, other in zip(self.moments, moments):
+            accumulator.merge(other)
+        self.N_prev += moments[0].n
+    
     def get_learning_stats(self):
         """Returns the mean, variance, and SNR across different parameters in W_in"""
         for ii in range(0, len(self.nn.layer_list)):
             for jj in range(0, len(self.update_list_rec[ii])):
-                self.variance[ii][jj] = self.learning_stats['moment_2'][ii][jj] - self.learning_stats['mean_update'][ii][jj]**2
-                self.mean[ii][jj] = self.learning_stats['mean_update'][ii][jj]
+                self.variance[ii][jj] = self.learning_stats['m2'][ii][jj] / self.N_prev
+                self.mean[ii][jj] = np.copy(self.learning_stats['mean_update'][ii][jj])
                 self.snr[ii][jj] = self.mean[ii][jj]**2/self.variance[ii][jj]
         return self.mean, self.variance, self.snr
     
@@ -573,17 +2449,23 @@ class LayeredLearningAlgorithm():
         return
                 
 class LayeredImpression(LayeredLearningAlgorithm):
+    needs_both_passes = False #grad_rec in sleep and grad_gen in wake only read the active pass
+    requires_loss = False
+    
     def __init__(self, network, learning_rate, switch_period):
         super().__init__(network, learning_rate)
         self.switch_period = switch_period
-        self.switch_counter = 0
+        self.scheduler = PhaseScheduler(network, switch_period)
+        
     def update_learning_vars(self, record_stats = False):
         #the statistics functions only care about W_in, so we only run in the sleep phase if stats are being recorded
             
         #update the feedforward recognition weights
+        #outside of stats recording, weight updates stay in factored form and are applied in place
+        factored = not(record_stats)
         if self.nn.phase == 'sleep':# and not(self.switch_counter == 0):
             for ii in range(0, len(self.nn.layer_list)):
-                self.update_list_rec[ii] = self.nn.layer_list[ii].grad_rec()
+                self.update_list_rec[ii] = self.nn.layer_list[ii].grad_rec(factored)
         else:
             for ii in range(0, len(self.nn.layer_list)):
                 self.update_list_rec[ii] = [0]*len(self.nn.layer_list[ii].params_list_rec)
@@ -591,20 +2473,14 @@ class LayeredImpression(LayeredLearningAlgorithm):
         #update the top-down generative weights
         if self.nn.phase == 'wake':# and not(self.switch_counter == 0):
             for ii in range(0, len(self.nn.layer_list)):
-                self.update_list_gen[ii] = self.nn.layer_list[ii].grad_gen()
+                self.update_list_gen[ii] = self.nn.layer_list[ii].grad_gen(factored)
         else:
             for ii in range(0, len(self.nn.layer_list)):
                 self.update_list_gen[ii] = [0]*len(self.nn.layer_list[ii].params_list_gen)
         
         #if not(record_stats):
         #determine whether to transition phase (wake or sleep)
-        if self.switch_period > 0:
-            self.switch_counter = self.switch_counter + 1;
-            if self.switch_counter > self.switch_period:
-                self.nn.toggle_phase()
-                self.switch_counter = 0
-            else:
-                self.nn.continue_phase()
+        self.scheduler.step()
                     
                     
 class LayeredREINFORCE(LayeredLearningAlgorithm):
@@ -639,7 +2515,10 @@ class LayeredREINFORCE(LayeredLearningAlgorithm):
                 self.update_list_gen[ii] = self.nn.layer_list[ii].grad_gen()
                 
 class LayeredAlternatingREINFORCE(LayeredLearningAlgorithm):
-    """Algorithm for performing REINFORCE while the network is in an alternating mode, rather than when delta = 1"""
+    """Algorithm for performing REINFORCE while the network is in an alternating mode, rather than when delta = 1.
+    Each gradient is computed once per step, and the updates and eligibility traces are persistent buffers
+    that are overwritten (the updates) or decayed and accumulated (the traces) in place. The network may also be an
+    EnsembleLayeredHM, with one reward baseline (loss_avg) per member"""
     def __init__(self, network, learning_rate, switch_period, decay = 1, loss_decay = 0.99):
         super().__init__(network, learning_rate)
         self.e_trace = 0
@@ -647,71 +2526,546 @@ class LayeredAlternatingREINFORCE(LayeredLearningAlgorithm):
         self.e_trace_rec_list = []
         self.e_trace_gen_list = []
         self.e_trace_rec_update_list = []
-        self.e_trace_rec_update_prev = []
         self.e_trace_gen_update_list = []
-        self.e_trace_gen_update_prev = []
+        self.scratch_rec = []
+        self.scratch_gen = []
         for ii in range(0, len(self.nn.layer_list)):
-            self.e_trace_rec_list.append([0]*len(self.nn.layer_list[ii].params_list_rec))
-            self.e_trace_gen_list.append([0]*len(self.nn.layer_list[ii].params_list_gen))
-            self.e_trace_rec_update_list.append([0]*len(self.nn.layer_list[ii].params_list_rec))
-            self.e_trace_rec_update_prev.append([0]*len(self.nn.layer_list[ii].params_list_rec))
-            self.e_trace_gen_update_list.append([0]*len(self.nn.layer_list[ii].params_list_gen))
-            self.e_trace_gen_update_prev.append([0]*len(self.nn.layer_list[ii].params_list_gen))
+            params_rec = self.nn.layer_list[ii].params_list_rec
+            params_gen = self.nn.layer_list[ii].params_list_gen
+            self.update_list_rec[ii] = [np.zeros(np.shape(param)) for param in params_rec]
+            self.update_list_gen[ii] = [np.zeros(np.shape(param)) for param in params_gen]
+            self.e_trace_rec_list.append([np.zeros(np.shape(param)) for param in params_rec])
+            self.e_trace_gen_list.append([np.zeros(np.shape(param)) for param in params_gen])
+            self.e_trace_rec_update_list.append([0]*len(params_rec))
+            self.e_trace_gen_update_list.append([0]*len(params_gen))
+            self.scratch_rec.append([np.zeros(np.shape(param)) for param in params_rec])
+            self.scratch_gen.append([np.zeros(np.shape(param)) for param in params_gen])
         self.loss_avg = 0
         self.decay = decay
         self.loss_decay = loss_decay
         
         self.switch_period = switch_period
-        self.switch_counter = 0
+        self.scheduler = PhaseScheduler(network, switch_period)
     
     def reset_learning(self, loss_reset = False):
-        for ii in range(0, len(self.nn.layer_list)):
-            self.e_trace_rec_list.append([0]*len(self.nn.layer_list[ii].params_list_rec))
-            self.e_trace_gen_list.append([0]*len(self.nn.layer_list[ii].params_list_gen))
-            self.e_trace_rec_update_list.append([0]*len(self.nn.layer_list[ii].params_list_rec))
-            self.e_trace_rec_update_prev.append([0]*len(self.nn.layer_list[ii].params_list_rec))
-            self.e_trace_gen_update_list.append([0]*len(self.nn.layer_list[ii].params_list_gen))
-            self.e_trace_gen_update_prev.append([0]*len(self.nn.layer_list[ii].params_list_gen))
-        
+        #the eligibility traces carry over between epochs (resetting has never cleared them)
         if loss_reset:
             self.loss_avg = 0
             
+    def accumulate(self, update, e_trace, scratch, grad, impression_scale, trace_scale, reward):
+        """update = impression_scale * grad + reward * e_trace, with e_trace = trace_scale * grad + decay * e_trace.
+        For an ensemble, the scales and the reward have one entry per member"""
+        ndim = np.ndim(update)
+        #First, the update given by impression learning
+        np.multiply(member_axes(impression_scale, ndim), grad, out = update)
+        #step 2, add on the update given by REINFORCE
+        np.multiply(e_trace, self.decay, out = e_trace)
+        np.multiply(member_axes(trace_scale, ndim), grad, out = scratch)
+        np.add(scratch, e_trace, out = e_trace)
+        np.multiply(member_axes(reward, ndim), e_trace, out = scratch)
+        np.add(update, scratch, out = update)
+            
     def update_learning_vars(self, record_stats = False):
         #self.loss_avg = (self.loss_decay) * self.loss_avg + (1-self.loss_decay) * self.nn.loss_total
         self.loss_avg = self.loss_decay * self.loss_avg + (1-self.loss_decay)*self.nn.loss_total
+        reward = self.nn.loss_total - self.loss_avg
         
-        #First, compute the updates given by impression learning
         for ii in range(0, len(self.nn.layer_list)):
-            self.update_list_gen[ii] = [(self.nn.layer_list[ii].delta)*grad for grad in self.nn.layer_list[ii].grad_gen()] #this is supposed to be 0 if delta = 0
-            self.update_list_rec[ii] = [(1-self.nn.layer_list[ii].delta)*grad for grad in self.nn.layer_list[ii].grad_rec()] #this is supposed to be 0 if delta = 1
+            layer = self.nn.layer_list[ii]
+            #the same gradients give the impression update (masked by the phase) and the eligibility trace increment
+            self.e_trace_rec_update_list[ii] = layer.grad_rec()
+            self.e_trace_gen_update_list[ii] = layer.grad_gen()
+            
+            #the recognition update is supposed to be 0 if delta = 1, the generative update 0 if delta = 0
+            for jj in range(0, len(layer.params_list_rec)):
+                self.accumulate(self.update_list_rec[ii][jj], self.e_trace_rec_list[ii][jj], self.scratch_rec[ii][jj], self.e_trace_rec_update_list[ii][jj], 1 - layer.delta, layer.delta, reward)
+            for jj in range(0, len(layer.params_list_gen)):
+                self.accumulate(self.update_list_gen[ii][jj], self.e_trace_gen_list[ii][jj], self.scratch_gen[ii][jj], self.e_trace_gen_update_list[ii][jj], layer.delta, 1 - layer.delta, reward)
+
+        self.scheduler.step()
+                    
+class Backpropagation(LayeredLearningAlgorithm):
+    """Gradient descent on the layered loss, with the exact gradient computed analytically by backpropagating
+    through the pass that sets h: the recognition pass in the wake phase and the generative pass in the sleep phase.
+    Both the recognition and the generative parameters are updated in every phase. The noise is treated as a fixed
+    input and the previous state of the top layer as a constant, so the gradient is truncated at one time step.
+    The loss is scaled by sigma_min**2/2, sigma_min being the smallest noise level in the active half of the loss,
+    so that with equal noise levels each layer's own term gives the update LayeredImpression does.
+    The network may also be an EnsembleLayeredHM whose members share a phase (as under a PhaseScheduler), in which
+    case every state and update carries the member axis"""
+    needs_both_passes = False #each phase only reads the pass that sets h
+    requires_loss = False
+    
+    def __init__(self, network, learning_rate, switch_period = 1):
+        super().__init__(network, learning_rate)
+        self.switch_period = switch_period
+        self.scheduler = PhaseScheduler(network, switch_period)
+        layers = self.nn.layer_list
+        #weight of each layer's term in the wake (generative) and sleep (recognition) halves of the loss
+        sigma_gen = np.array([layer.sigma_gen for layer in layers], dtype = float)
+        sigma_rec = np.array([layer.sigma_rec for layer in layers], dtype = float)
+        self.precision_wake = (np.min(sigma_gen) / sigma_gen)**2
+        self.precision_sleep = (np.min(sigma_rec) / sigma_rec)**2
+        #an ensemble adds a leading member axis, and its updates are always dense
+        self.batched = isinstance(self.nn, EnsembleLayeredHM)
+        members = (self.nn.K,) if self.batched else ()
+        
+        #per-layer buffers, overwritten every step
+        self.E = [np.zeros(members + (layer.N,)) for layer in layers] #weighted prediction error of the layer's term
+        self.g = [np.zeros(members + (layer.N,)) for layer in layers] #minus the gradient of the loss with respect to h
+        self.D = [np.zeros(members + (layer.N,)) for layer in layers] #delta at the recognition pre-activation
+        self.G = [np.zeros(members + (layer.N,)) for layer in layers] #delta at the generative pre-activation
+        self.pre = [np.zeros(members + (layer.N,)) for layer in layers]
+        self.pred = [np.zeros(members + (layer.N,)) for layer in layers]
+        self.f_prime = [np.zeros(members + (layer.N,)) for layer in layers]
+        self.tmp = [np.zeros(members + (layer.N,)) for layer in layers]
+        #weight updates, in factored form or written into dense buffers when the statistics are recorded
+        self.W_in_factors = [None] + [Rank1Update(self.D[ii], None) for ii in range(1, len(layers))]
+        self.W_in_update = [None] + [np.zeros(np.shape(layer.W_in)) for layer in layers[1::]]
+        self.W_out_factors = [Rank1Update(self.G[ii], None) for ii in range(0, len(layers) - 1)] + [None]
+        self.W_out_update = [np.zeros(np.shape(layer.W_out)) for layer in layers[:-1]] + [None]
+        self.transition_factors = Rank1Update(None, None)
+        self.transition_mat_update = np.zeros(layers[-1].transition_mat.shape)
+        
+    def outer_update(self, factors, dense, u, v, factored):
+        """returns the weight update u v^T, as factors or written into dense"""
+        if factored:
+            factors.u = u
+            factors.v = v
+            return factors
+        return outer(u, v, out = dense)
+    
+    def transition_update(self, u, factored):
+        """returns the update of the top-layer transition matrix for the delta u at its output"""
+        top = self.nn.layer_list[-1]
+        if top.diagonal_transition:
+            return np.multiply(u, top.h_prev, out = self.transition_mat_update)
+        return self.outer_update(self.transition_factors, self.transition_mat_update, u, top.h_prev, factored)
+        
+    def update_learning_vars(self, record_stats = False):
+        #outside of stats recording, weight updates stay in factored form and are applied in place
+        factored = not(record_stats) and not(self.batched)
+        if self.nn.phase == 'wake':
+            self.backprop_wake(factored)
+        elif self.nn.phase == 'sleep':
+            self.backprop_sleep(factored)
+        else:
+            for ii in range(0, len(self.nn.layer_list)):
+                self.update_list_rec[ii] = [0]*len(self.nn.layer_list[ii].params_list_rec)
+                self.update_list_gen[ii] = [0]*len(self.nn.layer_list[ii].params_list_gen)
+        
+        #determine whether to transition phase (wake or sleep)
+        self.scheduler.step()
+        
+    def backprop_wake(self, factored):
+        """wake phase: h is h_rec, and the loss is the generative prediction error of every layer"""
+        layers = self.nn.layer_list
+        L = len(layers) - 1
+        #prediction errors of the generative model, and their gradients with respect to the generative parameters
+        for ii in range(0, L + 1):
+            layer = layers[ii]
+            E = self.E[ii]
+            G = self.G[ii]
+            if ii == 0:
+                h_pred = layer.cache.get('pre_pred_gen')
+                if h_pred is None:
+                    h_pred = matvec(layer.W_out, layer.parent.h, out = self.pred[ii])
+                np.subtract(layer.h, h_pred, out = E)
+                np.multiply(E, self.precision_wake[ii], out = E)
+                np.copyto(G, E)
+                self.update_list_gen[ii] = [self.outer_update(self.W_out_factors[ii], self.W_out_update[ii], G, layer.parent.h, factored)]
+            elif np.all(layer.rec_switch == 1):
+                #just after a switch, h is predicted by h_prev, which the parameters do not enter
+                np.subtract(layer.h, layer.h_prev, out = E)
+                np.multiply(E, self.precision_wake[ii], out = E)
+                G.fill(0)
+                self.update_list_gen[ii] = [0]*len(layer.params_list_gen)
+            elif ii == L:
+                h_pred = layer.cache.get('pred_gen')
+                if h_pred is None:
+                    h_pred = layer.transition(layer.h_prev, out = self.pred[ii])
+                np.subtract(layer.h, h_pred, out = E)
+                np.multiply(E, self.precision_wake[ii], out = E)
+                self.update_list_gen[ii] = [self.transition_update(E, factored)]
+            else:
+                h_pre_pred = layer.cache.get('pre_pred_gen')
+                if h_pre_pred is None:
+                    h_pre_pred = matvec(layer.W_out, layer.parent.h, out = self.pre[ii])
+                    np.add(h_pre_pred, layer.bias_gen, out = h_pre_pred)
+                h_pred = layer.cache.get('pred_gen')
+                if h_pred is None:
+                    h_pred = layer.nl.f(h_pre_pred, out = self.pred[ii])
+                np.subtract(layer.h, h_pred, out = E)
+                np.multiply(E, self.precision_wake[ii], out = E)
+                np.multiply(layer.nl.f_prime(h_pre_pred, out = self.f_prime[ii]), E, out = G)
+                self.update_list_gen[ii] = [self.outer_update(self.W_out_factors[ii], self.W_out_update[ii], G, layer.parent.h, factored)]
+                if layer.biased:
+                    self.update_list_gen[ii].append(G)
+        
+        #backpropagate through the recognition pass, from the top down. h of each layer enters its own term, the
+        #prediction of the layer below and the recognition pass of the layer above
+        self.update_list_rec[0] = []
+        for ii in range(L, 0, -1):
+            layer = layers[ii]
+            g = self.g[ii]
+            np.negative(self.E[ii], out = g)
+            np.add(g, vecmat(self.G[ii-1], layers[ii-1].W_out, out = self.tmp[ii]), out = g)
+            if ii < L:
+                np.add(g, vecmat(self.D[ii+1], layers[ii+1].W_in, out = self.tmp[ii]), out = g)
+            np.multiply(layer.fprime_rec(), g, out = self.D[ii])
+            self.update_list_rec[ii] = [self.outer_update(self.W_in_factors[ii], self.W_in_update[ii], self.D[ii], layer.child.h, factored)]
+            if layer.biased:
+                self.update_list_rec[ii].append(self.D[ii])
                 
+    def backprop_sleep(self, factored):
+        """sleep phase: h is h_gen, and the loss is the recognition prediction error of every layer"""
+        layers = self.nn.layer_list
+        L = len(layers) - 1
+        #prediction errors of the recognition model, and their gradients with respect to the recognition parameters
+        for ii in range(0, L + 1):
+            layer = layers[ii]
+            E = self.E[ii]
+            if ii == 0:
+                np.subtract(layer.h, layer.h_child, out = E)
+                np.multiply(E, self.precision_sleep[ii], out = E)
+                self.update_list_rec[ii] = []
+                continue
+            h_pre_pred = layer.cache.get('pre_grad_rec')
+            if h_pre_pred is None:
+                h_pre_pred = matvec(layer.W_in, layer.child.h, out = self.pre[ii])
+                np.add(h_pre_pred, layer.bias, out = h_pre_pred)
+                h_pred = layer.nl.f(h_pre_pred, out = self.pred[ii])
+            else:
+                h_pred = layer.cache['pred_grad_rec']
+            np.subtract(layer.h, h_pred, out = E)
+            np.multiply(E, self.precision_sleep[ii], out = E)
+            np.multiply(layer.nl.f_prime(h_pre_pred, out = self.f_prime[ii]), E, out = self.D[ii])
+            self.update_list_rec[ii] = [self.outer_update(self.W_in_factors[ii], self.W_in_update[ii], self.D[ii], layer.child.h, factored)]
+            if layer.biased:
+                self.update_list_rec[ii].append(self.D[ii])
+        
+        #backpropagate through the generative pass, from the bottom up. h of each layer enters its own term, the
+        #recognition prediction of the layer above and the generative pass of the layer below
+        for ii in range(0, L + 1):
+            layer = layers[ii]
+            g = self.g[ii]
+            G = self.G[ii]
+            np.negative(self.E[ii], out = g)
+            if ii < L:
+                np.add(g, vecmat(self.D[ii+1], layers[ii+1].W_in, out = self.tmp[ii]), out = g)
+            if ii > 0:
+                np.add(g, vecmat(self.G[ii-1], layers[ii-1].W_out, out = self.tmp[ii]), out = g)
+            if ii == 0:
+                np.copyto(G, g)
+                self.update_list_gen[ii] = [self.outer_update(self.W_out_factors[ii], self.W_out_update[ii], G, layer.parent.h, factored)]
+            elif ii == L:
+                self.update_list_gen[ii] = [self.transition_update(g, factored)]
+            else:
+                h_pre_gen = matvec(layer.W_out, layer.parent.h, out = self.pre[ii])
+                np.add(h_pre_gen, layer.bias_gen, out = h_pre_gen)
+                np.multiply(layer.nl.f_prime(h_pre_gen, out = self.f_prime[ii]), g, out = G)
+                self.update_list_gen[ii] = [self.outer_update(self.W_out_factors[ii], self.W_out_update[ii], G, layer.parent.h, factored)]
+                if layer.biased:
+                    self.update_list_gen[ii].append(G)
+                    
+class EnsembleImpression(LayeredLearningAlgorithm):
+    """Impression learning for an EnsembleLayeredHM. learning_rate and switch_period may be scalars
+    or have one entry per member, so that a hyperparameter sweep runs as a single ensemble"""
+    requires_loss = False
+    def __init__(self, network, learning_rate, switch_period):
+        super().__init__(network, learning_rate)
+        K = self.nn.K
+        self.learning_rate = np.broadcast_to(np.asarray(learning_rate, dtype = float), (K,)).copy()
+        self.scheduler = EnsemblePhaseScheduler(network, switch_period)
+        self.switch_period = self.scheduler.switch_period
+        #member scalings broadcast against the updates (K x N or K x N x M), built once rather than every step
+        self.member_axes = {ndim: (-1,) + (1,)*(ndim - 1) for ndim in (2, 3)}
+        self.member_learning_rate = {ndim: np.reshape(self.learning_rate, shape) for ndim, shape in self.member_axes.items()}
+        
+    def update_learning_vars(self, record_stats = False):
+        #the gradients are fresh arrays, or buffers of a fused ensemble that are rewritten every step, so they are
+        #masked in place (the same products as member_scale)
+        asleep = (self.nn.phases == 'sleep').astype(float)
+        awake = (self.nn.phases == 'wake').astype(float)
+        asleep_axes = {ndim: np.reshape(asleep, shape) for ndim, shape in self.member_axes.items()}
+        awake_axes = {ndim: np.reshape(awake, shape) for ndim, shape in self.member_axes.items()}
+        
+        #update the feedforward recognition weights of the members in the sleep phase
+        for ii in range(0, len(self.nn.layer_list)):
+            if asleep.any():
+                self.update_list_rec[ii] = [np.multiply(asleep_axes[grad.ndim], grad, out = grad) for grad in self.nn.layer_list[ii].grad_rec()]
+            else:
+                self.update_list_rec[ii] = [0]*len(self.nn.layer_list[ii].params_list_rec)
+                
+        #update the top-down generative weights of the members in the wake phase
+        for ii in range(0, len(self.nn.layer_list)):
+            if awake.any():
+                self.update_list_gen[ii] = [np.multiply(awake_axes[grad.ndim], grad, out = grad) for grad in self.nn.layer_list[ii].grad_gen()]
+            else:
+                self.update_list_gen[ii] = [0]*len(self.nn.layer_list[ii].params_list_gen)
+        
+        #determine, per member, whether to transition phase (wake or sleep)
+        self.scheduler.step()
+        
+    def assign_vars(self):
+        #phases without an update leave a scalar 0 in the update lists, which is skipped. The updates are not read
+        #again after this step, so they are scaled in place
         for ii in range(0, len(self.nn.layer_list)):
-            self.e_trace_rec_update_prev[ii] = self.e_trace_rec_update_list[ii]
-            self.e_trace_gen_update_prev[ii] = self.e_trace_gen_update_list[ii]
-            
-            self.e_trace_rec_update_list[ii] = self.nn.layer_list[ii].grad_rec()
-            self.e_trace_gen_update_list[ii] = self.nn.layer_list[ii].grad_gen()
-            
-            #step 2, add on the update given by REINFORCE
             for jj in range(0, len(self.nn.layer_list[ii].params_list_rec)):
-                self.e_trace_rec_list[ii][jj] = (self.nn.layer_list[ii].delta)* self.e_trace_rec_update_list[ii][jj] + (self.decay)*self.e_trace_rec_list[ii][jj]#self.e_trace_rec_update_prev[ii][jj]
-                self.update_list_rec[ii][jj] += (self.nn.loss_total- self.loss_avg) * self.e_trace_rec_list[ii][jj]
-            
+                update = self.update_list_rec[ii][jj]
+                if np.ndim(update) > 0:
+                    np.multiply(self.member_learning_rate[update.ndim], update, out = update)
+                    np.divide(update, exp_params.recognition_scale, out = update)
+                    self.nn.layer_list[ii].params_list_rec[jj] += update
             for jj in range(0, len(self.nn.layer_list[ii].params_list_gen)):
-                self.e_trace_gen_list[ii][jj] = (1 - self.nn.layer_list[ii].delta)*self.e_trace_gen_update_list[ii][jj] + (self.decay)*self.e_trace_gen_list[ii][jj]#self.e_trace_gen_update_prev[ii][jj]
-                self.update_list_gen[ii][jj] += (self.nn.loss_total - self.loss_avg) * self.e_trace_gen_list[ii][jj]
+                update = self.update_list_gen[ii][jj]
+                if np.ndim(update) > 0:
+                    np.multiply(self.member_learning_rate[update.ndim], update, out = update)
+                    self.nn.layer_list[ii].params_list_gen[jj] += update
+            self.nn.layer_list[ii].invalidate_cache()
+            
+    def compile_assign(self):
+        #ensemble steps are dominated by the batched products, so assign_vars is used as is
+        return self.assign_vars
+                
+class SNREstimator(LayeredLearningAlgorithm):
+    """The learning statistics that a learning_stats Simulation over many short epochs (episodes) gives for a
+    learning algorithm on a frozen network, with batch_size episodes simulated at once as the members of an
+    EnsembleLayeredHM. Each member runs its own chain of episodes, reset between episodes as in Simulation, with its
+    own phase schedule and algorithm state. With batch_size = 1 and no burn_in, this is the sequential run. With more
+    members, each chain is epoch_num/batch_size episodes long, so state carried over between episodes has a shorter
+    history than in the sequential run. That is harmless for LayeredImpression and Backpropagation, but not for
+    LayeredAlternatingREINFORCE, whose loss average and eligibility traces (decay = 1) build up over the whole run.
+    The moments are kept for the parameters of the frozen network, and are read with get_learning_stats (or merged
+    with merge_learning_stats) as for the learning algorithms"""
+    def __init__(self, network, alg_class, *alg_args, batch_size = 10000, **alg_kwargs):
+        """alg_class: LayeredImpression, LayeredAlternatingREINFORCE or Backpropagation, constructed on the ensemble
+        with alg_args and alg_kwargs after the network"""
+        super().__init__(network, 0)
+        self.batch_size = batch_size
+        #every member of the ensemble is a copy of the frozen network. The initial parameters the ensemble draws are
+        #overwritten, so they come from a private Generator and leave the global random state untouched
+        self.ensemble = EnsembleLayeredHM(network.N_vec, network.sigma_gen_vec, network.sigma_rec_vec, batch_size, diagonal_transition = network.layer_list[-1].diagonal_transition,
+                                          rng = np.random.default_rng(0))
+        self.ensemble.copy_network(network)
+        self.learn_alg = alg_class(self.ensemble, *alg_args, **alg_kwargs)
+        
+    def run(self, data, epoch_num, seed = None, burn_in = 0):
+        """runs epoch_num episodes over data (N_0 x T) and returns get_learning_stats(). The members left over in the
+        last batch run, but are not counted.
+        burn_in: episodes each member runs before the statistics are counted. A chain of epoch_num/batch_size
+        episodes is far shorter than the sequential run, so state that settles over many steps, such as the
+        running loss average of LayeredAlternatingREINFORCE, should be given time to reach its steady state"""
+        if not(seed is None):
+            self.ensemble.set_noise(NoiseProvider(seed))
+        X = np.ascontiguousarray(np.transpose(data))
+        self.ensemble.set_phase('wake')
+        #the number of members counted in each batch of episodes
+        batches = [0]*burn_in + [min(self.batch_size, epoch_num - start) for start in range(0, epoch_num, self.batch_size)]
+        for n in batches:
+            self.ensemble.reset()
+            self.learn_alg.reset_learning()
+            for x in X:
+                self.ensemble.forward(x)
+                self.learn_alg.update_learning_vars(record_stats = True)
+                if n > 0:
+                    self.update_learning_stats_batch(self.learn_alg.update_list_rec, n)
+        if not(seed is None):
+            self.ensemble.set_noise(None)
+        return self.get_learning_stats()
+    
+def update_snr(nn, alg_class, data, *alg_args, batch_size = None, **alg_kwargs):
+    """returns the learning statistics (mean, variance, SNR) of alg_class, constructed on the frozen network nn with
+    alg_args and alg_kwargs, over exp_params.epoch_num_snr episodes of data, as in the SNR mode
+    batch_size: episodes simulated at once (default: exp_params.snr_batch_size). 1 runs the original learning_stats
+    Simulation one episode after another; otherwise the episodes are run by an SNREstimator"""
+    if batch_size is None:
+        batch_size = exp_params.snr_batch_size
+    if batch_size == 1:
+        learn_alg = alg_class(nn, *alg_args, **alg_kwargs)
+        comparison_sim = Simulation(data, None, nn, epoch_num = exp_params.epoch_num_snr, train = False, compare_algs = [learn_alg], learning_stats = True,
+                                    seed = noise_seed(120994))
+        comparison_sim.run()
+        return learn_alg.get_learning_stats()
+    estimator = SNREstimator(nn, alg_class, *alg_args, batch_size = batch_size, **alg_kwargs)
+    return estimator.run(data, exp_params.epoch_num_snr, seed = noise_seed(120994), burn_in = exp_params.snr_burn_in)
+    
+#Define simulation
+def time_major_blocks(data, block_size = 4096):
+    """yields data (... x T) as consecutive time-major blocks (t x ...), in which every time step is one contiguous row.
+    Data already stored time-major (e.g. the transposed views returned by the dataset cache) is sliced without copying;
+    otherwise each block is copied, so only block_size steps are ever held in the second layout"""
+    data = np.moveaxis(data, -1, 0)
+    for start in range(0, data.shape[0], block_size):
+        yield np.ascontiguousarray(data[start:start + block_size])
 
-        if self.switch_period > 0:
-            self.switch_counter = self.switch_counter + 1;
-            if self.switch_counter > self.switch_period:
-                self.nn.toggle_phase()
-                self.switch_counter = 0
+def snapshot_steps(total_steps, n_snapshots = 20, spacing = 'linear'):
+    """returns the training steps at which to record network snapshots
+    spacing: 'linear' takes one snapshot every total_steps/n_snapshots steps, starting at step 0. 'log' spaces at most
+        n_snapshots logarithmically between the first and the last step, so most of them fall early in training"""
+    if spacing == 'linear':
+        return np.arange(0, total_steps, max(int(total_steps/n_snapshots), 1))
+    elif spacing == 'log':
+        return np.unique(np.geomspace(1, total_steps, n_snapshots).astype(int) - 1)
+    raise ValueError('unknown snapshot spacing: ' + str(spacing))
+
+class SnapshotStore():
+    """Records the parameters of a network (params_list_rec/params_list_gen of every layer), with the step index,
+    phase and each layer's rec_switch, at a fixed list of steps. Each parameter is stored in one preallocated (snapshot x shape) array; for
+    a network with a ParameterArena, these are views of one (snapshot x arena size) array, flat.
+    The store behaves like the list of networks it replaces: store[ii] rebuilds the network at snapshot ii
+    from one stored template, with its parameters as read-only views of the snapshot."""
+    def __init__(self, nn, steps):
+        self.steps = np.asarray(steps)
+        n_snapshots = len(self.steps)
+        self.template = deepcopy(nn)
+        self.arena = getattr(nn, 'arena', None)
+        if self.arena is None:
+            self.params_rec = [[np.zeros((n_snapshots,) + np.shape(param)) for param in layer.params_list_rec] for layer in nn.layer_list]
+            self.params_gen = [[np.zeros((n_snapshots,) + np.shape(param)) for param in layer.params_list_gen] for layer in nn.layer_list]
+        else:
+            #one copy of the arena per snapshot, so that recording is a single row copy. The per-parameter arrays
+            #are views of its columns
+            self.flat = np.zeros((n_snapshots, self.arena.size))
+            self.params_rec = [[] for layer in nn.layer_list]
+            self.params_gen = [[] for layer in nn.layer_list]
+            for ii, list_name, jj, name, offset, shape in self.arena.layout:
+                stored = self.flat[:, offset:offset + int(np.prod(shape))].reshape((n_snapshots,) + shape)
+                if list_name == 'params_list_rec':
+                    self.params_rec[ii].append(stored)
+                else:
+                    self.params_gen[ii].append(stored)
+        self.step = np.zeros((n_snapshots,), dtype = int)
+        self.phase = np.zeros((n_snapshots,), dtype = '<U10')
+        #whether each layer has just switched back to wake. A reset does not clear it, so the first step of a run on
+        #the snapshot depends on it
+        self.rec_switch = [np.zeros((n_snapshots,) + np.shape(layer.rec_switch), dtype = int) for layer in nn.layer_list]
+        self.count = 0
+        self.last = None #(index, network) of the most recent lookup
+        
+    def due(self, step):
+        """returns whether a snapshot is scheduled at step"""
+        return self.count < len(self.steps) and step == self.steps[self.count]
+        
+    def record(self, nn, step):
+        """copies the current parameters of nn into the next snapshot"""
+        if not(self.arena is None):
+            self.flat[self.count] = nn.arena.flat
+        else:
+            for layer, params_rec, params_gen in zip(nn.layer_list, self.params_rec, self.params_gen):
+                for param, stored in zip(layer.params_list_rec, params_rec):
+                    stored[self.count] = param
+                for param, stored in zip(layer.params_list_gen, params_gen):
+                    stored[self.count] = param
+        self.step[self.count] = step
+        self.phase[self.count] = nn.phase
+        for layer, rec_switch in zip(nn.layer_list, self.rec_switch):
+            rec_switch[self.count] = layer.rec_switch
+        self.count += 1
+        
+    def network(self, ii):
+        """rebuilds the network as it was at snapshot ii"""
+        nn = deepcopy(self.template)
+        if not(self.arena is None):
+            #run the network directly on the stored row
+            flat = self.flat[ii]
+            flat.flags.writeable = False
+            nn.arena.bind(nn.layer_list, flat)
+            self.restore_state(nn, ii)
+            return nn
+        for layer, params_rec, params_gen in zip(nn.layer_list, self.params_rec, self.params_gen):
+            views = {}
+            for params_list, stored_list in ((layer.params_list_rec, params_rec), (layer.params_list_gen, params_gen)):
+                for jj in range(0, len(params_list)):
+                    view = stored_list[jj][ii]
+                    view.flags.writeable = False
+                    views[id(params_list[jj])] = view
+                    params_list[jj] = view
+            for name, value in list(vars(layer).items()): #point the layer's named parameters at the same views
+                if id(value) in views:
+                    setattr(layer, name, views[id(value)])
+        self.restore_state(nn, ii)
+        return nn
+    
+    def restore_state(self, nn, ii):
+        """sets the phase and rec_switch of nn to those recorded at snapshot ii"""
+        if self.phase[ii] in ('wake', 'sleep', 'deep_sleep'):
+            nn.set_phase(self.phase[ii])
+        for layer, rec_switch in zip(nn.layer_list, self.rec_switch):
+            if np.ndim(layer.rec_switch) == 0:
+                layer.rec_switch = int(rec_switch[ii])
             else:
-                self.nn.continue_phase()
-                    
-#Define simulation
+                layer.rec_switch = rec_switch[ii].copy()
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self, ii):
+        """returns the network at snapshot ii. Repeated lookups of the same snapshot return the same network"""
+        if ii < 0:
+            ii += self.count
+        if not(0 <= ii < self.count):
+            raise IndexError('snapshot index out of range')
+        if self.last is None or self.last[0] != ii:
+            self.last = (ii, self.network(ii))
+        return self.last[1]
+    
+    def __iter__(self):
+        for ii in range(0, self.count):
+            yield self.network(ii)
+
+class GenerativeRun():
+    """One sequence drawn with network.sample, in place of the deep_sleep Simulation that used to produce it.
+    latent: hidden activities (sum(N_vec[1:]) x T), as in Simulation.latent
+    observations: generated inputs (N_vec[0] x T)
+    nn: the network the sequence was drawn from, as in Simulation.nn
+    Unlike a Simulation it holds no loss: the deep sleep loss needs the recognition pass, which sampling skips"""
+    def __init__(self, latent, observations, nn):
+        self.latent = latent
+        self.observations = observations
+        self.nn = nn
+
+class StepPlan():
+    """The per-step work of a Simulation, resolved once into flat references: the network's forward, the callables
+    that follow it (learning updates and parameter assignment, learning statistics, or phase scheduling) and the
+    layers whose activities are recorded with their latent slices"""
+    def __init__(self, sim):
+        self.forward = sim.nn.forward
+        updates = []
+        if sim.train:
+            updates = [sim.learn_alg.update_learning_vars, sim.learn_alg.compile_assign()]
+        elif sim.learning_stats:
+            for alg in sim.compare_algs:
+                updates += [partial(alg.update_learning_vars, record_stats = True), alg.update_learning_stats]
+        elif sim.phase_switch:
+            #inference only: advance the phase schedule without computing any gradients
+            if hasattr(sim.learn_alg, 'scheduler'):
+                updates = [sim.learn_alg.scheduler.step]
+            else:
+                updates = [sim.learn_alg.update_learning_vars]
+        self.updates = tuple(updates)
+        record = []
+        start = 0
+        for layer in sim.nn.layer_list[1::]:
+            record.append((layer, slice(start, start + layer.N)))
+            start += layer.N
+        self.record = tuple(record)
+        
 class Simulation():
-    def __init__(self, data, learn_alg, nn, train = True, compare_algs = [], epoch_num = 1, learning_stats = False, nn_record = False, phase_switch = False, starting_phase = 'wake'):
+    def __init__(self, data, learn_alg, nn, train = True, compare_algs = [], epoch_num = 1, learning_stats = False, nn_record = False, phase_switch = False, starting_phase = 'wake', seed = None,
+                 snapshot_num = 20, snapshot_spacing = 'linear', vectorized = False, loss_every = 1, loss_sample = None):
+        """seed: if given, all network noise for this run is drawn from a NoiseProvider with this seed.
+        Otherwise noise is drawn from the global np.random state, as before, and the run makes every draw the
+        step-by-step simulation makes (no phase kernels or vectorized evaluation, which skip unused draws).
+        nn_record: record the network parameters during the run in a SnapshotStore, nn_list, at snapshot_num steps
+        spaced according to snapshot_spacing (see snapshot_steps)
+        vectorized: if the run is a frozen, wake-only evaluation (train = False, no phase switching, learning stats or
+        nn_record), process the data in blocks with the network's forward_sequence instead of one step at a time.
+        The recognition noise is drawn in blocks, so the results match the step-by-step run. Needs a seed
+        loss_every: compute and record the loss only every loss_every steps
+        loss_sample: if given, compute and record the loss on this many randomly chosen steps instead
+        The returned loss then has one column per recorded step (listed in loss_steps). Both options are ignored,
+        and the loss is recorded every step, if a learning rule that computes updates during the run requires it"""
         self.data = data
         self.learn_alg = learn_alg
         self.compare_algs = compare_algs
@@ -719,25 +3073,92 @@ class Simulation():
         self.train = train
         self.learning_stats = learning_stats
         self.nn_record = nn_record
+        self.snapshot_num = snapshot_num
+        self.snapshot_spacing = snapshot_spacing
         self.epoch_num = epoch_num
         if nn_record:
             self.nn_list = []
         self.starting_phase = starting_phase
         self.phase_switch = phase_switch
+        self.seed = seed
+        self.vectorized = vectorized
+        self.loss_every = loss_every
+        self.loss_sample = loss_sample
+        self.loss_steps = None
+        
+    def frozen_wake_run(self):
+        """returns whether this run can be evaluated with forward_sequence"""
+        return (self.vectorized and not(self.seed is None) and not(self.train) and not(self.phase_switch) and not(self.learning_stats) and not(self.nn_record)
+                and self.starting_phase == 'wake' and hasattr(self.nn, 'forward_sequence'))
+        
+    def update_algs(self):
+        """returns the learning algorithms that compute updates during this run"""
+        if self.train:
+            return [self.learn_alg]
+        elif self.learning_stats:
+            return self.compare_algs
+        return []
+        
+    def phase_kernels_allowed(self):
+        """returns whether the network may run its phase-specialized kernels: only for pooled noise (a seeded run),
+        and if no learning rule that computes updates during this run needs both passes"""
+        return not(self.seed is None) and hasattr(self.nn, 'set_phase_kernels') and not(any([getattr(alg, 'needs_both_passes', True) for alg in self.update_algs()]))
+    
+    def loss_schedule(self, T):
+        """returns the steps of each epoch at which the loss is computed and recorded, or None for every step"""
+        if any([getattr(alg, 'requires_loss', True) for alg in self.update_algs()]):
+            return None
+        if not(self.loss_sample is None):
+            rng = np.random.default_rng(self.seed)
+            return np.sort(rng.choice(T, size = min(self.loss_sample, T), replace = False))
+        if self.loss_every > 1:
+            return np.arange(0, T, self.loss_every)
+        return None
+        
+    def data_chunks(self):
+        """iterates over the data in chunks along time. Arrays form a single chunk; a DataStream supplies its own chunks"""
+        if hasattr(self.data, 'chunks'):
+            return self.data.chunks()
+        return [self.data]
+    
     def run(self):
-        T = self.data.shape[1] #total time
-        if isinstance(self.nn, TwoLayeredHM):
-            latent = np.zeros((self.nn.l1.N + self.nn.l2.N, T))
-        elif isinstance(self.nn, LayeredHM):# or isinstance(self.nn, TwoLayeredHM):
-            latent = np.zeros((self.nn.l1.N, T))
-
-        loss = np.zeros((1,T))
-        report_period = int(T*self.epoch_num/10)
-        if report_period == 0:
-            1 + 1
-        nn_record_period = int(T*self.epoch_num/20)
-        report_percent = 0
+        if not(self.seed is None):
+            self.nn.set_noise(NoiseProvider(self.seed))
+        T = self.data.shape[-1] #total time
+        #latent and loss are recorded time-major (one contiguous row per step) and returned as (... x T) views
+        if isinstance(self.nn, EnsembleLayeredHM):
+            latent = np.zeros((T, self.nn.K, self.nn.n_hidden))
+        else:
+            latent = np.zeros((T, self.nn.n_hidden))
+
+        self.loss_steps = self.loss_schedule(T)
+        if self.loss_steps is None:
+            loss_mask = None
+            n_loss = T
+        else:
+            loss_mask = np.zeros((T,), dtype = bool)
+            loss_mask[self.loss_steps] = True
+            n_loss = len(self.loss_steps)
+        if isinstance(self.nn, EnsembleLayeredHM):
+            loss = np.zeros((n_loss, self.nn.K)) #one loss trace per member
+        else:
+            loss = np.zeros((n_loss, 1))
+        #progress is reported at block boundaries, roughly every 10% of the run
+        total_steps = T*self.epoch_num
+        report_period = max(int(total_steps/10), 1)
+        next_report = 0
+        if self.nn_record:
+            self.nn_list = SnapshotStore(self.nn, snapshot_steps(total_steps, self.snapshot_num, self.snapshot_spacing))
+            snapshots = [int(step) for step in self.nn_list.steps]
+        else:
+            snapshots = []
+        snapshots.append(-1) #sentinel
+        frozen_wake = self.frozen_wake_run()
+        phase_kernels = self.phase_kernels_allowed()
+        if phase_kernels:
+            self.nn.set_phase_kernels(True)
         t0 = time.time()
+        nn = self.nn
         self.nn.set_phase(self.starting_phase)
         for ee in range(0, self.epoch_num): #loop through data as many times as dictated by the # of epochs.
             self.nn.reset() #remove stored previous states from the network
@@ -746,39 +3167,55 @@ class Simulation():
                 self.learn_alg.reset_learning()
             for alg in self.compare_algs:
                 alg.reset_learning()
-            for tt in range(0,T):
-                if self.learning_stats:
-                    1+1
-                if np.mod(int(tt+ T*ee), report_period) == 0:
-                    print('Progress: ' + str(report_percent) + ' % complete')
-                    print('Total time: ' + str(time.time() - t0) + ' seconds')
-                    report_percent += 10
-                    
-                if self.nn_record and np.mod(tt + T*ee, nn_record_period) == 0:
-                    if self.nn_record:
-                        self.nn_list.append(deepcopy(self.nn))
-                # process one datum
-                self.nn.forward(self.data[:,tt])
-        
-                # update the learning variables/parameters
-                if self.train:
-                    self.learn_alg.update_learning_vars()
-                    self.learn_alg.assign_vars()
-                elif self.learning_stats:
-                    for alg in self.compare_algs:
-                        alg.update_learning_vars(record_stats = True)
-                        alg.update_learning_stats()
-                elif self.phase_switch:
-                    self.learn_alg.update_learning_vars()
-                
-                # keep record of neural activations and loss
-                if isinstance(self.nn, LayeredHM) or isinstance(self.nn, TwoLayeredHM):
-                    latent[:,tt] = np.hstack([layer.h for layer in self.nn.layer_list[1::]]) #store a concatenation of all neural activities in the network
-                    
-                loss[:,tt] = self.nn.loss_total
+            #resolve the per-step work once per epoch, after the learning variables have been reset
+            plan = StepPlan(self)
+            forward = plan.forward
+            updates = plan.updates
+            record = plan.record
+            next_snapshot = snapshots[self.nn_list.count] if self.nn_record else -1
+            tt = 0
+            ll = 0 #number of losses recorded in this epoch
+            for data_chunk in self.data_chunks():
+                for data_block in time_major_blocks(data_chunk):
+                    if tt + T*ee >= next_report:
+                        print('Progress: ' + str(int(100*(tt + T*ee)/total_steps)) + ' % complete')
+                        print('Total time: ' + str(time.time() - t0) + ' seconds')
+                        next_report = ((tt + T*ee)//report_period + 1)*report_period
+                    if frozen_wake:
+                        n = data_block.shape[0]
+                        latent[tt:tt + n], block_loss = self.nn.forward_sequence(data_block)
+                        if not(loss_mask is None):
+                            block_loss = block_loss[loss_mask[tt:tt + n]]
+                        loss[ll:ll + len(block_loss), 0] = block_loss
+                        tt += n
+                        ll += len(block_loss)
+                        continue
+                    for x in data_block:
+                        if tt + T*ee == next_snapshot:
+                            self.nn_list.record(nn, next_snapshot)
+                            next_snapshot = snapshots[self.nn_list.count]
+                        # process one datum
+                        compute_loss = loss_mask is None or loss_mask[tt]
+                        forward(x, compute_loss)
+                        # update the learning variables/parameters
+                        for update in updates:
+                            update()
+                        # keep record of neural activations and loss
+                        for layer, layer_slice in record: #store a concatenation of all neural activities in the network
+                            latent[tt,...,layer_slice] = layer.h
+                        if compute_loss:
+                            loss[ll] = nn.loss_total
+                            ll += 1
+                        tt += 1
         
+        latent = np.moveaxis(latent, 0, -1)
+        loss = np.moveaxis(loss, 0, -1)
         self.latent = latent
         self.loss = loss
+        if not(self.seed is None):
+            self.nn.set_noise(None)
+        if phase_kernels:
+            self.nn.set_phase_kernels(False)
         
         return latent, loss
 
@@ -803,8 +3240,13 @@ if __name__ == '__main__':
         n_digits = exp_params.n_digits
         data_train, data_latent_train = Vocal_Digits(n_sample, n_digits, hpc = not(exp_params.local))
         data_test, data_latent_test = Vocal_Digits(n_sample, n_digits, hpc = not(exp_params.local), test = True)
+    elif not(exp_params.data_seed is None):
+        mixing_matrix, data_train, data_latent_train, data_test, data_latent_test = simulated_dataset(n_latent, n_in, n_out, n_sample, n_test, dt, exp_params.data_seed)
+    elif exp_params.legacy_data:
+        data_train, data_latent_train = simulate_data(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01, legacy = True)
+        data_test, data_latent_test = simulate_data(n_latent, n_out, n_test, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01, legacy = True)
     else:
-        data_train, data_latent_train = simulate_data(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01)
+        data_train = DataStream(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01) #generated in chunks as training consumes it
         data_test, data_latent_test = simulate_data(n_latent, n_out, n_test, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01)
     
     
@@ -813,7 +3255,7 @@ if __name__ == '__main__':
     nonlinearity = tanh
     W_out = np.random.normal(loc = 0, scale = 1/n_neurons, size = (n_in, n_neurons))
     W_in = np.random.normal(loc = 0, scale = 1/n_in, size = (n_neurons, n_in))
-    transition_mat = 0.6 * np.eye(n_neurons)
+    transition_mat = 0.6 * np.ones((n_neurons,)) #diagonal of the top-layer transition matrix
     sigma_latent = exp_params.sigma_latent
     sigma_obs_gen = exp_params.sigma_obs_gen
     if exp_params.mode in ('MNIST', 'Vocal_Digits'):
@@ -822,17 +3264,47 @@ if __name__ == '__main__':
         sigma_latent_gen = sigma_latent_data
     
     #network = HelmholtzMachine(n_neurons, n_in, W_in, sigma_latent, W_out, transition_mat, sigma_obs_gen, sigma_latent_gen, nonlinearity)
-    if exp_params.mode in ('standard', 'MNIST', 'time_constant', 'switch_period', 'dimensionality', 'lr_optim', 'SNR', 'sinusoid'):
-        network = LayeredHM([n_in, n_neurons], [sigma_obs_gen, sigma_latent_gen], [exp_params.sigma_in, sigma_latent])
+    ensemble_sweep = exp_params.mode == 'lr_optim' and exp_params.ensemble_sweep and exp_params.algorithm == 'wake_sleep'
+    if ensemble_sweep:
+        #one row per (learning rate, replica): the 4-2 networks are too small for a single run to use the CPU.
+        #Every row starts from the network a single task builds from the seeded state, so that the rows differ only
+        #in their learning rate (and their noise); the ensemble's own initial weights are overwritten
+        learning_rate_sweep = np.repeat(exp_params.learning_rate_sweep, exp_params.replicas)
+        initial_network = LayeredHM([n_in, n_neurons], [sigma_obs_gen, sigma_latent_gen], [exp_params.sigma_in, sigma_latent])
+        network = EnsembleLayeredHM([n_in, n_neurons], [sigma_obs_gen, sigma_latent_gen], [exp_params.sigma_in, sigma_latent], len(learning_rate_sweep), fused = exp_params.fused, arena = exp_params.arena,
+                                    rng = np.random.default_rng(0))
+        network.copy_network(initial_network)
+    elif exp_params.mode in ('standard', 'MNIST', 'time_constant', 'switch_period', 'dimensionality', 'lr_optim', 'SNR', 'sinusoid'):
+        network = LayeredHM([n_in, n_neurons], [sigma_obs_gen, sigma_latent_gen], [exp_params.sigma_in, sigma_latent], fused = exp_params.fused, stacked = exp_params.stacked, arena = exp_params.arena)
         #network = RandomLayeredHM([n_in, n_neurons], [sigma_obs_gen, sigma_latent_gen], [0, sigma_latent])
     elif exp_params.mode == ('Vocal_Digits'):
-        network = TwoLayeredHM([n_in, n_neurons, 40], [sigma_obs_gen, sigma_obs_gen, sigma_latent_gen], [exp_params.sigma_in, sigma_latent, sigma_latent])
+        N_vec = [n_in] + list(exp_params.hidden_layers)
+        n_hidden_layers = len(N_vec) - 1
+        network = DeepHM(N_vec, [sigma_obs_gen]*n_hidden_layers + [sigma_latent_gen], [exp_params.sigma_in] + [sigma_latent]*n_hidden_layers, fused = exp_params.fused, stacked = exp_params.stacked, arena = exp_params.arena)
     #build the learning algorithm
     learning_rate = exp_params.learning_rate
     switch_period = exp_params.switch_period
-    learn_alg = set_learn_alg(network, learning_rate, switch_period)
+    if ensemble_sweep:
+        learn_alg = EnsembleImpression(network, learning_rate_sweep, switch_period)
+    else:
+        learn_alg = set_learn_alg(network, learning_rate, switch_period)
     
-    if exp_params.mode in ('standard', 'MNIST', 'time_constant', 'switch_period', 'dimensionality', 'lr_optim', 'Vocal_Digits', 'sinusoid'):
+    if ensemble_sweep:
+        #run the training simulation
+        sim = Simulation(data_train, learn_alg, network, train = True, epoch_num = exp_params.epoch_num, learning_stats = False, nn_record = True, starting_phase = 'wake')
+        latent_train, loss = sim.run()
+        
+        #run the test simulation, with one mean loss per member at each snapshot
+        loss_mean = np.zeros((len(sim.nn_list), network.K))
+        counter = 0
+        for nn in sim.nn_list:
+            learn_alg_test = EnsembleImpression(nn, learning_rate_sweep, switch_period)
+            test_sim = Simulation(data_test, learn_alg_test, nn, train = False, phase_switch = True)
+            latent_test, loss_test = test_sim.run()
+            loss_mean[counter] = np.mean(loss_test, axis = -1)
+            counter = counter + 1
+        
+    elif exp_params.mode in ('standard', 'MNIST', 'time_constant', 'switch_period', 'dimensionality', 'lr_optim', 'Vocal_Digits', 'sinusoid'):
         #run the training simulation
         sim = Simulation(data_train, learn_alg, network, train = True, epoch_num = exp_params.epoch_num, learning_stats = False, nn_record = True, starting_phase = 'wake')
         latent_train, loss = sim.run()
@@ -846,30 +3318,26 @@ if __name__ == '__main__':
                 phase_switch = False
             else:
                 phase_switch = True
-            test_sim = Simulation(data_test, learn_alg_test, nn, train = False, phase_switch = phase_switch)
+            test_sim = Simulation(data_test, learn_alg_test, nn, train = False, phase_switch = phase_switch, vectorized = True)
             latent_test, loss_test = test_sim.run()
             loss_mean[counter] = np.mean(loss_test)
             counter = counter + 1
         
         #run the generative simulation
         if (not(exp_params.mode == 'MNIST')):
-            gen_sim = Simulation(data_test, learn_alg, network, train = False, starting_phase = 'deep_sleep')
-            latent_gen, loss_gen = gen_sim.run()
+            latent_gen, observations_gen = network.sample(data_test.shape[1])
+            gen_sim = GenerativeRun(latent_gen[0], observations_gen[0], network)
+            latent_gen = gen_sim.latent
         else:
-            gen_sim = []
-            for ii in range(0, exp_params.gen_sim_num):
-                gen_sim_temp = Simulation(data_test[:,0:50], learn_alg, network, train = False, starting_phase = 'deep_sleep')
-                _,_ = gen_sim_temp.run()
-                gen_sim.append(deepcopy(gen_sim_temp))
+            latent_gen, observations_gen = network.sample(50, exp_params.gen_sim_num)
+            gen_sim = [GenerativeRun(latent_gen[ii], observations_gen[ii], network) for ii in range(0, exp_params.gen_sim_num)]
         
         
         #get a short test sequence for comparing wake/sleep alternation to just wake
-        np.random.seed(1111)
-        wake_sequence = Simulation(data_test, learn_alg, network, train = False)
+        wake_sequence = Simulation(data_test, learn_alg, network, train = False, seed = noise_seed(1111), vectorized = True)
         _,_ = wake_sequence.run()
         
-        np.random.seed(1111)
-        wake_sleep_sequence = Simulation(data_test, learn_alg, network, train = False, phase_switch = True)
+        wake_sleep_sequence = Simulation(data_test, learn_alg, network, train = False, phase_switch = True, seed = noise_seed(1111))
         _,_ = wake_sleep_sequence.run()
         
         
@@ -878,10 +3346,10 @@ if __name__ == '__main__':
         sim = Simulation(data_train, learn_alg, network, train = True, learning_stats = False, nn_record = True)
         latent_train, loss = sim.run()
         
-        test_sim = Simulation(data_test, learn_alg, network, train = False)
+        test_sim = Simulation(data_test, learn_alg, network, train = False, vectorized = True)
         latent_test, loss_test = test_sim.run()
         
-        data_compare, data_latent_compare = simulate_data(n_latent, n_out, exp_params.n_compare, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01)
+        data_compare, data_latent_compare = simulate_data(n_latent, n_out, exp_params.n_compare, mixing_matrix, transition_matrix, sigma_latent = sigma_latent_data, sigma_out = 0.01, legacy = exp_params.legacy_data)
         #run a test simulation for each network frozen at a point during training time
         #compare the weight updates given by different learning algorithms
         mean_ws = []
@@ -903,28 +3371,25 @@ if __name__ == '__main__':
             latent_test, loss_test = test_sim.run()
             loss_mean[counter] = np.mean(loss_test)
             
-            learn_alg_ws = LayeredImpression(nn, learning_rate, switch_period)
-            learn_alg_reinforce = LayeredAlternatingREINFORCE(nn, learning_rate, switch_period, decay = 1)
-            
-            compare_algs_ws = [learn_alg_ws]
-            comparison_sim = Simulation(data_compare, None, nn, epoch_num = exp_params.epoch_num_snr, train = False, compare_algs = compare_algs_ws, learning_stats = True)
-            np.random.seed(120994)
-            _,_ = comparison_sim.run()
-            mean, var, snr = learn_alg_ws.get_learning_stats()
+            #the updates of each algorithm over epoch_num_snr short episodes on data_compare (see update_snr)
+            mean, var, snr = update_snr(nn, LayeredImpression, data_compare, learning_rate, switch_period)
             mean_ws.append(mean)
             var_ws.append(var)
             snr_ws.append(snr)
             
-            compare_algs_reinforce = [learn_alg_reinforce]
-            comparison_sim = Simulation(data_compare, None, nn, epoch_num = exp_params.epoch_num_snr, train = False, compare_algs = compare_algs_reinforce, learning_stats = True)
-            np.random.seed(120994)
-            _,_ = comparison_sim.run()
-            
-            mean, var, snr = learn_alg_reinforce.get_learning_stats()
+            #the REINFORCE statistics depend on the traces built up over the whole run, so its episodes are always
+            #simulated one after another
+            mean, var, snr = update_snr(nn, LayeredAlternatingREINFORCE, data_compare, learning_rate, switch_period, decay = 1, batch_size = 1)
             mean_reinforce.append(mean)
             var_reinforce.append(var)
             snr_reinforce.append(snr)
-            
+
+            if exp_params.backprop_snr:
+                mean, var, snr = update_snr(nn, Backpropagation, data_compare, learning_rate, switch_period)
+                mean_backprop.append(mean)
+                var_backprop.append(var)
+                snr_backprop.append(snr)
+
             counter = counter + 1
 #%% Save
     if exp_params.save:
@@ -961,11 +3426,26 @@ if __name__ == '__main__':
             result = {'loss_mean': loss_mean}
             filename = '/impression_lr_'
         #save the whole dictionary
-        if exp_params.local:
-            save_path = os.getcwd() + 'impression_data' + str(array_num)
+        if ensemble_sweep:
+            #one file per learning rate, with loss_mean averaged over the replicas. The noise differs from the
+            #single-task runs, so the files are named apart from theirs
+            loss_mean_replicas = np.reshape(loss_mean, (loss_mean.shape[0], len(exp_params.learning_rate_sweep), exp_params.replicas))
+            for ii in range(0, len(exp_params.learning_rate_sweep)):
+                result = {'loss_mean': np.mean(loss_mean_replicas[:, ii], axis = -1),
+                          'loss_mean_replicas': loss_mean_replicas[:, ii],
+                          'learning_rate': exp_params.learning_rate_sweep[ii]}
+                if exp_params.local:
+                    save_path = os.getcwd() + 'impression_data_sweep' + str(ii + 1)
+                else:
+                    save_path = os.getcwd() + filename + 'sweep_' + str(ii + 1)
+                with open(save_path, 'wb') as f:
+                    pickle.dump(result, f)
         else:
-            save_path = os.getcwd() + filename + str(array_num)
-        with open(save_path, 'wb') as f:
-            pickle.dump(result, f)
+            if exp_params.local:
+                save_path = os.getcwd() + 'impression_data' + str(array_num)
+            else:
+                save_path = os.getcwd() + filename + str(array_num)
+            with open(save_path, 'wb') as f:
+                pickle.dump(result, f)
     
     
\ No newline at end of file
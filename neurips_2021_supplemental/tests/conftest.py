@@ -0,0 +1,12 @@
+"""Shared setup for the regression checks: makes the modules in neurips_2021_supplemental importable and selects
+the tanh nonlinearity that the experiments use. Run with pytest tests"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+import impression_learning as il
+il.nonlinearity = il.tanh
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path)
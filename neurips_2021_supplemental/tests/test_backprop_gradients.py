@@ -0,0 +1,62 @@
+"""Regression check: the updates of Backpropagation are the finite-difference gradients of the step's loss, scaled
+by -sigma_min**2/2 (sigma_min: the smallest noise of the phase)"""
+from copy import deepcopy
+import numpy as np
+import impression_learning as il
+
+def step_loss(net, x):
+    #the loss of one step, with the same noise every time
+    net.set_noise(il.NoiseProvider(7))
+    net.forward(x)
+    return net.loss_total
+
+def check_gradients(N_vec, phase, rec_switch = 0, fused = False, diagonal_transition = True, eps = 1e-6):
+    np.random.seed(0)
+    sigma_gen = list(np.random.uniform(0.05, 0.3, len(N_vec)))
+    sigma_rec = list(np.random.uniform(0.05, 0.3, len(N_vec)))
+    net = il.DeepHM(N_vec, sigma_gen, sigma_rec, fused = fused, diagonal_transition = diagonal_transition)
+    for layer in net.layer_list:
+        for param in layer.params_list_rec + layer.params_list_gen:
+            param += np.random.normal(scale = 0.3, size = np.shape(param))
+    #a few steps, so that the previous states are not zero
+    net.reset()
+    net.set_noise(il.NoiseProvider(1))
+    for tt in range(0, 5):
+        net.forward(np.random.normal(size = (N_vec[0],)))
+    net.set_phase(phase)
+    for layer in net.layer_list:
+        layer.rec_switch = rec_switch
+    x = np.random.normal(size = (N_vec[0],))
+
+    stepped = deepcopy(net)
+    step_loss(stepped, x)
+    backprop = il.Backpropagation(stepped, 1e-3, 0)
+    backprop.update_learning_vars(record_stats = True)
+    sigma_min = min(sigma_gen) if phase == 'wake' else min(sigma_rec)
+    for ii in range(0, len(N_vec)):
+        for kind in ('rec', 'gen'):
+            for jj, update in enumerate(getattr(backprop, 'update_list_' + kind)[ii]):
+                if isinstance(update, il.Rank1Update):
+                    update = update.dense()
+                perturbed = deepcopy(net)
+                param = getattr(perturbed.layer_list[ii], 'params_list_' + kind)[jj]
+                grad = np.zeros(np.shape(param))
+                for idx in np.ndindex(np.shape(param)):
+                    param[idx] += eps
+                    loss_plus = step_loss(deepcopy(perturbed), x)
+                    param[idx] -= 2*eps
+                    loss_minus = step_loss(deepcopy(perturbed), x)
+                    param[idx] += eps
+                    grad[idx] = (loss_plus - loss_minus)/(2*eps)
+                expected = -sigma_min**2/2 * grad
+                update = np.broadcast_to(np.asarray(update, dtype = float), expected.shape)
+                assert np.allclose(update, expected, rtol = 1e-5, atol = 1e-7 * max(np.abs(expected).max(), 1)), (N_vec, phase, rec_switch, ii, kind, jj)
+
+def test_backprop_gradients(monkeypatch):
+    monkeypatch.setattr(il.exp_params, 'recognition_scale', 1)
+    for fused in (False, True):
+        for N_vec in ([4, 2], [5, 4, 3]):
+            for phase, rec_switch in (('wake', 0), ('wake', 1), ('sleep', 0)):
+                check_gradients(N_vec, phase, rec_switch, fused)
+        check_gradients([5, 4, 3], 'wake', fused = fused, diagonal_transition = False)
+        check_gradients([5, 4, 3], 'sleep', fused = fused, diagonal_transition = False)
@@ -0,0 +1,37 @@
+"""Regression check: the chunked data generator follows the latent recursion of the original loop, and a DataStream
+replays the same data on every pass"""
+import numpy as np
+import impression_learning as il
+
+def loop_data(latent_noise, mixing_matrix, transition_matrix):
+    #the recursion of the original simulate_data, with every latent dimension starting from its noise
+    latent = np.zeros(latent_noise.shape)
+    latent[:,0] = latent_noise[:,0]
+    for ii in range(1, latent_noise.shape[1]):
+        latent[:,ii] = transition_matrix @ latent[:,ii-1] + latent_noise[:,ii]
+    return mixing_matrix @ latent, latent
+
+def test_chunks_match_loop():
+    n_latent, n_out, n_sample, chunk_size = 3, 5, 1000, 128
+    rng = np.random.default_rng(0)
+    mixing_matrix = rng.normal(size = (n_out, n_latent))
+    transition_matrices = (np.diag([0.9, 0.5, -0.3]), 0.99 * np.eye(n_latent), 0.5 * np.eye(n_latent) + 0.1 * rng.normal(size = (n_latent, n_latent)))
+    for transition_matrix in transition_matrices:
+        data, latent = il.simulate_data(n_latent, n_out, n_sample, mixing_matrix, transition_matrix, sigma_latent = 0.3, chunk_size = chunk_size,
+                                        rng = np.random.default_rng(1))
+        #the noise is drawn one chunk at a time
+        noise_rng = np.random.default_rng(1)
+        latent_noise = np.concatenate([noise_rng.normal(scale = 0.3, size = (n_latent, min(chunk_size, n_sample - start))) for start in range(0, n_sample, chunk_size)], axis = 1)
+        data_loop, latent_loop = loop_data(latent_noise, mixing_matrix, transition_matrix)
+        assert np.allclose(latent, latent_loop, rtol = 1e-10, atol = 1e-12)
+        assert np.allclose(data, data_loop, rtol = 1e-10, atol = 1e-12)
+
+def test_data_stream_replays():
+    rng = np.random.default_rng(0)
+    mixing_matrix = rng.normal(size = (4, 2))
+    stream = il.DataStream(2, 4, 700, mixing_matrix, 0.9 * np.eye(2), sigma_latent = 0.3, chunk_size = 256, seed = 3)
+    first = np.concatenate(list(stream.chunks()), axis = 1)
+    second = np.concatenate(list(stream.chunks()), axis = 1)
+    data = il.simulate_data(2, 4, 700, mixing_matrix, 0.9 * np.eye(2), sigma_latent = 0.3, chunk_size = 256, rng = np.random.default_rng(3))[0]
+    assert first.shape == (4, 700)
+    assert np.array_equal(first, second) and np.array_equal(first, data)
@@ -0,0 +1,52 @@
+"""Regression check: datasets written through il_data_cache read back unchanged, are built only once, and a failed
+build leaves nothing behind"""
+import os
+import numpy as np
+import il_data_cache
+import impression_learning as il
+
+def test_round_trip(directory):
+    built = []
+
+    def build(create):
+        built.append(True)
+        create('a', (5, 3))[...] = np.arange(15).reshape((5, 3))
+        create('b', (4,), dtype = np.int64)[...] = [1, 2, 3, 4]
+
+    for kk in range(0, 2):
+        a, b = il_data_cache.load_dataset('key', ('a', 'b'), build, directory)
+        assert np.array_equal(a, np.arange(15).reshape((5, 3))) and a.dtype == np.float64
+        assert np.array_equal(b, [1, 2, 3, 4]) and b.dtype == np.int64
+        assert not(a.flags.writeable)
+    assert len(built) == 1
+    assert sorted(os.listdir(os.path.join(directory, 'key'))) == ['a.npy', 'b.npy']
+
+def test_failed_build_leaves_no_files(directory):
+    def build(create):
+        create('a', (5,))[...] = 1
+        raise RuntimeError('build failed')
+
+    try:
+        il_data_cache.load_dataset('key', ('a',), build, directory)
+        assert False, 'the build error was swallowed'
+    except RuntimeError:
+        pass
+    assert os.listdir(os.path.join(directory, 'key')) == []
+
+def test_dataset_key():
+    key = il_data_cache.dataset_key('generator', 1, n = 10, dt = np.float64(0.1))
+    assert key == il_data_cache.dataset_key('generator', 1, dt = 0.1, n = 10)
+    assert key != il_data_cache.dataset_key('generator', 2, n = 10, dt = 0.1)
+    assert key != il_data_cache.dataset_key('generator', 1, n = 11, dt = 0.1)
+
+def test_simulated_dataset(directory, monkeypatch):
+    monkeypatch.setattr(il_data_cache, 'cache_dir', directory)
+    first = il.simulated_dataset(3, 4, 4, 500, 200, 0.1, seed = 7, chunk_size = 128)
+    second = il.simulated_dataset(3, 4, 4, 500, 200, 0.1, seed = 7, chunk_size = 128)
+    mixing_matrix, data_train, latent_train, data_test, latent_test = first
+    assert mixing_matrix.shape == (4, 3)
+    assert data_train.shape == (4, 500) and latent_train.shape == (3, 500)
+    assert data_test.shape == (4, 200) and latent_test.shape == (3, 200)
+    assert np.allclose(data_train, mixing_matrix @ latent_train)
+    for a, b in zip(first, second):
+        assert np.array_equal(a, b)
@@ -0,0 +1,26 @@
+"""Regression check: a one-member EnsembleLayeredHM trained with EnsembleImpression reproduces a single network
+trained with LayeredImpression"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def test_single_member_ensemble():
+    for N_vec in ([6, 3], [8, 5, 3]):
+        sigma = [0.01]*len(N_vec)
+        np.random.seed(0)
+        data = np.random.normal(size = (N_vec[0], 1000)) * 0.3
+        net = il.DeepHM(N_vec, sigma, sigma)
+        ens = il.EnsembleLayeredHM(N_vec, sigma, sigma, 1)
+        ens.copy_network(net)
+        with contextlib.redirect_stdout(io.StringIO()):
+            np.random.seed(5)
+            latent, loss = il.Simulation(data, il.LayeredImpression(net, 1e-3, 1), net).run()
+            np.random.seed(5)
+            latent_ens, loss_ens = il.Simulation(data, il.EnsembleImpression(ens, 1e-3, 1), ens).run()
+        assert latent_ens.shape == (1,) + latent.shape
+        assert np.allclose(latent_ens[0], latent, rtol = 0, atol = 1e-10)
+        assert np.allclose(loss_ens, loss, rtol = 1e-10, atol = 1e-10)
+        for layer, member_layer in zip(net.layer_list, ens.layer_list):
+            for param, member_param in zip(layer.params_list_rec + layer.params_list_gen, member_layer.params_list_rec + member_layer.params_list_gen):
+                assert np.allclose(member_param[0], param, rtol = 0, atol = 1e-12)
@@ -0,0 +1,34 @@
+"""Regression check: the fused layers and the parameter arena give the same training run as the original layers,
+and stacked fused layers agree up to rounding"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def train(N_vec, algorithm, **network_kwargs):
+    #returns the latents, loss and final parameters of a short seeded training run
+    sigma = [0.01]*len(N_vec)
+    np.random.seed(0)
+    data = np.random.normal(size = (N_vec[0], 1500)) * 0.3
+    net = il.DeepHM(N_vec, sigma, sigma, **network_kwargs)
+    if algorithm == 'wake_sleep':
+        learn_alg = il.LayeredImpression(net, 1e-3, 1)
+    else:
+        learn_alg = il.LayeredAlternatingREINFORCE(net, 1e-9, 1, decay = 0.9)
+    with contextlib.redirect_stdout(io.StringIO()):
+        latent, loss = il.Simulation(data, learn_alg, net, seed = 1).run()
+    return [latent, loss] + [param.copy() for layer in net.layer_list for param in layer.params_list_rec + layer.params_list_gen]
+
+def test_fused_and_arena_match():
+    for N_vec in ([6, 3], [8, 5, 3]):
+        for algorithm in ('wake_sleep', 'reinforce'):
+            reference = train(N_vec, algorithm)
+            for network_kwargs in ({'fused': True}, {'arena': True}, {'fused': True, 'arena': True}):
+                for a, b in zip(reference, train(N_vec, algorithm, **network_kwargs)):
+                    assert np.array_equal(a, b), (N_vec, algorithm, network_kwargs)
+
+def test_stacked_matches_up_to_rounding():
+    for algorithm in ('wake_sleep', 'reinforce'):
+        reference = train([8, 5, 3], algorithm)
+        for a, b in zip(reference, train([8, 5, 3], algorithm, fused = True, stacked = True)):
+            assert np.allclose(a, b, rtol = 1e-8, atol = 1e-10), algorithm
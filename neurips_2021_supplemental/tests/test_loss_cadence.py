@@ -0,0 +1,33 @@
+"""Regression check: with loss_every or loss_sample, a Simulation records the full run's loss at the chosen steps
+and otherwise runs exactly as before"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def run(loss_kwargs, seed, **network_kwargs):
+    #returns the latents, loss, loss steps and final parameters of a short training run
+    np.random.seed(0)
+    data = np.random.normal(size = (6, 800)) * 0.3
+    nn = il.DeepHM([6, 4, 2], [0.01]*3, [0.01]*3, **network_kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        np.random.seed(5)
+        sim = il.Simulation(data, il.LayeredImpression(nn, 1e-3, 1), nn, epoch_num = 2, seed = seed, **loss_kwargs)
+        latent, loss = sim.run()
+    return latent, loss, sim.loss_steps, [param.copy() for layer in nn.layer_list for param in layer.params_list_rec + layer.params_list_gen]
+
+def test_loss_cadence():
+    for seed in (None, 1):
+        for network_kwargs in ({}, {'fused': True}):
+            latent, loss, loss_steps, params = run({}, seed, **network_kwargs)
+            assert loss_steps is None and loss.shape == (1, 800)
+            for loss_kwargs in ({'loss_every': 7}, {'loss_sample': 50}):
+                latent_c, loss_c, loss_steps_c, params_c = run(loss_kwargs, seed, **network_kwargs)
+                if 'loss_every' in loss_kwargs:
+                    assert np.array_equal(loss_steps_c, np.arange(0, 800, 7))
+                else:
+                    assert len(loss_steps_c) == 50 and len(np.unique(loss_steps_c)) == 50
+                assert np.array_equal(latent_c, latent)
+                assert np.array_equal(loss_c, loss[:, loss_steps_c])
+                for a, b in zip(params_c, params):
+                    assert np.array_equal(a, b)
@@ -0,0 +1,61 @@
+"""Regression check: MomentAccumulator gives the moments of the whole stream, whether updated one array at a time,
+in batches, or in shards that are merged, and so do the learning statistics of a learning algorithm recorded in
+two halves"""
+import pickle
+import numpy as np
+import impression_learning as il
+
+def test_welford_matches_batch_moments():
+    rng = np.random.default_rng(0)
+    #a large offset, where the naive E[x^2] - E[x]^2 loses all precision
+    X = 1e3 + rng.normal(size = (4000, 3, 4)) * 1e-3
+    moments = il.MomentAccumulator((3, 4))
+    for x in X:
+        moments.update(x)
+    assert moments.n == X.shape[0]
+    assert np.allclose(moments.mean, X.mean(axis = 0), rtol = 1e-14, atol = 0)
+    assert np.allclose(moments.variance(), X.var(axis = 0), rtol = 1e-8, atol = 0)
+
+    #shards, some updated one array at a time and some in batches, merged after a round trip through pickle
+    merged = il.MomentAccumulator((3, 4))
+    for kk, shard in enumerate(np.array_split(X, 5)):
+        part = il.MomentAccumulator((3, 4))
+        if kk % 2 == 0:
+            for x in shard:
+                part.update(x)
+        else:
+            part.update_batch(shard)
+        merged.merge(pickle.loads(pickle.dumps(part)))
+    merged.merge(il.MomentAccumulator((3, 4))) #an empty shard changes nothing
+    assert merged.n == X.shape[0]
+    assert np.allclose(merged.mean, moments.mean, rtol = 1e-14, atol = 0)
+    assert np.allclose(merged.m2, moments.m2, rtol = 1e-8, atol = 0)
+
+def test_learning_stats_merge():
+    #synthetic recognition updates, recorded in one stream, and in two halves (one a batch) that are merged
+    for arena in (False, True):
+        np.random.seed(2)
+        net = il.DeepHM([6, 4, 2], [0.01]*3, [0.01]*3, arena = arena)
+        rng = np.random.default_rng(3)
+        updates = [[[rng.normal(size = np.shape(param)) for param in layer.params_list_rec] for layer in net.layer_list] for tt in range(0, 400)]
+        whole = il.LayeredImpression(net, 1e-3, 1)
+        first = il.LayeredImpression(net, 1e-3, 1)
+        second = il.LayeredImpression(net, 1e-3, 1)
+        for tt, update_list_rec in enumerate(updates):
+            whole.update_list_rec = update_list_rec
+            whole.update_learning_stats()
+            if tt < 150:
+                first.update_list_rec = update_list_rec
+                first.update_learning_stats()
+        stacked = [[np.stack([update_list_rec[ii][jj] for update_list_rec in updates[150:]]) for jj in range(0, len(updates[0][ii]))] for ii in range(0, len(updates[0]))]
+        second.update_learning_stats_batch(stacked, len(updates) - 150)
+        first.merge_learning_stats(second.moments)
+        assert first.N_prev == whole.N_prev == len(updates)
+        mean, var, snr = first.get_learning_stats()
+        mean_whole, var_whole, snr_whole = whole.get_learning_stats()
+        for ii in range(0, len(updates[0])):
+            for jj in range(0, len(updates[0][ii])):
+                U = np.stack([update_list_rec[ii][jj] for update_list_rec in updates])
+                for stats, stats_whole, expected in ((mean, mean_whole, U.mean(axis = 0)), (var, var_whole, U.var(axis = 0))):
+                    assert np.allclose(stats_whole[ii][jj], expected, rtol = 1e-10, atol = 1e-12)
+                    assert np.allclose(stats[ii][jj], expected, rtol = 1e-10, atol = 1e-12)
@@ -0,0 +1,29 @@
+"""Regression check: network.sample draws the sequence a deep_sleep Simulation generates from the same noise"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def test_sample_matches_deep_sleep_run():
+    T = 300
+    for N_vec in ([4, 2], [6, 4, 2]):
+        for network_kwargs in ({}, {'fused': True}):
+            np.random.seed(0)
+            nn = il.DeepHM(N_vec, [0.05]*len(N_vec), [0.05]*len(N_vec), **network_kwargs)
+            data = np.zeros((N_vec[0], T))
+            with contextlib.redirect_stdout(io.StringIO()):
+                latent, loss = il.Simulation(data, il.LayeredImpression(nn, 1e-3, 1), nn, train = False, seed = 3, starting_phase = 'deep_sleep').run()
+            #the generated observations, which the Simulation does not record
+            nn.set_noise(il.NoiseProvider(3))
+            nn.set_phase('deep_sleep')
+            nn.reset()
+            observations = np.zeros((N_vec[0], T))
+            for tt in range(0, T):
+                nn.forward(data[:, tt])
+                observations[:, tt] = nn.l0.h_gen
+            nn.set_noise(il.NoiseProvider(3))
+            latent_sample, observations_sample = nn.sample(T)
+            nn.set_noise(None)
+            assert latent_sample.shape == (1,) + latent.shape and observations_sample.shape == (1, N_vec[0], T)
+            assert np.allclose(latent_sample[0], latent, rtol = 1e-10, atol = 1e-12), (N_vec, network_kwargs)
+            assert np.allclose(observations_sample[0], observations, rtol = 1e-10, atol = 1e-12), (N_vec, network_kwargs)
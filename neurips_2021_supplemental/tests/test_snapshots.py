@@ -0,0 +1,35 @@
+"""Regression check: the networks a SnapshotStore rebuilds run exactly like deepcopies of the network taken at the
+same steps, which is how the snapshots were kept before"""
+import io
+import contextlib
+from copy import deepcopy
+import numpy as np
+import impression_learning as il
+
+def test_snapshots_match_deepcopies(monkeypatch):
+    copies = []
+    record = il.SnapshotStore.record
+
+    def record_and_copy(store, nn, step):
+        copies.append(deepcopy(nn))
+        record(store, nn, step)
+
+    monkeypatch.setattr(il.SnapshotStore, 'record', record_and_copy)
+    np.random.seed(0)
+    data = np.random.normal(size = (6, 400)) * 0.3
+    data_test = np.random.normal(size = (6, 100)) * 0.3
+    for network_kwargs in ({}, {'fused': True}, {'arena': True}):
+        del copies[:]
+        nn = il.DeepHM([6, 4, 2], [0.01]*3, [0.01]*3, **network_kwargs)
+        with contextlib.redirect_stdout(io.StringIO()):
+            #the phase switches every step, so at each snapshot after the first every layer has just switched back
+            #to wake
+            sim = il.Simulation(data, il.LayeredImpression(nn, 1e-3, 1), nn, nn_record = True, snapshot_num = 4, seed = 1)
+            sim.run()
+            assert len(sim.nn_list) == len(copies)
+            for snapshot, copy in zip(sim.nn_list, copies):
+                runs = []
+                for test_nn in (snapshot, copy):
+                    test_sim = il.Simulation(data_test, il.LayeredImpression(test_nn, 1e-3, 1), test_nn, train = False, phase_switch = True, seed = 2)
+                    runs.append(test_sim.run())
+                assert np.array_equal(runs[0][0], runs[1][0]) and np.array_equal(runs[0][1], runs[1][1]), network_kwargs
@@ -0,0 +1,44 @@
+"""Regression check: the SNR estimates of SNREstimator and update_snr agree with the learning_stats Simulation of
+the original SNR mode"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def make_problem():
+    np.random.seed(0)
+    mixing = np.random.normal(scale = 0.5, size = (4, 2))
+    data = il.simulate_data(2, 4, 4, mixing, 0.91*np.eye(2), sigma_latent = 0.3)[0]
+    nn = il.DeepHM([4, 2], [0.01]*2, [0.01]*2)
+    return data, nn
+
+def simulation_stats(nn, learn_alg, data, epoch_num):
+    #the SNR mode of the original code
+    with contextlib.redirect_stdout(io.StringIO()):
+        il.Simulation(data, None, nn, epoch_num = epoch_num, train = False, compare_algs = [learn_alg], learning_stats = True, seed = 120994).run()
+    return learn_alg.get_learning_stats()
+
+def assert_stats_close(stats, stats_ref, rtol):
+    for moment, moment_ref in zip(stats, stats_ref):
+        for layer, layer_ref in zip(moment, moment_ref):
+            for param, param_ref in zip(layer, layer_ref):
+                assert np.allclose(param, param_ref, rtol = rtol, atol = 0)
+
+def test_single_member_estimator():
+    data, nn = make_problem()
+    for alg_class, kwargs in ((il.LayeredImpression, {}), (il.LayeredAlternatingREINFORCE, {'decay': 1}), (il.Backpropagation, {})):
+        stats_ref = simulation_stats(nn, alg_class(nn, 1e-4, 1, **kwargs), data, 200)
+        stats = il.SNREstimator(nn, alg_class, 1e-4, 1, batch_size = 1, **kwargs).run(data, 200, seed = 120994)
+        assert_stats_close(stats, stats_ref, 1e-10)
+
+def test_update_snr_sequential(monkeypatch):
+    #the original SNR mode seeded np.random before its Simulation
+    data, nn = make_problem()
+    monkeypatch.setattr(il.exp_params, 'epoch_num_snr', 200, raising = False)
+    monkeypatch.setattr(il.exp_params, 'pooled_noise', False)
+    learn_alg = il.LayeredImpression(nn, 1e-4, 1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        np.random.seed(120994)
+        il.Simulation(data, None, nn, epoch_num = 200, train = False, compare_algs = [learn_alg], learning_stats = True).run()
+        stats = il.update_snr(nn, il.LayeredImpression, data, 1e-4, 1, batch_size = 1)
+    assert_stats_close(stats, learn_alg.get_learning_stats(), 0)
@@ -0,0 +1,64 @@
+"""Regression check: a Simulation run through its StepPlan matches the general step it replaces, which calls
+forward, update_learning_vars and assign_vars (or update_learning_stats) on the objects directly"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def make_alg(nn, algorithm):
+    if algorithm == 'wake_sleep':
+        return il.LayeredImpression(nn, 1e-3, 1)
+    return il.LayeredAlternatingREINFORCE(nn, 1e-9, 1, decay = 0.9)
+
+def general_run(nn, learn_alg, data, learning_stats):
+    #the step of Simulation.run before the plan, for one seeded epoch
+    nn.set_noise(il.NoiseProvider(1))
+    nn.set_phase('wake')
+    nn.reset()
+    learn_alg.reset_learning()
+    latent = np.zeros((nn.n_hidden, data.shape[1]))
+    loss = np.zeros((1, data.shape[1]))
+    for tt in range(0, data.shape[1]):
+        nn.forward(data[:, tt])
+        if learning_stats:
+            learn_alg.update_learning_vars(record_stats = True)
+            learn_alg.update_learning_stats()
+        else:
+            learn_alg.update_learning_vars()
+            learn_alg.assign_vars()
+        latent[:, tt] = np.concatenate([layer.h for layer in nn.layer_list[1::]])
+        loss[0, tt] = nn.loss_total
+    nn.set_noise(None)
+    return latent, loss
+
+def test_step_plan_matches_general_step():
+    np.random.seed(0)
+    data = np.random.normal(size = (6, 600)) * 0.3
+    for network_kwargs in ({}, {'fused': True}):
+        for algorithm in ('wake_sleep', 'reinforce'):
+            for learning_stats in (False, True):
+                runs = []
+                for planned in (False, True):
+                    np.random.seed(2)
+                    nn = il.DeepHM([6, 4, 2], [0.01]*3, [0.01]*3, **network_kwargs)
+                    learn_alg = make_alg(nn, algorithm)
+                    if planned and learning_stats:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            latent, loss = il.Simulation(data, None, nn, train = False, compare_algs = [learn_alg], learning_stats = True, seed = 1).run()
+                    elif planned:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            latent, loss = il.Simulation(data, learn_alg, nn, seed = 1).run()
+                    else:
+                        latent, loss = general_run(nn, learn_alg, data, learning_stats)
+                    params = [param.copy() for layer in nn.layer_list for param in layer.params_list_rec + layer.params_list_gen]
+                    stats = learn_alg.get_learning_stats() if learning_stats else ([], [], [])
+                    runs.append((latent, loss, params, stats))
+                (latent, loss, params, stats), (latent_plan, loss_plan, params_plan, stats_plan) = runs
+                case = (network_kwargs, algorithm, learning_stats)
+                assert np.array_equal(latent_plan, latent) and np.array_equal(loss_plan, loss), case
+                for a, b in zip(params_plan, params):
+                    assert np.array_equal(a, b), case
+                for moment, moment_plan in zip(stats, stats_plan):
+                    for layer, layer_plan in zip(moment, moment_plan):
+                        for a, b in zip(layer, layer_plan):
+                            assert np.array_equal(a, b), case
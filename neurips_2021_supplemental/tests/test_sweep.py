@@ -0,0 +1,30 @@
+"""Regression check: every row of the lr_optim ensemble sweep starts from the network a single task would train, and
+with the same learning rate trains like it"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def test_rows_share_the_initial_network():
+    np.random.seed(120994)
+    network = il.LayeredHM([4, 2], [0.01]*2, [0.01]*2)
+    for fused, arena in ((False, False), (True, True)):
+        ensemble = il.EnsembleLayeredHM([4, 2], [0.01]*2, [0.01]*2, 3, fused = fused, arena = arena, rng = np.random.default_rng(0))
+        ensemble.copy_network(network)
+        for layer, member_layer in zip(network.layer_list, ensemble.layer_list):
+            for param, member_param in zip(layer.params_list_rec + layer.params_list_gen, member_layer.params_list_rec + member_layer.params_list_gen):
+                for kk in range(0, 3):
+                    assert np.array_equal(np.broadcast_to(member_param[kk], np.shape(param)), param)
+
+def test_single_row_matches_network():
+    np.random.seed(0)
+    data = np.random.normal(size = (4, 500)) * 0.3
+    network = il.LayeredHM([4, 2], [0.01]*2, [0.01]*2)
+    ensemble = il.EnsembleLayeredHM([4, 2], [0.01]*2, [0.01]*2, 1, rng = np.random.default_rng(0))
+    ensemble.copy_network(network)
+    with contextlib.redirect_stdout(io.StringIO()):
+        np.random.seed(5)
+        latent, loss = il.Simulation(data, il.LayeredImpression(network, 1e-3, 1), network).run()
+        np.random.seed(5)
+        latent_ens, loss_ens = il.Simulation(data, il.EnsembleImpression(ensemble, np.array([1e-3]), 1), ensemble).run()
+    assert np.allclose(latent_ens[0], latent) and np.allclose(loss_ens[0], loss[0])
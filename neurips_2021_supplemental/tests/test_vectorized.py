@@ -0,0 +1,23 @@
+"""Regression check: a frozen wake-only run evaluated over whole blocks of time (Simulation(vectorized = True)) gives
+the latents and loss of the step-by-step run with the same noise, up to rounding"""
+import io
+import contextlib
+import numpy as np
+import impression_learning as il
+
+def test_vectorized_matches_stepped():
+    for N_vec in ([6, 3], [8, 5, 3]):
+        for network_kwargs in ({}, {'fused': True}, {'arena': True}):
+            np.random.seed(0)
+            data = np.random.normal(size = (N_vec[0], 1000)) * 0.3
+            nn = il.DeepHM(N_vec, [0.05]*len(N_vec), [0.05]*len(N_vec), **network_kwargs)
+            runs = []
+            with contextlib.redirect_stdout(io.StringIO()):
+                for vectorized in (False, True):
+                    sim = il.Simulation(data, il.LayeredImpression(nn, 1e-3, 1), nn, train = False, seed = 3, vectorized = vectorized)
+                    assert sim.frozen_wake_run() == vectorized
+                    runs.append(sim.run())
+            (latent, loss), (latent_vec, loss_vec) = runs
+            assert latent_vec.shape == latent.shape and loss_vec.shape == loss.shape
+            assert np.allclose(latent_vec, latent, rtol = 1e-10, atol = 1e-12), (N_vec, network_kwargs)
+            assert np.allclose(loss_vec, loss, rtol = 1e-10, atol = 1e-12), (N_vec, network_kwargs)